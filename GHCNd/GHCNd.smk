@@ -3,6 +3,15 @@ import os
 # Directory to store GHCNd data.
 # This is where all downloaded and processed GHCNd files will be saved.
 GHCND_DATA_DIR = os.path.join(DATADIR, "GHCNd")
+GHCND_SRC_DIR = os.path.join(HOMEDIR, "GHCNd")  # this folder
+
+
+configfile: os.path.join(GHCND_SRC_DIR, "ghcnd_config.yml")
+
+
+ghcnd_env = os.path.join(GHCND_SRC_DIR, "ghcnd_env.yml")
+GHCND_ARCHIVE_URL = "https://www.ncei.noaa.gov/data/global-historical-climatology-network-daily/archive/daily-summaries-latest.tar.gz"
+GHCND_MANIFEST = os.path.join(HOMEDIR, config["ghcnd"]["manifest"])
 
 
 # Rule: Download the GHCNd .tar.gz file.
@@ -11,7 +20,7 @@ rule download_ghcnd:
     output:
         temp(os.path.join(GHCND_DATA_DIR, "daily-summaries-latest.tar.gz")),
     shell:
-        "curl -o {output} https://www.ncei.noaa.gov/data/global-historical-climatology-network-daily/archive/daily-summaries-latest.tar.gz"
+        "curl -o {output} " + GHCND_ARCHIVE_URL
 
 
 # Rule: Download additional GHCNd text files.
@@ -43,6 +52,72 @@ rule unzip_ghcnd:
         "mkdir -p {output} && tar -xzf {input} -C {output}"
 
 
+# Rule: Convert the GHCNd .tar.gz file into a partitioned Parquet dataset.
+# The station files are read straight from the archive, without extracting it.
+rule ghcnd_to_parquet:
+    input:
+        script=os.path.join(GHCND_SRC_DIR, "tarball_to_parquet.py"),
+        tarball=os.path.join(GHCND_DATA_DIR, "daily-summaries-latest.tar.gz"),
+        stations=os.path.join(GHCND_DATA_DIR, "ghcnd-stations.txt"),
+    output:
+        directory(os.path.join(GHCND_DATA_DIR, "daily-summaries.parquet")),
+    log:
+        os.path.join(LOGS, "ghcnd_to_parquet.log"),
+    params:
+        partition_by=" ".join(config["ghcnd"]["partition_by"]),
+        batch_rows=config["ghcnd"]["batch_rows"],
+    conda:
+        ghcnd_env
+    threads: config["ghcnd"]["parse_workers"]
+    shell:
+        "python {input.script} --tarball {input.tarball} --stations {input.stations} --outdir {output} --partition-by {params.partition_by} --workers {threads} --batch-rows {params.batch_rows}"
+
+
+# Rule: Rewrite the GHCNd .tar.gz file as independent gzip blocks, with an index.
+# Single stations can then be read from it in milliseconds, see ghcnd_utils/archive.py.
+rule ghcnd_seekable:
+    input:
+        os.path.join(GHCND_DATA_DIR, "daily-summaries-latest.tar.gz"),
+    output:
+        archive=os.path.join(GHCND_DATA_DIR, "daily-summaries-latest.blocks.tar.gz"),
+        index=os.path.join(
+            GHCND_DATA_DIR, "daily-summaries-latest.blocks.tar.gz.index.parquet"
+        ),
+    log:
+        os.path.join(LOGS, "ghcnd_seekable.log"),
+    params:
+        block_size=config["ghcnd"]["block_size_mb"],
+    conda:
+        ghcnd_env
+    shell:
+        "cd {GHCND_SRC_DIR} && python -m ghcnd_utils.archive build --tarball {input} --outfile {output.archive} --block-size {params.block_size}"
+
+
+# Rule: Refresh the station files and the Parquet dataset from the latest archive.
+# The archive is streamed from NCEI without saving it, and only the stations that
+# changed since the last refresh (as recorded in the manifest) are rewritten.
+# Run it with `snakemake ghcnd_refresh --forcerun ghcnd_refresh`.
+rule ghcnd_refresh:
+    input:
+        script=os.path.join(GHCND_SRC_DIR, "refresh_ghcnd.py"),
+        stations=os.path.join(GHCND_DATA_DIR, "ghcnd-stations.txt"),
+        station_dir=ancient(os.path.join(GHCND_DATA_DIR, "daily-summaries")),
+        parquet_dir=ancient(os.path.join(GHCND_DATA_DIR, "daily-summaries.parquet")),
+    output:
+        os.path.join(GHCND_DATA_DIR, "daily-summaries-changes.txt"),
+    log:
+        os.path.join(LOGS, "ghcnd_refresh.log"),
+    params:
+        url=GHCND_ARCHIVE_URL,
+        manifest=GHCND_MANIFEST,
+        partition_by=" ".join(config["ghcnd"]["partition_by"]),
+        batch_rows=config["ghcnd"]["batch_rows"],
+    conda:
+        ghcnd_env
+    shell:
+        "python {input.script} --source {params.url} --station-dir {input.station_dir} --manifest {params.manifest} --parquet-dir {input.parquet_dir} --stations {input.stations} --partition-by {params.partition_by} --batch-rows {params.batch_rows} --report {output}"
+
+
 # Define all GHCNd files to be created by the `ghcnd` rule.
 all_ghcnd_files = [
     os.path.join(GHCND_DATA_DIR, "ghcnd-{name}.txt").format(name=name)
@@ -50,6 +125,8 @@ all_ghcnd_files = [
 ] + [
     os.path.join(GHCND_DATA_DIR, "ghcnd-documentation.pdf"),
     os.path.join(GHCND_DATA_DIR, "daily-summaries"),
+    os.path.join(GHCND_DATA_DIR, "daily-summaries.parquet"),
+    os.path.join(GHCND_DATA_DIR, "daily-summaries-latest.blocks.tar.gz"),
 ]
 
 
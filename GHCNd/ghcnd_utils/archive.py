@@ -0,0 +1,307 @@
+"""
+Read single GHCNd stations from the daily summaries archive without extracting it.
+
+A gzip stream can only be decompressed from its start, so reading one station out of
+`daily-summaries-latest.tar.gz` means decompressing on average half of the archive.
+`build_seekable` rewrites the archive once as a series of independent gzip blocks of
+about `block_size` bytes of tar data each, starting at the boundaries between
+station files, and saves an index with the block and position of every station. A
+station is then read by seeking to its block and decompressing that block only up to
+the end of the station file, which takes milliseconds.
+
+The rewritten archive is still a valid `.tar.gz`: `tar -xzf` and
+`tarfile.open(..., "r:gz")` read all of it. Stream readers (`"r|gz"`) stop after the
+first block, so keep the original archive for `tarball_to_parquet.py` and
+`refresh_ghcnd.py`.
+
+Example:
+    python -m ghcnd_utils.archive build --tarball daily-summaries-latest.tar.gz \
+        --outfile daily-summaries-latest.blocks.tar.gz
+
+    from ghcnd_utils.archive import SeekableArchive
+
+    archive = SeekableArchive("daily-summaries-latest.blocks.tar.gz")
+    df = archive.read_station("USW00012960")
+"""
+
+import argparse
+import io
+import os
+import tarfile
+import zlib
+from collections import defaultdict
+from typing import BinaryIO, Dict, Iterable, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# the columns of the index, one row per station
+INDEX_SCHEMA = pa.schema(
+    [
+        ("station", pa.string()),
+        ("block_offset", pa.int64()),
+        ("block_length", pa.int64()),
+        ("data_offset", pa.int64()),
+        ("size", pa.int64()),
+    ]
+)
+
+# gzip framing for zlib
+GZIP_WBITS = 31
+
+
+def index_path(archive: str) -> str:
+    """The index of a seekable archive, `{archive}.index.parquet`."""
+    return archive + ".index.parquet"
+
+
+def _padding(size: int) -> bytes:
+    """The zeros that pad tar data to a whole number of 512-byte blocks."""
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+class _BlockWriter:
+    """Write data as consecutive, independent gzip members."""
+
+    def __init__(self, f: BinaryIO, level: int) -> None:
+        self.f = f
+        self.level = level
+        self.n_blocks = 0
+        self._start()
+
+    def _start(self) -> None:
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+        self.block_offset = self.f.tell()
+        self.n_bytes = 0
+
+    def write(self, data: bytes) -> None:
+        """Add uncompressed data to the current block."""
+        self.f.write(self.compressor.compress(data))
+        self.n_bytes += len(data)
+
+    def end_block(self) -> int:
+        """Finish the current block, start a new one, and return its length."""
+        self.f.write(self.compressor.flush())
+        length = self.f.tell() - self.block_offset
+        self.n_blocks += 1
+        self._start()
+        return length
+
+
+def build_seekable(
+    tarball: str, outfile: str, block_size: int = 2**20, level: int = 6
+) -> int:
+    """Rewrite the daily summaries archive as independent gzip blocks, with an index.
+
+    The archive is streamed, so it is not extracted to disk. The index is saved as
+    `index_path(outfile)`. Both files are written under temporary names and only
+    moved into place once complete.
+
+    Args:
+        tarball (str): Path to `daily-summaries-latest.tar.gz`.
+        outfile (str): Path to save the rewritten archive.
+        block_size (int, optional): Uncompressed size in bytes after which a block
+            is finished at the next station file. Smaller blocks make reads faster
+            and the archive larger.
+        level (int, optional): The gzip compression level.
+
+    Returns:
+        int: The number of station files.
+
+    Example:
+        build_seekable("daily-summaries-latest.tar.gz",
+                       "daily-summaries-latest.blocks.tar.gz")
+    """
+    rows = {name: [] for name in INDEX_SCHEMA.names}
+    pending: List[int] = []  # the rows of the current block
+    tmpfile = outfile + ".part"
+    with tarfile.open(tarball, "r|gz") as tar, open(tmpfile, "wb") as f:
+        writer = _BlockWriter(f, level)
+
+        def end_block() -> None:
+            length = writer.end_block()
+            for row in pending:
+                rows["block_length"][row] = length
+            pending.clear()
+
+        for member in tar:
+            if not member.isfile():
+                continue
+            data = tar.extractfile(member).read()
+            header = member.tobuf(
+                tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape"
+            )
+            if member.name.endswith(".csv"):
+                rows["station"].append(os.path.basename(member.name)[: -len(".csv")])
+                rows["block_offset"].append(writer.block_offset)
+                rows["block_length"].append(0)
+                rows["data_offset"].append(writer.n_bytes + len(header))
+                rows["size"].append(len(data))
+                pending.append(len(rows["station"]) - 1)
+            writer.write(header + data + _padding(len(data)))
+            if writer.n_bytes >= block_size:
+                end_block()
+        # the end-of-archive marker
+        writer.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+        end_block()
+
+    index = pa.table(rows, schema=INDEX_SCHEMA)
+    pq.write_table(index, index_path(outfile) + ".part")
+    os.replace(tmpfile, outfile)
+    os.replace(index_path(outfile) + ".part", index_path(outfile))
+    print(f"Wrote {index.num_rows} stations in {writer.n_blocks} blocks to {outfile}")
+    return index.num_rows
+
+
+class SeekableArchive:
+    """Read station files from an archive made by `build_seekable`.
+
+    Attributes:
+        path (str): Path to the archive.
+        index (pd.DataFrame): The block and position of each station, indexed by
+            station ID.
+    """
+
+    def __init__(self, path: str, index_file: str = None) -> None:
+        """Open an archive and load its index.
+
+        Args:
+            path (str): Path to the archive.
+            index_file (str, optional): Path to its index. Defaults to
+                `index_path(path)`.
+        """
+        self.path = path
+        index = pq.read_table(index_file or index_path(path)).to_pandas()
+        self.index = index.set_index("station")
+
+    @property
+    def stations(self) -> List[str]:
+        """The station IDs in the archive."""
+        return self.index.index.tolist()
+
+    def read_csvs(self, stations: Iterable[str]) -> Dict[str, bytes]:
+        """Read the CSV files of some stations.
+
+        Each block is read and decompressed once, and only up to the end of the last
+        station file needed from it.
+
+        Args:
+            stations (Iterable[str]): The station IDs.
+
+        Returns:
+            Dict[str, bytes]: The content of the CSV file of each station.
+
+        Raises:
+            KeyError: If a station is not in the archive.
+        """
+        stations = list(stations)
+        missing = [station for station in stations if station not in self.index.index]
+        if missing:
+            raise KeyError(f"Stations not in {self.path}: {missing}")
+
+        by_block = defaultdict(list)
+        for station, row in self.index.loc[stations].iterrows():
+            by_block[(row["block_offset"], row["block_length"])].append(
+                (station, row["data_offset"], row["size"])
+            )
+        csvs = {}
+        with open(self.path, "rb") as f:
+            for (block_offset, block_length), members in sorted(by_block.items()):
+                f.seek(block_offset)
+                end = max(offset + size for _, offset, size in members)
+                data = zlib.decompressobj(GZIP_WBITS).decompress(
+                    f.read(block_length), end
+                )
+                for station, offset, size in members:
+                    csvs[station] = data[offset : offset + size]
+        return {station: csvs[station] for station in stations}
+
+    def read_csv(self, station: str) -> bytes:
+        """Read the CSV file of one station.
+
+        Args:
+            station (str): The station ID, e.g. "USW00012960".
+
+        Returns:
+            bytes: The content of its CSV file.
+        """
+        return self.read_csvs([station])[station]
+
+    def read_stations(self, stations: Iterable[str]) -> Dict[str, pd.DataFrame]:
+        """Read the daily summaries of some stations.
+
+        Args:
+            stations (Iterable[str]): The station IDs.
+
+        Returns:
+            Dict[str, pd.DataFrame]: The CSV file of each station, as a table with a
+                row per day.
+
+        Example:
+            from ghcnd_utils.stations import StationIndex
+
+            index = StationIndex.from_files("ghcnd-stations.txt")
+            houston = index.within_radius(29.76, -95.37, radius_km=50)
+            dfs = archive.read_stations(houston["station"])
+        """
+        return {
+            station: pd.read_csv(
+                io.BytesIO(data), parse_dates=["DATE"], low_memory=False
+            )
+            for station, data in self.read_csvs(stations).items()
+        }
+
+    def read_station(self, station: str) -> pd.DataFrame:
+        """Read the daily summaries of one station.
+
+        Args:
+            station (str): The station ID, e.g. "USW00012960".
+
+        Returns:
+            pd.DataFrame: Its CSV file, as a table with a row per day.
+        """
+        return self.read_stations([station])[station]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Make and read a seekable GHCNd daily summaries archive."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Rewrite the archive with an index.")
+    build.add_argument(
+        "--tarball", required=True, help="Path to daily-summaries-latest.tar.gz."
+    )
+    build.add_argument(
+        "--outfile", required=True, help="Path to save the seekable archive."
+    )
+    build.add_argument(
+        "--block-size",
+        type=float,
+        default=1,
+        help="Uncompressed size of the blocks, in MB.",
+    )
+    build.add_argument("--level", type=int, default=6, help="gzip compression level.")
+
+    extract = subparsers.add_parser(
+        "extract", help="Save the CSV files of some stations."
+    )
+    extract.add_argument("--archive", required=True, help="The seekable archive.")
+    extract.add_argument(
+        "--station", required=True, action="append", help="Station ID. Repeatable."
+    )
+    extract.add_argument("--outdir", default=".", help="Directory for the CSV files.")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_seekable(
+            args.tarball, args.outfile, int(args.block_size * 2**20), args.level
+        )
+    else:
+        os.makedirs(args.outdir, exist_ok=True)
+        csvs = SeekableArchive(args.archive).read_csvs(args.station)
+        for station, data in csvs.items():
+            with open(os.path.join(args.outdir, f"{station}.csv"), "wb") as f:
+                f.write(data)
@@ -0,0 +1,130 @@
+"""
+Keep track of the station files of the last GHCNd daily summaries archive.
+
+`daily-summaries-latest.tar.gz` is republished with every station in it, but only a
+fraction of the stations change between releases. The manifest is a small SQLite
+database with the size, modification time and checksum of each station file of the
+last archive that was applied, so that a refresh can tell which members of a new
+archive differ without comparing them to the extracted files.
+
+Example:
+    python -m ghcnd_utils.manifest --manifest /data/GHCNd/.ghcnd_manifest.sqlite
+"""
+
+import argparse
+import hashlib
+import os
+from datetime import datetime
+from typing import Dict, Iterable, Tuple
+
+from util.sqlite import connect
+
+# how update times are stored
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    station TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    updated TEXT NOT NULL
+)
+"""
+
+
+def checksum(data: bytes) -> str:
+    """The checksum of the content of a station file, as a hex string."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class Manifest:
+    """The size, modification time and checksum of each station file, in SQLite.
+
+    Attributes:
+        path (str): Path to the SQLite database.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open the manifest, creating the database if it does not exist.
+
+        Args:
+            path (str): Path to the SQLite database.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with connect(self.path) as conn:
+            conn.execute(SCHEMA)
+
+    def members(self) -> Dict[str, Tuple[int, int, str]]:
+        """Get the recorded station files.
+
+        Returns:
+            Dict[str, Tuple[int, int, str]]: The size, modification time and checksum
+                of the file of each station.
+        """
+        with connect(self.path) as conn:
+            rows = conn.execute(
+                "SELECT station, size, mtime, checksum FROM members"
+            ).fetchall()
+        return {station: (size, mtime, digest) for station, size, mtime, digest in rows}
+
+    def update(
+        self,
+        members: Iterable[Tuple[str, int, int, str]],
+        removed: Iterable[str] = (),
+    ) -> None:
+        """Record station files and forget removed stations, in one transaction.
+
+        Args:
+            members (Iterable[Tuple[str, int, int, str]]): The station, size,
+                modification time and checksum of each new or changed file.
+            removed (Iterable[str], optional): Stations that are no longer in the
+                archive.
+
+        Returns:
+            None
+        """
+        updated = datetime.now().strftime(TIME_FORMAT)
+        with connect(self.path) as conn:
+            conn.executemany(
+                "INSERT INTO members (station, size, mtime, checksum, updated) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (station) DO UPDATE SET size = excluded.size, "
+                "mtime = excluded.mtime, checksum = excluded.checksum, "
+                "updated = excluded.updated",
+                [(*member, updated) for member in members],
+            )
+            conn.executemany(
+                "DELETE FROM members WHERE station = ?",
+                [(station,) for station in removed],
+            )
+
+    def summary(self) -> Dict[str, object]:
+        """Count the recorded stations.
+
+        Returns:
+            Dict[str, object]: The number of stations, their total size in bytes and
+                the last update time.
+        """
+        with connect(self.path) as conn:
+            n_stations, size, updated = conn.execute(
+                "SELECT COUNT(*), SUM(size), MAX(updated) FROM members"
+            ).fetchone()
+        return {"stations": n_stations, "bytes": size or 0, "updated": updated}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Show the station files recorded in a GHCNd manifest."
+    )
+    parser.add_argument(
+        "--manifest", required=True, help="Path to the SQLite manifest."
+    )
+    args = parser.parse_args()
+
+    counts = Manifest(args.manifest).summary()
+    print(
+        f"{counts['stations']} stations, {counts['bytes'] / 2**30:.2f} GiB, "
+        f"last updated {counts['updated']}"
+    )
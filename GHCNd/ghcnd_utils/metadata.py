@@ -0,0 +1,189 @@
+"""
+Read the GHCNd station and inventory metadata files.
+
+`ghcnd-stations.txt` and `ghcnd-inventory.txt` are fixed-width text files with about
+130k and 800k lines. `pd.read_fwf` parses them line by line in Python, which takes
+seconds. Here the whole file is read as one block of bytes, viewed as a 2D array of
+characters, and each column is cut out of it with one slice, so the parsing runs in
+numpy.
+
+The parsed tables are cached as Parquet next to the text file, and the cache is
+used for as long as the text file keeps the same size and modification time.
+
+Example:
+    from ghcnd_utils.metadata import read_inventory, read_stations
+
+    stations = read_stations("/data/GHCNd/ghcnd-stations.txt")
+    inventory = read_inventory("/data/GHCNd/ghcnd-inventory.txt")
+"""
+
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# The columns of each file, as (name, first, last, dtype) with 1-based character
+# positions as in the GHCNd readme; dtype is None for text columns
+STATION_COLUMNS = [
+    ("station", 1, 11, None),
+    ("latitude", 13, 20, "float64"),
+    ("longitude", 22, 30, "float64"),
+    ("elevation", 32, 37, "float64"),
+    ("state", 39, 40, None),
+    ("name", 42, 71, None),
+    ("gsn_flag", 73, 75, None),
+    ("hcn_crn_flag", 77, 79, None),
+    ("wmo_id", 81, 85, None),
+]
+INVENTORY_COLUMNS = [
+    ("station", 1, 11, None),
+    ("latitude", 13, 20, "float64"),
+    ("longitude", 22, 30, "float64"),
+    ("element", 32, 35, None),
+    ("first_year", 37, 40, "int32"),
+    ("last_year", 42, 45, "int32"),
+]
+
+# keys of the Parquet metadata that record which text file a cache was made from
+CACHE_KEYS = (b"source_size", b"source_mtime")
+
+
+def _char_array(fname: str) -> np.ndarray:
+    """Read a text file as a 2D array with one row of bytes per line.
+
+    Lines shorter than the longest line are padded with spaces.
+    """
+    with open(fname, "rb") as f:
+        raw = f.read()
+    if not raw:
+        return np.zeros((0, 0), dtype="S1")
+    width = raw.find(b"\n")
+    n_lines = len(raw) // (width + 1)
+    if width > 0 and n_lines * (width + 1) == len(raw):
+        chars = np.frombuffer(raw, dtype="S1").reshape(n_lines, width + 1)
+        # all lines have the same length if every line ends at the same column
+        if (chars[:, width] == b"\n").all():
+            return chars[:, :width]
+    lines = raw.rstrip(b"\n").split(b"\n")
+    width = max(len(line) for line in lines)
+    padded = np.array([line.ljust(width) for line in lines], dtype=f"S{width}")
+    return padded.view("S1").reshape(len(lines), width)
+
+
+def read_fixed_width(fname: str, columns: List[Tuple]) -> pd.DataFrame:
+    """Parse a fixed-width text file with vectorized slicing.
+
+    Args:
+        fname (str): Path to the text file.
+        columns (List[Tuple]): `(name, first, last, dtype)` of each column, with
+            1-based inclusive character positions. Text columns (dtype None) are
+            stripped of spaces, and empty text is None.
+
+    Returns:
+        pd.DataFrame: One row per line.
+    """
+    chars = _char_array(fname)
+    data = {}
+    for name, first, last, dtype in columns:
+        last = min(last, chars.shape[1])
+        width = max(last - first + 1, 0)
+        # one fixed-width bytes value per line, e.g. b"  29.7600"
+        field = np.ascontiguousarray(chars[:, first - 1 : last])
+        values = field.view(f"S{width}").ravel() if width else field.ravel()
+        if dtype is None:
+            text = np.char.strip(values.astype(f"U{max(width, 1)}"))
+            data[name] = pd.Series(text).replace("", None)
+        else:
+            data[name] = values.astype(dtype)
+    return pd.DataFrame(data)
+
+
+def _source_stamp(fname: str) -> Dict[bytes, bytes]:
+    """The size and modification time of a file, as Parquet metadata."""
+    stat = os.stat(fname)
+    return {
+        CACHE_KEYS[0]: str(stat.st_size).encode(),
+        CACHE_KEYS[1]: str(stat.st_mtime_ns).encode(),
+    }
+
+
+def _cache_file(fname: str) -> str:
+    """The Parquet cache of a text file."""
+    return os.path.splitext(fname)[0] + ".parquet"
+
+
+def read_cached(fname: str, columns: List[Tuple], cache: bool = True) -> pd.DataFrame:
+    """Parse a fixed-width file, or read it from its Parquet cache if up to date.
+
+    The cache is `{name}.parquet` next to `{name}.txt`. It is rewritten when the
+    size or modification time of the text file changes.
+
+    Args:
+        fname (str): Path to the text file.
+        columns (List[Tuple]): The columns, see `read_fixed_width`.
+        cache (bool, optional): Use and update the cache.
+
+    Returns:
+        pd.DataFrame: One row per line.
+    """
+    if not cache:
+        return read_fixed_width(fname, columns)
+
+    cache_file = _cache_file(fname)
+    stamp = _source_stamp(fname)
+    if os.path.exists(cache_file):
+        metadata = pq.read_schema(cache_file).metadata or {}
+        if all(metadata.get(key) == stamp[key] for key in CACHE_KEYS):
+            return pd.read_parquet(cache_file)
+
+    df = read_fixed_width(fname, columns)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **stamp})
+    tmpfile = cache_file + ".part"
+    try:
+        pq.write_table(table, tmpfile)
+        os.replace(tmpfile, cache_file)
+    except OSError:
+        # a read-only data directory should not stop anyone from reading the file
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    return df
+
+
+def read_stations(fname: str, cache: bool = True) -> pd.DataFrame:
+    """Read `ghcnd-stations.txt`.
+
+    Args:
+        fname (str): Path to `ghcnd-stations.txt`.
+        cache (bool, optional): Use and update the Parquet cache next to the file.
+
+    Returns:
+        pd.DataFrame: The columns station, latitude, longitude, elevation, state,
+            name, gsn_flag, hcn_crn_flag and wmo_id, one row per station.
+
+    Example:
+        stations = read_stations("ghcnd-stations.txt")
+        stations[stations["state"] == "TX"]
+    """
+    return read_cached(fname, STATION_COLUMNS, cache=cache)
+
+
+def read_inventory(fname: str, cache: bool = True) -> pd.DataFrame:
+    """Read `ghcnd-inventory.txt`.
+
+    Args:
+        fname (str): Path to `ghcnd-inventory.txt`.
+        cache (bool, optional): Use and update the Parquet cache next to the file.
+
+    Returns:
+        pd.DataFrame: The columns station, latitude, longitude, element, first_year
+            and last_year, one row per station and element.
+
+    Example:
+        inventory = read_inventory("ghcnd-inventory.txt")
+        inventory[inventory["element"] == "PRCP"]
+    """
+    return read_cached(fname, INVENTORY_COLUMNS, cache=cache)
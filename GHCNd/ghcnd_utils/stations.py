@@ -0,0 +1,276 @@
+"""
+Find GHCNd stations by location and by the elements they record.
+
+`StationIndex` keeps a KD-tree of the stations on the unit sphere, so that the
+nearest stations to a point, or the stations within a radius, are found in a few
+milliseconds without computing the distance to every station. Element queries are
+answered from `ghcnd-inventory.txt`, grouped by element once when the index is made.
+
+Example:
+    from ghcnd_utils.stations import StationIndex
+
+    index = StationIndex.from_files("ghcnd-stations.txt", "ghcnd-inventory.txt")
+    index.nearest(29.76, -95.37, n=5, element="PRCP", years=(1950, 2020))
+    index.within_radius(29.76, -95.37, radius_km=50)
+    index.in_bbox(-106.6, -93.5, 25.8, 36.5, element="TMAX")
+"""
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from .metadata import read_inventory, read_stations
+
+# mean radius of the Earth, in km
+EARTH_RADIUS = 6371.0
+
+
+def _unit_vectors(lat, lon) -> np.ndarray:
+    """Convert latitudes and longitudes in degrees to points on the unit sphere."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+def _chord(distance_km: float) -> float:
+    """The straight-line distance on the unit sphere for a great-circle distance."""
+    return 2 * np.sin(min(distance_km / EARTH_RADIUS, np.pi) / 2)
+
+
+def _great_circle(chord: np.ndarray) -> np.ndarray:
+    """The great-circle distance in km for a straight-line distance on the unit sphere."""
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+class StationIndex:
+    """Spatial and inventory queries over the GHCNd stations.
+
+    Every query returns rows of the station table, with a `distance_km` column for
+    the queries around a point. Queries can be restricted to the stations that
+    record an element, optionally over a whole range of years.
+
+    Attributes:
+        stations (pd.DataFrame): The stations, as from `read_stations`.
+        tree (cKDTree): The stations on the unit sphere.
+    """
+
+    def __init__(self, stations: pd.DataFrame, inventory: pd.DataFrame = None):
+        """Build the index.
+
+        Args:
+            stations (pd.DataFrame): The stations, with the columns station,
+                latitude and longitude.
+            inventory (pd.DataFrame, optional): The inventory, with the columns
+                station, element, first_year and last_year. Needed for the element
+                queries.
+        """
+        self.stations = stations.reset_index(drop=True)
+        self.tree = cKDTree(
+            _unit_vectors(self.stations["latitude"], self.stations["longitude"])
+        )
+        self._positions = pd.Series(
+            np.arange(len(self.stations)), index=self.stations["station"]
+        )
+        # for each element, the station positions and the years they cover
+        self._elements: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        if inventory is not None:
+            positions = self._positions.reindex(inventory["station"]).to_numpy()
+            known = ~np.isnan(positions)
+            inventory = inventory[known]
+            positions = positions[known].astype(np.int64)
+            for element, rows in inventory.groupby("element").indices.items():
+                self._elements[element] = (
+                    positions[rows],
+                    inventory["first_year"].to_numpy()[rows],
+                    inventory["last_year"].to_numpy()[rows],
+                )
+
+    @classmethod
+    def from_files(
+        cls, stations_file: str, inventory_file: str = None, cache: bool = True
+    ) -> "StationIndex":
+        """Build the index from `ghcnd-stations.txt` and `ghcnd-inventory.txt`.
+
+        Args:
+            stations_file (str): Path to `ghcnd-stations.txt`.
+            inventory_file (str, optional): Path to `ghcnd-inventory.txt`.
+            cache (bool, optional): Use the Parquet caches of the files, see
+                `ghcnd_utils.metadata.read_cached`.
+
+        Returns:
+            StationIndex: The index.
+        """
+        stations = read_stations(stations_file, cache=cache)
+        inventory = None
+        if inventory_file is not None:
+            inventory = read_inventory(inventory_file, cache=cache)
+        return cls(stations, inventory)
+
+    def has_element(
+        self, element: str, years: Optional[Tuple[int, int]] = None
+    ) -> np.ndarray:
+        """Find the stations that record an element.
+
+        Args:
+            element (str): The element, e.g. "PRCP".
+            years (Tuple[int, int], optional): The first and last year that must be
+                covered. Defaults to any record.
+
+        Returns:
+            np.ndarray: A boolean mask over `stations`.
+
+        Raises:
+            ValueError: If the index has no inventory.
+        """
+        if not self._elements:
+            raise ValueError("The index was built without an inventory")
+        mask = np.zeros(len(self.stations), dtype=bool)
+        if element not in self._elements:
+            return mask
+        positions, first_year, last_year = self._elements[element]
+        keep = np.ones(len(positions), dtype=bool)
+        if years is not None:
+            keep = (first_year <= years[0]) & (last_year >= years[1])
+        mask[positions[keep]] = True
+        return mask
+
+    def with_element(
+        self, element: str, years: Optional[Tuple[int, int]] = None
+    ) -> pd.DataFrame:
+        """Get the stations that record an element.
+
+        Args:
+            element (str): The element, e.g. "PRCP".
+            years (Tuple[int, int], optional): The first and last year that must be
+                covered. Defaults to any record.
+
+        Returns:
+            pd.DataFrame: The matching stations.
+
+        Example:
+            index.with_element("TMAX", years=(1950, 2020))
+        """
+        return self.stations[self.has_element(element, years)]
+
+    def _filter(
+        self,
+        positions: np.ndarray,
+        element: Optional[str],
+        years: Optional[Tuple[int, int]],
+    ) -> np.ndarray:
+        """Keep the station positions that record an element, if one is given."""
+        if element is None:
+            return positions
+        return positions[self.has_element(element, years)[positions]]
+
+    def _around(self, lat: float, lon: float, positions: np.ndarray) -> pd.DataFrame:
+        """Get stations with their distance to a point, nearest first."""
+        point = _unit_vectors([lat], [lon])[0]
+        chord = np.linalg.norm(self.tree.data[positions] - point, axis=1)
+        order = np.argsort(chord, kind="stable")
+        result = self.stations.iloc[positions[order]].copy()
+        result["distance_km"] = _great_circle(chord[order])
+        return result
+
+    def nearest(
+        self,
+        lat: float,
+        lon: float,
+        n: int = 1,
+        element: str = None,
+        years: Optional[Tuple[int, int]] = None,
+    ) -> pd.DataFrame:
+        """Get the stations nearest to a point.
+
+        Args:
+            lat (float): Latitude of the point, in degrees.
+            lon (float): Longitude of the point, in degrees.
+            n (int, optional): Number of stations.
+            element (str, optional): Only keep stations that record this element.
+            years (Tuple[int, int], optional): The first and last year that the
+                element must cover.
+
+        Returns:
+            pd.DataFrame: Up to `n` stations, nearest first, with `distance_km`.
+
+        Example:
+            index.nearest(29.76, -95.37, n=5, element="PRCP", years=(1950, 2020))
+        """
+        point = _unit_vectors([lat], [lon])[0]
+        if element is None:
+            k = min(n, len(self.stations))
+            positions = np.atleast_1d(self.tree.query(point, k=k)[1])
+            return self._around(lat, lon, positions)
+
+        # ask for more neighbours until enough of them record the element
+        candidates = self.has_element(element, years)
+        n_available = int(candidates.sum())
+        k = min(max(4 * n, 16), len(self.stations))
+        while True:
+            positions = np.atleast_1d(self.tree.query(point, k=k)[1])
+            positions = positions[candidates[positions]]
+            if len(positions) >= min(n, n_available) or k == len(self.stations):
+                return self._around(lat, lon, positions[:n])
+            k = min(4 * k, len(self.stations))
+
+    def within_radius(
+        self,
+        lat: float,
+        lon: float,
+        radius_km: float,
+        element: str = None,
+        years: Optional[Tuple[int, int]] = None,
+    ) -> pd.DataFrame:
+        """Get the stations within a great-circle distance of a point.
+
+        Args:
+            lat (float): Latitude of the point, in degrees.
+            lon (float): Longitude of the point, in degrees.
+            radius_km (float): The distance, in km.
+            element (str, optional): Only keep stations that record this element.
+            years (Tuple[int, int], optional): The first and last year that the
+                element must cover.
+
+        Returns:
+            pd.DataFrame: The stations, nearest first, with `distance_km`.
+        """
+        point = _unit_vectors([lat], [lon])[0]
+        positions = np.array(
+            self.tree.query_ball_point(point, _chord(radius_km)), dtype=np.int64
+        )
+        return self._around(lat, lon, self._filter(positions, element, years))
+
+    def in_bbox(
+        self,
+        lon_min: float,
+        lon_max: float,
+        lat_min: float,
+        lat_max: float,
+        element: str = None,
+        years: Optional[Tuple[int, int]] = None,
+    ) -> pd.DataFrame:
+        """Get the stations inside a longitude-latitude box.
+
+        Args:
+            lon_min (float): Western edge, in degrees from -180 to 180. A box with
+                `lon_min > lon_max` crosses the antimeridian.
+            lon_max (float): Eastern edge.
+            lat_min (float): Southern edge.
+            lat_max (float): Northern edge.
+            element (str, optional): Only keep stations that record this element.
+            years (Tuple[int, int], optional): The first and last year that the
+                element must cover.
+
+        Returns:
+            pd.DataFrame: The stations.
+        """
+        lat = self.stations["latitude"].to_numpy()
+        lon = self.stations["longitude"].to_numpy()
+        in_lon = (lon >= lon_min) & (lon <= lon_max)
+        if lon_min > lon_max:
+            in_lon = (lon >= lon_min) | (lon <= lon_max)
+        positions = np.flatnonzero(in_lon & (lat >= lat_min) & (lat <= lat_max))
+        return self.stations.iloc[self._filter(positions, element, years)]
@@ -0,0 +1,377 @@
+"""
+Refresh the extracted GHCNd station files, and the Parquet dataset, from a new archive.
+
+Downloading `daily-summaries-latest.tar.gz` and extracting all of it again rewrites
+every station file, although only a fraction of the stations change between
+releases. This script streams the new archive (from NCEI or from a local file)
+without saving it, and compares each member with the manifest of the last refresh
+(see `ghcnd_utils.manifest`):
+
+- a member with the same size and modification time is skipped without reading it,
+- otherwise its checksum is compared, and the station file is only rewritten if its
+  content changed,
+- stations that are no longer in the archive are removed.
+
+If a Parquet dataset made by `tarball_to_parquet.py` is given, only its files that
+hold rows of changed or removed stations are rewritten without those rows, and the
+new rows of the changed stations are added as new files. The archive is never on
+disk, and files are replaced one at a time, so the refresh needs little more disk
+space than the data itself.
+
+The first refresh with an empty manifest compares the members with the files that
+are already extracted, so the manifest is filled without rewriting them. Later
+refreshes only trust the manifest: a station file left behind by an interrupted
+refresh, but not yet in the manifest, is written and added to the Parquet dataset
+again.
+
+Example:
+    python refresh_ghcnd.py --station-dir /data/GHCNd/daily-summaries \
+        --manifest .ghcnd_manifest.sqlite \
+        --parquet-dir /data/GHCNd/daily-summaries.parquet \
+        --stations /data/GHCNd/ghcnd-stations.txt --report changes.txt
+"""
+
+import argparse
+import bisect
+import glob
+import os
+import tarfile
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Sequence, Set
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ghcnd_utils.manifest import Manifest, checksum
+from tarball_to_parquet import parse_station_csv, station_table, write_rows
+
+ARCHIVE_URL = "https://www.ncei.noaa.gov/data/global-historical-climatology-network-daily/archive/daily-summaries-latest.tar.gz"
+
+# the partition columns that only depend on the station
+STATION_PARTITIONS = {"country": lambda station: station[:2]}
+
+
+@contextmanager
+def open_archive(source: str) -> Iterator[tarfile.TarFile]:
+    """Open a `.tar.gz` archive from a URL or a path as a stream, without saving it."""
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source) as response, tarfile.open(
+            fileobj=response, mode="r|gz"
+        ) as tar:
+            yield tar
+    else:
+        with tarfile.open(source, mode="r|gz") as tar:
+            yield tar
+
+
+def _file_checksum(fname: str) -> str:
+    """The checksum of a file, or None if it does not exist."""
+    if not os.path.exists(fname):
+        return None
+    with open(fname, "rb") as f:
+        return checksum(f.read())
+
+
+def _write_file(fname: str, data: bytes, mtime: int) -> None:
+    """Replace a file in one step, with the modification time of the archive member."""
+    tmpfile = fname + ".part"
+    with open(tmpfile, "wb") as f:
+        f.write(data)
+    os.utime(tmpfile, (mtime, mtime))
+    os.replace(tmpfile, fname)
+
+
+def refresh_station_files(
+    source: str, station_dir: str, manifest: Manifest
+) -> Dict[str, object]:
+    """Rewrite the station files that differ from those of a new archive.
+
+    The manifest is not updated here, see `refresh`, except while it is empty: the
+    members that match an extracted file are then recorded before the first file
+    is written, so that the next refresh no longer compares the extracted files.
+
+    Args:
+        source (str): URL or path of `daily-summaries-latest.tar.gz`.
+        station_dir (str): Directory of the extracted station files.
+        manifest (Manifest): The station files of the last refresh.
+
+    Returns:
+        Dict[str, object]: The stations that were "added", "changed" and
+            "removed", the number "unchanged", and the "members" to record in the
+            manifest as (station, size, mtime, checksum).
+    """
+    known = manifest.members()
+    # only an empty manifest is filled from the files that are already extracted
+    bootstrap = not known
+    matched = []
+    recorded = False
+    seen = set()
+    report = {"added": [], "changed": [], "removed": [], "unchanged": 0, "members": []}
+    os.makedirs(station_dir, exist_ok=True)
+    with open_archive(source) as tar:
+        for member in tar:
+            if not (member.isfile() and member.name.endswith(".csv")):
+                continue
+            station = os.path.basename(member.name)[: -len(".csv")]
+            fname = os.path.join(station_dir, f"{station}.csv")
+            seen.add(station)
+            previous = known.get(station)
+            if (
+                previous is not None
+                and previous[:2] == (member.size, int(member.mtime))
+                and os.path.exists(fname)
+            ):
+                report["unchanged"] += 1
+                continue
+
+            data = tar.extractfile(member).read()
+            digest = checksum(data)
+            report["members"].append((station, member.size, int(member.mtime), digest))
+            if previous is not None:
+                current = previous[2]
+            elif bootstrap:
+                current = _file_checksum(fname)
+                if current == digest:
+                    matched.append(report["members"][-1])
+            else:
+                current = None
+            if current == digest and os.path.exists(fname):
+                report["unchanged"] += 1
+                continue
+            if bootstrap and not recorded:
+                manifest.update(matched)
+                recorded = True
+            _write_file(fname, data, int(member.mtime))
+            report["changed" if current is not None else "added"].append(station)
+
+    for station in sorted(set(known) - seen):
+        fname = os.path.join(station_dir, f"{station}.csv")
+        if os.path.exists(fname):
+            os.remove(fname)
+        report["removed"].append(station)
+    return report
+
+
+def _partition_values(fname: str, root: str) -> Dict[str, str]:
+    """The hive partition values of a file of a dataset, e.g. {"element": "PRCP"}."""
+    parts = os.path.relpath(os.path.dirname(fname), root).split(os.sep)
+    return dict(part.split("=", 1) for part in parts if "=" in part)
+
+
+def _may_hold(fname: str, stations: List[str]) -> bool:
+    """Check the station statistics of a Parquet file for some sorted stations."""
+    metadata = pq.ParquetFile(fname).metadata
+    column = metadata.schema.names.index("station")
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(column).statistics
+        if stats is None or not stats.has_min_max:
+            return True
+        first = bisect.bisect_left(stations, stats.min)
+        if first < len(stations) and stations[first] <= stats.max:
+            return True
+    return False
+
+
+def remove_station_rows(parquet_dir: str, stations: Set[str]) -> int:
+    """Drop the rows of some stations from a partitioned Parquet dataset, in place.
+
+    Only the files that may hold rows of the stations, from their partition and
+    their statistics, are read, and only those that do are rewritten.
+
+    Args:
+        parquet_dir (str): Directory of the dataset.
+        stations (Set[str]): The station IDs.
+
+    Returns:
+        int: The number of files rewritten or removed.
+    """
+    if not stations:
+        return 0
+    sorted_stations = sorted(stations)
+    allowed = {
+        key: {value(station) for station in stations}
+        for key, value in STATION_PARTITIONS.items()
+    }
+    n_files = 0
+    for fname in glob.glob(
+        os.path.join(parquet_dir, "**", "*.parquet"), recursive=True
+    ):
+        values = _partition_values(fname, parquet_dir)
+        if any(key in values and values[key] not in allowed[key] for key in allowed):
+            continue
+        if not _may_hold(fname, sorted_stations):
+            continue
+        table = pq.ParquetFile(fname).read()
+        keep = pc.invert(pc.is_in(table["station"], pa.array(sorted_stations)))
+        n_keep = pc.sum(keep).as_py() or 0
+        if n_keep == table.num_rows:
+            continue
+        if n_keep == 0:
+            os.remove(fname)
+        else:
+            tmpfile = fname + ".part"
+            pq.write_table(table.filter(keep), tmpfile, compression="zstd")
+            os.replace(tmpfile, fname)
+        n_files += 1
+    return n_files
+
+
+def add_station_rows(
+    parquet_dir: str,
+    station_dir: str,
+    stations: Sequence[str],
+    stations_file: str,
+    partition_by: Sequence[str],
+    batch_rows: int = 5_000_000,
+) -> int:
+    """Parse some extracted station files and add their rows to the dataset.
+
+    Args:
+        parquet_dir (str): Directory of the dataset.
+        station_dir (str): Directory of the extracted station files.
+        stations (Sequence[str]): The station IDs.
+        stations_file (str): Path to `ghcnd-stations.txt`.
+        partition_by (Sequence[str]): Columns the dataset is partitioned by.
+        batch_rows (int, optional): Number of parsed rows held before they are
+            written.
+
+    Returns:
+        int: The number of rows added.
+    """
+    metadata = station_table(stations_file)
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    tables = []
+    n_rows = 0
+    n_total = 0
+    batch = 0
+    for station in stations:
+        with open(os.path.join(station_dir, f"{station}.csv"), "rb") as f:
+            table = parse_station_csv(station, f.read())
+        tables.append(table)
+        n_rows += table.num_rows
+        if n_rows >= batch_rows:
+            write_rows(
+                tables, metadata, parquet_dir, partition_by, f"refresh-{stamp}-{batch}"
+            )
+            n_total += n_rows
+            tables, n_rows, batch = [], 0, batch + 1
+    if tables:
+        write_rows(
+            tables, metadata, parquet_dir, partition_by, f"refresh-{stamp}-{batch}"
+        )
+        n_total += n_rows
+    return n_total
+
+
+def refresh(
+    source: str,
+    station_dir: str,
+    manifest_path: str,
+    parquet_dir: str = None,
+    stations_file: str = None,
+    partition_by: Sequence[str] = ("element", "country"),
+    batch_rows: int = 5_000_000,
+    report_file: str = None,
+) -> Dict[str, object]:
+    """Bring the station files, and optionally the Parquet dataset, up to date.
+
+    The manifest is only updated once everything else is, so an interrupted
+    refresh is picked up again by the next one.
+
+    Args:
+        source (str): URL or path of `daily-summaries-latest.tar.gz`.
+        station_dir (str): Directory of the extracted station files.
+        manifest_path (str): Path to the SQLite manifest.
+        parquet_dir (str, optional): Directory of the Parquet dataset to update.
+        stations_file (str, optional): Path to `ghcnd-stations.txt`, needed with
+            `parquet_dir`.
+        partition_by (Sequence[str], optional): Columns the dataset is partitioned
+            by, as when it was made.
+        batch_rows (int, optional): Number of parsed rows held before they are
+            written.
+        report_file (str, optional): Path to save the changed stations, one
+            `{status} {station}` line each.
+
+    Returns:
+        Dict[str, object]: What changed, see `refresh_station_files`.
+
+    Raises:
+        ValueError: If `parquet_dir` is given without `stations_file`.
+
+    Example:
+        refresh(ARCHIVE_URL, "daily-summaries", ".ghcnd_manifest.sqlite")
+    """
+    if parquet_dir is not None and stations_file is None:
+        raise ValueError("Updating the Parquet dataset needs the stations file")
+    manifest = Manifest(manifest_path)
+    report = refresh_station_files(source, station_dir, manifest)
+    updated = report["added"] + report["changed"]
+    print(
+        f"{len(report['added'])} stations added, {len(report['changed'])} changed, "
+        f"{len(report['removed'])} removed, {report['unchanged']} unchanged"
+    )
+
+    if parquet_dir is not None and os.path.exists(parquet_dir):
+        # an added station may already have rows from an interrupted refresh
+        n_files = remove_station_rows(
+            parquet_dir, set(updated) | set(report["removed"])
+        )
+        n_rows = add_station_rows(
+            parquet_dir, station_dir, updated, stations_file, partition_by, batch_rows
+        )
+        print(f"Rewrote {n_files} Parquet files and added {n_rows} rows")
+
+    manifest.update(report["members"], report["removed"])
+    if report_file is not None:
+        with open(report_file, "w") as f:
+            for status in ("added", "changed", "removed"):
+                for station in report[status]:
+                    f.write(f"{status} {station}\n")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Refresh the GHCNd station files from a new archive."
+    )
+    parser.add_argument(
+        "--source",
+        default=ARCHIVE_URL,
+        help="URL or path of daily-summaries-latest.tar.gz.",
+    )
+    parser.add_argument(
+        "--station-dir", required=True, help="Directory of the station files."
+    )
+    parser.add_argument(
+        "--manifest", required=True, help="Path to the SQLite manifest."
+    )
+    parser.add_argument("--parquet-dir", help="Parquet dataset to update as well.")
+    parser.add_argument("--stations", help="Path to ghcnd-stations.txt.")
+    parser.add_argument(
+        "--partition-by",
+        nargs="+",
+        default=["element", "country"],
+        help="Columns the Parquet dataset is partitioned by.",
+    )
+    parser.add_argument(
+        "--batch-rows",
+        type=int,
+        default=5_000_000,
+        help="Number of parsed rows held in memory before they are written.",
+    )
+    parser.add_argument("--report", help="Path to save the changed stations.")
+    args = parser.parse_args()
+
+    refresh(
+        source=args.source,
+        station_dir=args.station_dir,
+        manifest_path=args.manifest,
+        parquet_dir=args.parquet_dir,
+        stations_file=args.stations,
+        partition_by=args.partition_by,
+        batch_rows=args.batch_rows,
+        report_file=args.report,
+    )
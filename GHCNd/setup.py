@@ -0,0 +1,14 @@
+from setuptools import setup, find_packages
+
+setup(
+    name="ghcnd_utils",
+    version="1.0",
+    packages=find_packages(),
+    long_description="Utilities for working with GHCNd data",
+    install_requires=[
+        "numpy",
+        "pandas",
+        "pyarrow",
+        "scipy",
+    ],
+)
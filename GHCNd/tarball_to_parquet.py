@@ -0,0 +1,326 @@
+"""
+Convert the GHCNd daily summaries archive into a partitioned Parquet dataset.
+
+`daily-summaries-latest.tar.gz` holds one CSV file per station, with one row per day
+and a column (and an `_ATTRIBUTES` column) per element. Any query has to parse the
+CSV text of every station. This script streams the members straight out of the
+tarball, without extracting it, parses them in parallel, and writes one long table
+with a row per station, day and element:
+
+    station, date, element, value, mflag, qflag, sflag, obs_time,
+    country, state, latitude, longitude, elevation, name
+
+The station metadata comes from `ghcnd-stations.txt`, and the country is the first
+two characters of the station ID. The dataset is partitioned (by default by element
+and country), so that a query such as "all PRCP in the US" only reads the files of
+that partition. Values are as in the archive, e.g. tenths of mm for PRCP.
+
+Memory stays bounded: at most a few members per worker are in flight, and parsed
+rows are written out every `--batch-rows` rows, as one file per partition and batch.
+
+Example:
+    python tarball_to_parquet.py --tarball daily-summaries-latest.tar.gz \
+        --stations ghcnd-stations.txt --outdir daily-summaries.parquet
+"""
+
+import argparse
+import csv
+import io
+import os
+import shutil
+import tarfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Sequence, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from ghcnd_utils.metadata import read_stations
+
+# columns of the station CSV files that are not elements
+ID_COLUMNS = ["STATION", "DATE", "LATITUDE", "LONGITUDE", "ELEVATION", "NAME"]
+
+# the `_ATTRIBUTES` of each value are "mflag,qflag,sflag,obs_time"
+FLAG_COLUMNS = ["mflag", "qflag", "sflag", "obs_time"]
+FLAG_PATTERN = "^" + ",?".join(f"(?P<{flag}>[^,]*)" for flag in FLAG_COLUMNS) + "$"
+
+# the station metadata joined to every row
+STATION_FIELDS = ["station", "latitude", "longitude", "elevation", "state", "name"]
+
+# the columns of a parsed station file
+PARSED_SCHEMA = pa.schema(
+    [
+        ("station", pa.string()),
+        ("date", pa.date32()),
+        ("element", pa.string()),
+        ("value", pa.float32()),
+    ]
+    + [(flag, pa.string()) for flag in FLAG_COLUMNS]
+)
+
+# the columns of the dataset
+SCHEMA = pa.schema(
+    [
+        ("station", pa.string()),
+        ("date", pa.date32()),
+        ("element", pa.string()),
+        ("value", pa.float32()),
+        ("mflag", pa.string()),
+        ("qflag", pa.string()),
+        ("sflag", pa.string()),
+        ("obs_time", pa.string()),
+        ("country", pa.string()),
+        ("state", pa.string()),
+        ("latitude", pa.float32()),
+        ("longitude", pa.float32()),
+        ("elevation", pa.float32()),
+        ("name", pa.string()),
+    ]
+)
+
+
+def iter_members(tarball: str) -> Iterator[Tuple[str, bytes]]:
+    """Read the station CSV files of the archive one at a time, without extracting it.
+
+    Args:
+        tarball (str): Path to `daily-summaries-latest.tar.gz`.
+
+    Yields:
+        Tuple[str, bytes]: The station ID and the content of its CSV file.
+    """
+    with tarfile.open(tarball, "r|gz") as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(".csv"):
+                station = os.path.basename(member.name)[: -len(".csv")]
+                yield station, tar.extractfile(member).read()
+
+
+def parse_station_csv(station: str, data: bytes) -> pa.Table:
+    """Parse the CSV file of one station into one row per day and element.
+
+    Args:
+        station (str): The station ID.
+        data (bytes): The content of its CSV file.
+
+    Returns:
+        pa.Table: The columns station, date, element, value and the flags, for the
+            values that are not missing.
+    """
+    # read every column as text, since the elements differ between stations
+    header = next(csv.reader([data.split(b"\n", 1)[0].decode()]))
+    wide = pv.read_csv(
+        io.BytesIO(data),
+        convert_options=pv.ConvertOptions(
+            column_types={name: pa.string() for name in header},
+            strings_can_be_null=False,
+        ),
+    )
+    dates = pc.cast(wide["DATE"], pa.date32())
+    no_attributes = pa.chunked_array([pa.array([""] * wide.num_rows, pa.string())])
+    tables = []
+    for element in header:
+        if element in ID_COLUMNS or element.endswith("_ATTRIBUTES"):
+            continue
+        values = pc.utf8_trim_whitespace(wide[element])
+        keep = pc.not_equal(values, "")
+        n_values = pc.sum(keep).as_py() or 0
+        if not n_values:
+            continue
+        attributes = (
+            wide[f"{element}_ATTRIBUTES"]
+            if f"{element}_ATTRIBUTES" in header
+            else no_attributes
+        )
+        flags = pc.extract_regex(pc.filter(attributes, keep), FLAG_PATTERN)
+        columns = {
+            "station": pa.array([station] * n_values, pa.string()),
+            "date": pc.filter(dates, keep),
+            "element": pa.array([element] * n_values, pa.string()),
+            "value": pc.cast(pc.filter(values, keep), pa.float32()),
+        }
+        for flag in FLAG_COLUMNS:
+            columns[flag] = pc.struct_field(flags, flag)
+        tables.append(pa.table(columns))
+    if not tables:
+        return PARSED_SCHEMA.empty_table()
+    return pa.concat_tables(tables)
+
+
+def _parse_many(members: Sequence[Tuple[str, bytes]]) -> pa.Table:
+    """Parse several station files in one task, to amortise the inter-process cost."""
+    return pa.concat_tables(
+        [parse_station_csv(station, data) for station, data in members]
+    )
+
+
+def station_table(stations_file: str) -> pa.Table:
+    """Read the station metadata that is joined to every row of the dataset.
+
+    Args:
+        stations_file (str): Path to `ghcnd-stations.txt`.
+
+    Returns:
+        pa.Table: The columns of `STATION_FIELDS`, typed as in `SCHEMA`.
+    """
+    return pa.Table.from_pandas(
+        read_stations(stations_file)[STATION_FIELDS],
+        schema=pa.schema([SCHEMA.field(name) for name in STATION_FIELDS]),
+        preserve_index=False,
+    )
+
+
+def write_rows(
+    tables: List[pa.Table],
+    stations: pa.Table,
+    outdir: str,
+    partition_by: Sequence[str],
+    basename: str,
+) -> None:
+    """Join the station metadata to parsed rows and add them to the dataset.
+
+    Args:
+        tables (List[pa.Table]): Parsed station files, see `parse_station_csv`.
+        stations (pa.Table): The station metadata, see `station_table`.
+        outdir (str): Directory of the Parquet dataset.
+        partition_by (Sequence[str]): Columns the dataset is partitioned by.
+        basename (str): Name of the new files, which is followed by a counter in
+            each partition. Existing files of the same name are replaced.
+
+    Returns:
+        None
+    """
+    rows = pa.concat_tables(tables)
+    rows = rows.append_column("country", pc.utf8_slice_codeunits(rows["station"], 0, 2))
+    rows = rows.join(stations, keys="station", join_type="left outer")
+    table = rows.select(SCHEMA.names).cast(SCHEMA)
+    pq.write_to_dataset(
+        table,
+        root_path=outdir,
+        partition_cols=list(partition_by),
+        basename_template=f"{basename}-{{i}}.parquet",
+        compression="zstd",
+    )
+
+
+def tarball_to_parquet(
+    tarball: str,
+    stations_file: str,
+    outdir: str,
+    partition_by: Sequence[str] = ("element", "country"),
+    max_workers: int = 4,
+    batch_rows: int = 5_000_000,
+    members_per_task: int = 20,
+) -> int:
+    """Convert the GHCNd daily summaries archive into a partitioned Parquet dataset.
+
+    The dataset is written to `{outdir}.tmp` and moved to `outdir` once complete.
+
+    Args:
+        tarball (str): Path to `daily-summaries-latest.tar.gz`.
+        stations_file (str): Path to `ghcnd-stations.txt`.
+        outdir (str): Directory of the Parquet dataset. It is replaced if it exists.
+        partition_by (Sequence[str], optional): Columns to partition the dataset by,
+            such as "element", "country" or "state".
+        max_workers (int, optional): Number of processes parsing CSV files.
+        batch_rows (int, optional): Number of parsed rows held before they are
+            written, which bounds the memory use.
+        members_per_task (int, optional): Number of station files per parsing task.
+
+    Returns:
+        int: The number of station files converted.
+
+    Example:
+        tarball_to_parquet(
+            "daily-summaries-latest.tar.gz", "ghcnd-stations.txt", "ghcnd.parquet"
+        )
+    """
+    stations = station_table(stations_file)
+    tmpdir = outdir + ".tmp"
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+
+    tables = []
+    n_rows = 0
+    n_stations = 0
+    batch = 0
+
+    def collect(done) -> None:
+        nonlocal n_rows, batch
+        for future in done:
+            table = future.result()
+            tables.append(table)
+            n_rows += table.num_rows
+        if n_rows >= batch_rows:
+            write_rows(tables, stations, tmpdir, partition_by, f"part-{batch:05d}")
+            tables.clear()
+            n_rows = 0
+            batch += 1
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        task = []
+        for member in iter_members(tarball):
+            task.append(member)
+            n_stations += 1
+            if len(task) < members_per_task:
+                continue
+            pending.add(executor.submit(_parse_many, task))
+            task = []
+            # keep a few tasks per worker in flight, so that the tarball is not
+            # read much faster than it is parsed
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        if task:
+            pending.add(executor.submit(_parse_many, task))
+        done, _ = wait(pending)
+        collect(done)
+    if tables:
+        write_rows(tables, stations, tmpdir, partition_by, f"part-{batch:05d}")
+
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.makedirs(tmpdir, exist_ok=True)
+    os.replace(tmpdir, outdir)
+    print(f"Converted {n_stations} stations to {outdir}")
+    return n_stations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert the GHCNd daily summaries tarball to Parquet."
+    )
+    parser.add_argument(
+        "--tarball", required=True, help="Path to daily-summaries-latest.tar.gz."
+    )
+    parser.add_argument("--stations", required=True, help="Path to ghcnd-stations.txt.")
+    parser.add_argument(
+        "--outdir", required=True, help="Directory of the Parquet dataset."
+    )
+    parser.add_argument(
+        "--partition-by",
+        nargs="+",
+        default=["element", "country"],
+        help="Columns to partition the dataset by.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of parsing processes."
+    )
+    parser.add_argument(
+        "--batch-rows",
+        type=int,
+        default=5_000_000,
+        help="Number of parsed rows held in memory before they are written.",
+    )
+    args = parser.parse_args()
+
+    tarball_to_parquet(
+        tarball=args.tarball,
+        stations_file=args.stations,
+        outdir=args.outdir,
+        partition_by=args.partition_by,
+        max_workers=args.workers,
+        batch_rows=args.batch_rows,
+    )
@@ -0,0 +1,145 @@
+"""
+Benchmark the NetCDF4 encoding options of `grib2_to_netcdf4.py`.
+
+For each encoding, a series of synthetic hourly precipitation subsets is written
+with `write_netcdf` and read back. The fields mimic MRMS QPE: mostly dry, with
+spatially coherent rain areas and values at 0.1 mm precision. The script reports
+the bytes on disk and the write and read throughput, in MB/s of float32 data.
+
+Example:
+    python benchmarks/benchmark_netcdf_encoding.py --nlat 200 --nlon 150 --hours 48
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "nexrad"))
+from grib2_to_netcdf4 import netcdf_encoding, write_netcdf
+
+# the settings to compare, as arguments of `netcdf_encoding`
+SETTINGS = {
+    "float32 (default)": {},
+    "float64": {"dtype": "float64"},
+    "float32 zlib 1": {"dtype": "float32", "compression": "zlib", "complevel": 1},
+    "float32 zlib 4": {"dtype": "float32", "compression": "zlib", "complevel": 4},
+    "float32 zstd 3": {"dtype": "float32", "compression": "zstd", "complevel": 3},
+    "int16 x0.1 zlib 4": {
+        "dtype": "int16",
+        "scale_factor": 0.1,
+        "compression": "zlib",
+        "complevel": 4,
+    },
+    "int16 x0.1 zstd 3": {
+        "dtype": "int16",
+        "scale_factor": 0.1,
+        "compression": "zstd",
+        "complevel": 3,
+    },
+    "int16 x0.1 zlib 4 50x50": {
+        "dtype": "int16",
+        "scale_factor": 0.1,
+        "compression": "zlib",
+        "complevel": 4,
+        "chunks": [50, 50],
+    },
+}
+
+
+def synthetic_precipitation(
+    nlat: int, nlon: int, rng: np.random.Generator
+) -> xr.DataArray:
+    """Make one hour of MRMS-like precipitation over a small bounding box.
+
+    Args:
+        nlat (int): Number of grid cells along latitude.
+        nlon (int): Number of grid cells along longitude.
+        rng (np.random.Generator): The random number generator.
+
+    Returns:
+        xr.DataArray: The precipitation field in mm.
+    """
+    # rain falls in coherent cells, so build the field on a coarse grid first
+    coarse = rng.gamma(0.3, 4.0, size=(nlat // 10 + 1, nlon // 10 + 1))
+    field = np.kron(coarse, np.ones((10, 10)))[:nlat, :nlon]
+    field *= rng.uniform(0.5, 1.5, size=field.shape)
+    field[field < 1.0] = 0.0
+    field = np.round(field, 1).astype("float32")
+
+    return xr.DataArray(
+        field,
+        dims=["latitude", "longitude"],
+        coords={
+            "latitude": 30.5 - 0.01 * np.arange(nlat),
+            "longitude": 264.0 + 0.01 * np.arange(nlon),
+        },
+        name="precipitation",
+        attrs={"units": "mm"},
+    )
+
+
+def benchmark_setting(
+    fields: list, options: dict, tmpdir: str
+) -> tuple[int, float, float]:
+    """Write and read the fields with one encoding.
+
+    Args:
+        fields (list): The hourly fields.
+        options (dict): The arguments of `netcdf_encoding`.
+        tmpdir (str): Directory for the files.
+
+    Returns:
+        tuple[int, float, float]: Bytes on disk, write seconds, read seconds.
+    """
+    encoding = netcdf_encoding(**options)
+    fnames = [os.path.join(tmpdir, f"{i:04d}.nc") for i in range(len(fields))]
+
+    t0 = time.perf_counter()
+    for field, fname in zip(fields, fnames):
+        write_netcdf(field, fname, encoding=encoding)
+    t_write = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for fname in fnames:
+        with xr.open_dataarray(fname) as da:
+            da.load()
+    t_read = time.perf_counter() - t0
+
+    nbytes = sum(os.path.getsize(fname) for fname in fnames)
+    return nbytes, t_write, t_read
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NetCDF4 encodings.")
+    parser.add_argument("--nlat", type=int, default=200, help="Grid cells (lat).")
+    parser.add_argument("--nlon", type=int, default=150, help="Grid cells (lon).")
+    parser.add_argument("--hours", type=int, default=48, help="Files per setting.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    fields = [synthetic_precipitation(args.nlat, args.nlon, rng) for _ in range(24)]
+    fields = [fields[i % len(fields)] for i in range(args.hours)]
+    megabytes = sum(field.nbytes for field in fields) / 1e6
+
+    print(f"{args.hours} hours of {args.nlat}x{args.nlon} cells ({megabytes:.1f} MB)")
+    print(
+        f"{'setting':<26}{'bytes/file':>12}{'ratio':>8}{'write MB/s':>12}{'read MB/s':>11}"
+    )
+    baseline = None
+    for name, options in SETTINGS.items():
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                nbytes, t_write, t_read = benchmark_setting(fields, options, tmpdir)
+            except (ValueError, RuntimeError) as e:
+                print(f"{name:<26}unavailable: {e}")
+                continue
+        baseline = baseline or nbytes
+        print(
+            f"{name:<26}{nbytes // args.hours:>12}{baseline / nbytes:>8.1f}"
+            f"{megabytes / t_write:>12.1f}{megabytes / t_read:>11.1f}"
+        )
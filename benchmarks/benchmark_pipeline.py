@@ -0,0 +1,297 @@
+"""
+Benchmark the steps of the NEXRAD and ERA5 workflows, and keep a history of results.
+
+Slow code in `TimeRange`, `namingconventions` or `subset_and_convert` otherwise only
+shows up as a slower nightly run. This script times:
+
+- `timerange`: `TimeRange` over the full archive span,
+- `naming`: the file name, URL and `fname2dt` conversions, one hour at a time and
+  vectorized over the full span,
+- `convert`: `subset_and_convert` of a synthetic GRIB2 file on the full MRMS CONUS
+  grid (3500 x 7000 cells) to a NetCDF4 subset,
+- `dag`: a dry run of `snakemake nexrad` and `snakemake ERA5` against an empty
+  temporary data directory, which is the time to plan the workflow. The NEXRAD
+  time range is pinned to end at `ETIME`, so the plan does not grow from day to day.
+
+Everything runs offline on generated fixtures. Each run is appended to a JSON lines
+history file with the git commit (`logs/benchmark_history.jsonl` by default), and compared with the last run on the same host,
+so that regressions stand out.
+
+Example:
+    python benchmarks/benchmark_pipeline.py
+    python benchmarks/benchmark_pipeline.py --only naming convert --repeat 5
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+from typing import Callable, Dict
+
+import eccodes
+import numpy as np
+
+from nexrad_utils.const import GAUGECORR_BEGINTIME
+from nexrad_utils.namingconventions import (
+    fname2dt,
+    fname2dt_many,
+    get_grib2_fname,
+    get_grib2_fname_many,
+    get_nc_fname,
+    get_nc_fname_many,
+    get_url,
+    get_url_many,
+)
+from nexrad_utils.nexrad import TimeRange
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(REPO_DIR, "nexrad"))
+from grib2_to_netcdf4 import subset_and_convert
+from benchmark_netcdf_encoding import synthetic_precipitation
+
+SECTIONS = ["timerange", "naming", "convert", "dag"]
+
+# the end of the archive span that is benchmarked
+ETIME = datetime(2024, 12, 31, 23)
+
+# the MRMS CONUS grid, with 0.01 degree cells from the north-west corner
+MRMS_LAT0 = 54.995
+MRMS_LON0 = 230.005
+MRMS_STEP = 0.01
+
+# the Houston bounding box of nexrad_config.yml
+BBOX = (264.0, 265.5, 28.5, 30.5)
+
+# a run is flagged when it is this much slower than the last one
+SLOWER = 1.2
+
+
+def best_of(func: Callable, repeat: int, setup: Callable = None) -> float:
+    """Time a function, and return the best of some repetitions in seconds."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        times.append(timeit.timeit(func, number=1))
+    return min(times)
+
+
+def bench_timerange(repeat: int) -> Dict[str, float]:
+    """Time `TimeRange` over the full archive span."""
+    return {
+        "timerange/full_span": best_of(
+            lambda: TimeRange(GAUGECORR_BEGINTIME, ETIME), repeat
+        )
+    }
+
+
+def bench_naming(repeat: int) -> Dict[str, float]:
+    """Time the naming conventions for a year of hours, and the full span at once."""
+    dts = TimeRange(GAUGECORR_BEGINTIME, ETIME).dt_valid
+    year = dts[-8760:].to_pydatetime()
+    fnames = get_grib2_fname_many(dts)
+    year_fnames = list(fnames[-8760:])
+    scalar = {
+        "get_grib2_fname": lambda: [get_grib2_fname(dt, "/data") for dt in year],
+        "get_nc_fname": lambda: [get_nc_fname(dt, "/data", "Houston") for dt in year],
+        "get_url": lambda: [get_url(dt) for dt in year],
+        "fname2dt": lambda: [fname2dt(fname) for fname in year_fnames],
+    }
+    many = {
+        "get_grib2_fname_many": lambda: get_grib2_fname_many(dts, "/data"),
+        "get_nc_fname_many": lambda: get_nc_fname_many(dts, "/data", "Houston"),
+        "get_url_many": lambda: get_url_many(dts),
+        "fname2dt_many": lambda: fname2dt_many(fnames),
+    }
+    results = {
+        f"naming/{name}_year": best_of(func, repeat) for name, func in scalar.items()
+    }
+    results.update(
+        {f"naming/{name}_span": best_of(func, repeat) for name, func in many.items()}
+    )
+    return results
+
+
+def write_grib2(fname: str, nlat: int, nlon: int, seed: int = 42) -> None:
+    """Write one hour of synthetic MRMS-like precipitation as a GRIB2 file.
+
+    Args:
+        fname (str): Path of the GRIB2 file.
+        nlat (int): Number of grid cells along latitude, from north to south.
+        nlon (int): Number of grid cells along longitude, from west to east.
+        seed (int, optional): Seed of the random field.
+
+    Returns:
+        None
+    """
+    field = synthetic_precipitation(nlat, nlon, np.random.default_rng(seed))
+    gid = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+    try:
+        for key, value in {
+            "Ni": nlon,
+            "Nj": nlat,
+            "latitudeOfFirstGridPointInDegrees": MRMS_LAT0,
+            "longitudeOfFirstGridPointInDegrees": MRMS_LON0,
+            "latitudeOfLastGridPointInDegrees": MRMS_LAT0 - MRMS_STEP * (nlat - 1),
+            "longitudeOfLastGridPointInDegrees": MRMS_LON0 + MRMS_STEP * (nlon - 1),
+            "iDirectionIncrementInDegrees": MRMS_STEP,
+            "jDirectionIncrementInDegrees": MRMS_STEP,
+            "bitsPerValue": 16,
+        }.items():
+            eccodes.codes_set(gid, key, value)
+        eccodes.codes_set_values(gid, field.values.astype(np.float64).ravel())
+        with open(fname, "wb") as f:
+            eccodes.codes_write(gid, f)
+    finally:
+        eccodes.codes_release(gid)
+
+
+def bench_convert(repeat: int, nlat: int, nlon: int) -> Dict[str, float]:
+    """Time `subset_and_convert` of a synthetic GRIB2 file to a NetCDF4 subset."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        grib2_file = os.path.join(tmpdir, "MRMS.grib2")
+        write_grib2(grib2_file, nlat, nlon)
+
+        def remove_outputs() -> None:
+            # cfgrib writes an index next to the file, which a new file would not have
+            for fname in glob.glob(os.path.join(tmpdir, "*.idx")) + glob.glob(
+                os.path.join(tmpdir, "*.nc")
+            ):
+                os.remove(fname)
+
+        return {
+            "convert/subset_and_convert": best_of(
+                lambda: subset_and_convert(
+                    grib2_file, os.path.join(tmpdir, "subset.nc"), *BBOX
+                ),
+                repeat,
+                setup=remove_outputs,
+            )
+        }
+
+
+def bench_dag(repeat: int) -> Dict[str, float]:
+    """Time snakemake dry runs of the NEXRAD and ERA5 workflows on an empty data dir."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        configfile = os.path.join(tmpdir, "config.yaml")
+        datadir = os.path.join(tmpdir, "data")
+        with open(configfile, "w") as f:
+            json.dump(
+                {
+                    "datadir": {"osx": datadir, "linux": datadir, "windows": datadir},
+                    "endtime": ETIME.isoformat(),
+                },
+                f,
+            )
+        for target in ["nexrad", "ERA5"]:
+            command = [
+                sys.executable,
+                "-m",
+                "snakemake",
+                "--dry-run",
+                "--quiet",
+                "--configfile",
+                configfile,
+                "--",
+                target,
+            ]
+
+            def dry_run() -> None:
+                subprocess.run(command, cwd=REPO_DIR, check=True, capture_output=True)
+
+            results[f"dag/{target}"] = best_of(dry_run, repeat)
+    return results
+
+
+def git_commit() -> str:
+    """The current commit of the repository, or None outside of git."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def last_run(history: str, host: str) -> Dict[str, float]:
+    """The results of the last run on a host, from the history file."""
+    previous = {}
+    if os.path.exists(history):
+        with open(history) as f:
+            for line in f:
+                run = json.loads(line)
+                if run["host"] == host:
+                    previous = run["results"]
+    return previous
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the workflow steps.")
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=SECTIONS,
+        default=SECTIONS,
+        help="Sections to run.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of timed repetitions."
+    )
+    parser.add_argument(
+        "--dag-repeat",
+        type=int,
+        default=1,
+        help="Number of repetitions of the snakemake dry runs, which are slow.",
+    )
+    parser.add_argument("--nlat", type=int, default=3500, help="Grid cells (lat).")
+    parser.add_argument("--nlon", type=int, default=7000, help="Grid cells (lon).")
+    parser.add_argument(
+        "--history",
+        default=os.path.join(REPO_DIR, "logs", "benchmark_history.jsonl"),
+        help="JSON lines file the results are appended to.",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    if "timerange" in args.only:
+        results.update(bench_timerange(args.repeat))
+    if "naming" in args.only:
+        results.update(bench_naming(args.repeat))
+    if "convert" in args.only:
+        results.update(bench_convert(args.repeat, args.nlat, args.nlon))
+    if "dag" in args.only:
+        results.update(bench_dag(args.dag_repeat))
+
+    host = platform.node()
+    previous = last_run(args.history, host)
+    print(f"{'benchmark':<36}{'seconds':>10}{'last run':>10}{'ratio':>8}")
+    for name, seconds in results.items():
+        line = f"{name:<36}{seconds:>10.4f}"
+        if name in previous:
+            ratio = seconds / previous[name]
+            line += f"{previous[name]:>10.4f}{ratio:>8.2f}"
+            if ratio > SLOWER:
+                line += "  slower"
+        print(line)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+    with open(args.history, "a") as f:
+        run = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "host": host,
+            "python": platform.python_version(),
+            "results": results,
+        }
+        f.write(json.dumps(run) + "\n")
@@ -0,0 +1,69 @@
+"""
+Benchmark the construction of a `TimeRange` over the full NEXRAD archive.
+
+This compares the current vectorized filtering of missing snapshots against the
+previous approach, which checked every hour against the plain `MISSING_SNAPSHOTS`
+list, and then filtered the result a second time in `nexrad.smk`.
+
+Example:
+    python benchmarks/benchmark_timerange.py --repeat 5
+"""
+
+import argparse
+import timeit
+from datetime import datetime
+
+import pandas as pd
+
+from nexrad_utils.const import GAUGECORR_BEGINTIME, MISSING_SNAPSHOTS
+from nexrad_utils.nexrad import TimeRange
+
+
+def timerange_list_scan(stime: datetime, etime: datetime) -> list:
+    """Filter the missing snapshots the way `TimeRange` and `nexrad.smk` used to.
+
+    Args:
+        stime (datetime): Start time of the range.
+        etime (datetime): End time of the range.
+
+    Returns:
+        list: The valid datetimes.
+    """
+    dt_all = pd.date_range(stime, etime, freq="h")
+    dt_valid = [dt for dt in dt_all if dt not in MISSING_SNAPSHOTS]
+    return [t for t in dt_valid if t not in MISSING_SNAPSHOTS]
+
+
+def timerange_vectorized(stime: datetime, etime: datetime) -> pd.DatetimeIndex:
+    """Filter the missing snapshots with the current `TimeRange`.
+
+    Args:
+        stime (datetime): Start time of the range.
+        etime (datetime): End time of the range.
+
+    Returns:
+        pd.DatetimeIndex: The valid datetimes.
+    """
+    return TimeRange(stime, etime).dt_valid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark TimeRange construction.")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of timed repetitions."
+    )
+    args = parser.parse_args()
+
+    stime = GAUGECORR_BEGINTIME
+    etime = datetime(2024, 12, 31, 23)
+
+    # both approaches must agree before we compare their speed
+    expected = timerange_list_scan(stime, etime)
+    assert list(timerange_vectorized(stime, etime)) == expected
+
+    print(f"{len(expected)} valid hours from {stime} to {etime}")
+    for func in [timerange_list_scan, timerange_vectorized]:
+        elapsed = timeit.repeat(
+            lambda: func(stime, etime), number=1, repeat=args.repeat
+        )
+        print(f"{func.__name__:>22}: {min(elapsed):.4f} s (best of {args.repeat})")
@@ -0,0 +1,332 @@
+"""
+Derive daily and monthly aggregates, and the integrated vapour transport, from the
+yearly ERA5 files.
+
+Means of a whole year of hourly data are often recomputed by loading the year into
+memory. This script streams a yearly file a block of time steps at a time, keeps a
+running sum, count, minimum and maximum for the current day or month, and writes each
+period as soon as it is complete. No more than `--max-memory` MB of hourly data are
+read at once.
+
+The magnitude of the integrated vapour transport (IVT) is computed once per year
+from the eastward and northward vertical integrals of water vapour flux, and stored
+as an hourly file like the other variables, so that it can be aggregated as well.
+
+Example:
+    python aggregate_era5.py ivt \
+        --eastward vertical_integral_of_eastward_water_vapour_flux_2020.nc \
+        --northward vertical_integral_of_northward_water_vapour_flux_2020.nc \
+        --outfile integrated_vapour_transport_2020.nc
+
+    python aggregate_era5.py resample --infile 2m_temperature_2020.nc \
+        --outfile 2m_temperature_daily_2020.nc --frequency daily \
+        --statistic mean --statistic max
+"""
+
+import argparse
+from typing import Dict, Iterator, Sequence, Tuple
+
+import netCDF4
+import numpy as np
+
+from cds_download import create_netcdf, data_variables, find_time_dim
+
+# the name of the IVT files, used like a CDS variable name
+IVT_NAME = "integrated_vapour_transport"
+
+# numpy datetime units of the periods, by frequency
+FREQUENCIES = {"daily": "D", "monthly": "M"}
+
+STATISTICS = ("mean", "min", "max", "sum")
+
+
+def _read_times(var: netCDF4.Variable) -> np.ndarray:
+    """Read a CF time coordinate as `datetime64[s]` values."""
+    dates = netCDF4.num2date(
+        var[:],
+        var.units,
+        getattr(var, "calendar", "standard"),
+        only_use_cftime_datetimes=False,
+        only_use_python_datetimes=True,
+    )
+    return np.array(dates, dtype="datetime64[s]")
+
+
+def _read_block(var: netCDF4.Variable, start: int, stop: int) -> np.ndarray:
+    """Read time steps of a variable, unpacked, as floats with NaN for missing."""
+    return np.ma.filled(var[start:stop].astype(np.float64), np.nan)
+
+
+def _block_size(step_bytes: int, max_memory: float, n_arrays: int = 1) -> int:
+    """Number of time steps of `n_arrays` variables that fit in `max_memory` MB."""
+    return max(1, int(max_memory * 2**20) // (step_bytes * n_arrays))
+
+
+def _create_output(
+    src: netCDF4.Dataset, dst: netCDF4.Dataset, time_dim: str, dims: Sequence[str]
+) -> None:
+    """Create the dimensions and coordinates of an output file, like those of `src`."""
+    dst.setncatts(src.__dict__)
+    dst.createDimension(time_dim, None)
+    for dim in dims[1:]:
+        dst.createDimension(dim, len(src.dimensions[dim]))
+    for dim in dims:
+        if dim not in src.variables:
+            continue
+        var = src[dim]
+        new_var = dst.createVariable(dim, var.dtype, (dim,))
+        new_var.setncatts(
+            {key: value for key, value in var.__dict__.items() if key != "_FillValue"}
+        )
+        if dim != time_dim:
+            new_var[:] = var[:]
+
+
+def _create_data_var(
+    dst: netCDF4.Dataset,
+    name: str,
+    dims: Sequence[str],
+    attrs: Dict,
+) -> netCDF4.Variable:
+    """Create a compressed float32 variable with one field per chunk."""
+    chunks = [1] + [len(dst.dimensions[dim]) for dim in dims[1:]]
+    var = dst.createVariable(
+        name,
+        np.float32,
+        dims,
+        fill_value=np.float32(np.nan),
+        compression="zlib",
+        complevel=4,
+        chunksizes=chunks,
+    )
+    var.setncatts(attrs)
+    return var
+
+
+def _segments(labels: np.ndarray) -> Iterator[Tuple[int, int]]:
+    """Split sorted labels into `(start, stop)` runs of equal values."""
+    bounds = [0, *(np.flatnonzero(labels[1:] != labels[:-1]) + 1), len(labels)]
+    return zip(bounds[:-1], bounds[1:])
+
+
+class _Accumulator:
+    """Running statistics over the time steps of one period."""
+
+    def __init__(self, shape: Tuple[int, ...]):
+        self.total = np.zeros(shape)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.min = np.full(shape, np.nan)
+        self.max = np.full(shape, np.nan)
+
+    def add(self, values: np.ndarray) -> None:
+        """Add time steps, along the first axis."""
+        valid = ~np.isnan(values)
+        self.total += np.where(valid, values, 0).sum(axis=0)
+        self.count += valid.sum(axis=0)
+        self.min = np.fmin(self.min, np.nanmin(values, axis=0, initial=np.inf))
+        self.max = np.fmax(self.max, np.nanmax(values, axis=0, initial=-np.inf))
+
+    def result(self, statistic: str) -> np.ndarray:
+        """Get one statistic, NaN where no time step was valid."""
+        if statistic == "sum":
+            return np.where(self.count > 0, self.total, np.nan)
+        if statistic == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return np.where(self.count > 0, self.total / self.count, np.nan)
+        if statistic == "min":
+            return np.where(self.count > 0, self.min, np.nan)
+        return np.where(self.count > 0, self.max, np.nan)
+
+
+def resample_file(
+    infile: str,
+    outfile: str,
+    frequency: str = "daily",
+    statistics: Sequence[str] = ("mean",),
+    max_memory: float = 256,
+) -> None:
+    """Aggregate an hourly ERA5 file to daily or monthly statistics.
+
+    Each variable `{name}` is saved as `{name}_{statistic}` for every statistic, on
+    a time coordinate that holds the start of each period. Missing values are
+    ignored, and a period without any valid value is NaN.
+
+    Args:
+        infile (str): An hourly ERA5 NetCDF file, such as a yearly download.
+        outfile (str): Path to save the aggregates.
+        frequency (str, optional): "daily" or "monthly".
+        statistics (Sequence[str], optional): Some of "mean", "min", "max", "sum".
+        max_memory (float, optional): Memory budget in MB for the hourly data read
+            at once.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the frequency or a statistic is unknown.
+
+    Example:
+        resample_file("2m_temperature_2020.nc", "2m_temperature_monthly_2020.nc",
+                      "monthly", ["mean", "max"])
+    """
+    if frequency not in FREQUENCIES:
+        raise ValueError(f"Unknown frequency {frequency}; use one of {FREQUENCIES}")
+    unknown = set(statistics) - set(STATISTICS)
+    if unknown:
+        raise ValueError(f"Unknown statistics {unknown}; use some of {STATISTICS}")
+
+    with netCDF4.Dataset(infile) as src, create_netcdf(outfile) as dst:
+        time_dim = find_time_dim(src, infile)
+        names = data_variables(src, time_dim)
+        times = _read_times(src[time_dim])
+        labels = times.astype(f"datetime64[{FREQUENCIES[frequency]}]")
+
+        time_var = src[time_dim]
+        dims = src[names[0]].dimensions
+        _create_output(src, dst, time_dim, dims)
+        period_starts = labels[np.r_[0, np.flatnonzero(labels[1:] != labels[:-1]) + 1]]
+        dst[time_dim][:] = netCDF4.date2num(
+            period_starts.astype("datetime64[s]").tolist(),
+            time_var.units,
+            getattr(time_var, "calendar", "standard"),
+        )
+
+        for name in names:
+            var = src[name]
+            attrs = {
+                key: value
+                for key, value in var.__dict__.items()
+                if key not in ("_FillValue", "scale_factor", "add_offset")
+            }
+            outputs = {
+                statistic: _create_data_var(
+                    dst,
+                    f"{name}_{statistic}",
+                    var.dimensions,
+                    {**attrs, "cell_methods": f"{time_dim}: {statistic}"},
+                )
+                for statistic in statistics
+            }
+
+            step_bytes = 8 * int(np.prod(var.shape[1:]))
+            block = _block_size(step_bytes, max_memory)
+            index = -1
+            current = None
+            acc = None
+            for start in range(0, len(times), block):
+                stop = min(start + block, len(times))
+                values = _read_block(var, start, stop)
+                for seg_start, seg_stop in _segments(labels[start:stop]):
+                    label = labels[start + seg_start]
+                    if label != current:
+                        if acc is not None:
+                            for statistic, out in outputs.items():
+                                out[index] = acc.result(statistic)
+                        index += 1
+                        current = label
+                        acc = _Accumulator(var.shape[1:])
+                    acc.add(values[seg_start:seg_stop])
+            if acc is not None:
+                for statistic, out in outputs.items():
+                    out[index] = acc.result(statistic)
+
+
+def compute_ivt(
+    eastward_file: str, northward_file: str, outfile: str, max_memory: float = 256
+) -> None:
+    """Compute the magnitude of the integrated vapour transport from its components.
+
+    Args:
+        eastward_file (str): Hourly vertical integral of eastward water vapour flux.
+        northward_file (str): Hourly vertical integral of northward water vapour flux,
+            on the same times and grid.
+        outfile (str): Path to save the hourly IVT, as the variable `ivt`.
+        max_memory (float, optional): Memory budget in MB for the data read at once.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the two files have different times or grids.
+
+    Example:
+        compute_ivt("viwve_2020.nc", "viwvn_2020.nc", "ivt_2020.nc")
+    """
+    with netCDF4.Dataset(eastward_file) as east, netCDF4.Dataset(
+        northward_file
+    ) as north, create_netcdf(outfile) as dst:
+        time_dim = find_time_dim(east, eastward_file)
+        (east_name,) = data_variables(east, time_dim)
+        (north_name,) = data_variables(north, time_dim)
+        east_var, north_var = east[east_name], north[north_name]
+        if east_var.shape != north_var.shape or not np.array_equal(
+            east[time_dim][:], north[time_dim][:]
+        ):
+            raise ValueError(
+                f"{eastward_file} and {northward_file} have different times or grids"
+            )
+
+        _create_output(east, dst, time_dim, east_var.dimensions)
+        dst[time_dim][:] = east[time_dim][:]
+        out = _create_data_var(
+            dst,
+            "ivt",
+            east_var.dimensions,
+            {
+                "long_name": "Magnitude of the vertically integrated water vapour flux",
+                "units": getattr(east_var, "units", "kg m**-1 s**-1"),
+            },
+        )
+
+        n_times = east_var.shape[0]
+        block = _block_size(8 * int(np.prod(east_var.shape[1:])), max_memory, 3)
+        for start in range(0, n_times, block):
+            stop = min(start + block, n_times)
+            out[start:stop] = np.hypot(
+                _read_block(east_var, start, stop), _read_block(north_var, start, stop)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Derive aggregates and IVT from yearly ERA5 files."
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=256,
+        help="Memory budget in MB for the hourly data read at once.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ivt = subparsers.add_parser("ivt", help="Compute the hourly IVT magnitude.")
+    ivt.add_argument("--eastward", required=True, help="Eastward flux file.")
+    ivt.add_argument("--northward", required=True, help="Northward flux file.")
+    ivt.add_argument("-o", "--outfile", required=True, help="Output file path.")
+
+    resample = subparsers.add_parser(
+        "resample", help="Aggregate an hourly file to days or months."
+    )
+    resample.add_argument("--infile", required=True, help="Hourly ERA5 file.")
+    resample.add_argument("-o", "--outfile", required=True, help="Output file path.")
+    resample.add_argument(
+        "--frequency", choices=list(FREQUENCIES), default="daily", help="Period."
+    )
+    resample.add_argument(
+        "--statistic",
+        choices=STATISTICS,
+        action="append",
+        help="Statistic to compute. Repeat for several (default: mean).",
+    )
+    args = parser.parse_args()
+
+    if args.command == "ivt":
+        compute_ivt(args.eastward, args.northward, args.outfile, args.max_memory)
+    else:
+        resample_file(
+            infile=args.infile,
+            outfile=args.outfile,
+            frequency=args.frequency,
+            statistics=args.statistic or ["mean"],
+            max_memory=args.max_memory,
+        )
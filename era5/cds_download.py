@@ -0,0 +1,545 @@
+"""
+Retrieve one year of ERA5 data from the CDS as several smaller requests.
+
+Requests for a whole year of hourly data wait longest in the CDS queue, and if one
+fails the whole year has to be fetched again. `retrieve_chunked` splits a yearly
+request into sub-requests of a few months each and submits them concurrently. Each
+finished chunk is kept on disk next to the output file, so running it again after a
+failure only fetches the missing chunks. Once all chunks are there, they are merged
+into the single yearly file, a block of time steps at a time so that the year never
+has to fit in memory.
+
+Several variables, and several pressure levels, can also be retrieved in one request
+and then split into one file per variable and level with `split_variables`, which
+saves a wait in the CDS queue per variable.
+
+Requests can be cropped to a bounding box on the server with `crop_request`, which
+avoids downloading global fields when only a region is used.
+
+The client only needs a `retrieve(dataset, request)` method that returns a result
+with a `download(target)` method, like `cdsapi.Client`, so a local fake can stand in
+for the CDS. The wait in the CDS queue, the transfer, and the merging and splitting
+of files are recorded as separate phases by `util.instrument`.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import netCDF4
+import numpy as np
+
+from util.instrument import file_size, span
+
+# names of the time dimension in files from the current and the legacy CDS
+TIME_DIMS = ("valid_time", "time")
+
+# names of the pressure level dimension in files from the current and the legacy CDS
+LEVEL_DIMS = ("pressure_level", "level")
+
+# names of the horizontal dimensions
+SPACE_DIMS = ("latitude", "longitude")
+
+# number of time steps copied at once when merging or splitting files
+MERGE_BLOCK = 24
+
+# attributes that define how the values of a variable are packed on disk
+PACKING_ATTRS = ("scale_factor", "add_offset", "_FillValue", "missing_value")
+
+# names of the variables in the NetCDF files, by their name in CDS requests
+SHORT_NAMES = {
+    "2m_temperature": "t2m",
+    "2m_dewpoint_temperature": "d2m",
+    "10m_u_component_of_wind": "u10",
+    "10m_v_component_of_wind": "v10",
+    "mean_sea_level_pressure": "msl",
+    "surface_pressure": "sp",
+    "total_precipitation": "tp",
+    "total_column_water_vapour": "tcwv",
+    "vertical_integral_of_eastward_water_vapour_flux": "viwve",
+    "vertical_integral_of_northward_water_vapour_flux": "viwvn",
+    "geopotential": "z",
+    "temperature": "t",
+    "specific_humidity": "q",
+    "relative_humidity": "r",
+    "u_component_of_wind": "u",
+    "v_component_of_wind": "v",
+    "vertical_velocity": "w",
+}
+
+
+def crop_request(bbox: Sequence[float], resolution: float = None) -> Dict:
+    """Build the part of a CDS request that crops and regrids on the server.
+
+    Args:
+        bbox (Sequence[float]): The `(lon_min, lon_max, lat_min, lat_max)` to keep.
+        resolution (float, optional): The grid spacing in degrees. ERA5 is native
+            at 0.25 degrees.
+
+    Returns:
+        Dict: The `area` (and `grid`) entries of the request.
+
+    Example:
+        crop_request((-125, -65, 25, 50), 0.25)
+    """
+    lon_min, lon_max, lat_min, lat_max = bbox
+    request = {"area": [lat_max, lon_min, lat_min, lon_max]}
+    if resolution is not None:
+        request["grid"] = [resolution, resolution]
+    return request
+
+
+def report_bytes_saved(outfile: str, resolution: float = 0.25) -> int:
+    """Print how many bytes cropping on the server saved for one file.
+
+    The size of the global file is estimated from the size of the cropped one, in
+    proportion to the number of grid cells.
+
+    Args:
+        outfile (str): A cropped NetCDF file from the CDS.
+        resolution (float, optional): Its grid spacing in degrees.
+
+    Returns:
+        int: The estimated number of bytes saved.
+    """
+    with netCDF4.Dataset(outfile) as ds:
+        n_cells = len(ds.dimensions["latitude"]) * len(ds.dimensions["longitude"])
+    n_global = round(360 / resolution) * (round(180 / resolution) + 1)
+    size = os.path.getsize(outfile)
+    saved = int(size * n_global / max(n_cells, 1)) - size
+    print(
+        f"{os.path.basename(outfile)}: {size / 1e6:.1f} MB for {n_cells} cells, "
+        f"about {saved / 1e6:.1f} MB less than the {n_global} cells of the globe"
+    )
+    return saved
+
+
+def split_request(request: Dict, months_per_chunk: int = 1) -> List[Tuple[str, Dict]]:
+    """Split a CDS request into sub-requests of a few months each.
+
+    Args:
+        request (Dict): The CDS request, with a list of months under `month`.
+        months_per_chunk (int, optional): Number of months per sub-request.
+
+    Returns:
+        List[Tuple[str, Dict]]: A label such as "01" or "01-03" and the sub-request,
+            for each chunk in time order.
+
+    Example:
+        split_request({"year": [2020], "month": ["01", "02", "03"]}, 2)
+    """
+    months = list(request["month"])
+    chunks = []
+    for start in range(0, len(months), months_per_chunk):
+        group = months[start : start + months_per_chunk]
+        label = group[0] if len(group) == 1 else f"{group[0]}-{group[-1]}"
+        chunks.append((label, {**request, "month": group}))
+    return chunks
+
+
+def retrieve(client, dataset: str, request: Dict, target: str) -> None:
+    """Retrieve a CDS request, recording the queue wait and the download apart.
+
+    Args:
+        client: Anything with a `retrieve(dataset, request)` method that returns a
+            result with a `download(target)` method, like `cdsapi.Client`.
+        dataset (str): The CDS dataset, e.g. "reanalysis-era5-single-levels".
+        request (Dict): The CDS request.
+        target (str): Path to save the data.
+
+    Returns:
+        None
+    """
+    months = request.get("month")
+    with span("cds_queue", dataset=dataset, months=months):
+        result = client.retrieve(dataset, request)
+    with span("cds_transfer", dataset=dataset, months=months) as transfer:
+        result.download(target)
+        transfer.bytes_in = file_size(target)
+
+
+def _retrieve_chunk(client, dataset: str, request: Dict, target: str) -> None:
+    """Retrieve one chunk, and only move it into place once it is complete."""
+    tmpfile = target + ".part"
+    try:
+        retrieve(client, dataset, request, tmpfile)
+        os.replace(tmpfile, target)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def _storage_options(var: netCDF4.Variable) -> Dict:
+    """Get the compression and chunking of a variable, to create a copy of it."""
+    options = {}
+    filters = var.filters() or {}
+    if filters.get("zlib"):
+        options["compression"] = "zlib"
+        options["complevel"] = filters.get("complevel", 4)
+    options["shuffle"] = bool(filters.get("shuffle"))
+    chunking = var.chunking()
+    if chunking != "contiguous" and var.dimensions:
+        options["chunksizes"] = chunking
+    return options
+
+
+def _create_variable(
+    dst: netCDF4.Dataset, var: netCDF4.Variable, unpack: bool = False
+) -> netCDF4.Variable:
+    """Create an empty copy of a variable, with the same storage and attributes.
+
+    With `unpack`, the copy is float32 without packing attributes, and it masks and
+    scales the values written to it.
+    """
+    attrs = dict(var.__dict__)
+    fill_value = attrs.pop("_FillValue", None)
+    datatype = var.datatype
+    if unpack:
+        attrs = {key: value for key, value in attrs.items() if key not in PACKING_ATTRS}
+        datatype, fill_value = np.float32, netCDF4.default_fillvals["f4"]
+    options = _storage_options(var)
+    if "chunksizes" in options:
+        # chunks cannot be larger than a (fixed size) dimension
+        options["chunksizes"] = [
+            (
+                chunk
+                if dst.dimensions[dim].isunlimited()
+                else min(chunk, len(dst.dimensions[dim]))
+            )
+            for chunk, dim in zip(options["chunksizes"], var.dimensions)
+        ]
+    new_var = dst.createVariable(
+        var.name, datatype, var.dimensions, fill_value=fill_value, **options
+    )
+    new_var.setncatts(attrs)
+    new_var.set_auto_maskandscale(unpack)
+    return new_var
+
+
+def _packing(var: netCDF4.Variable) -> Tuple:
+    """Get the data type and packing attributes of a variable, to compare them."""
+    return (np.dtype(var.dtype).str,) + tuple(
+        np.asarray(var.__dict__[attr]).tolist() if attr in var.__dict__ else None
+        for attr in PACKING_ATTRS
+    )
+
+
+def _mixed_packing(chunk_files: Sequence[str], time_dim: str) -> List[str]:
+    """Find the variables along time that are not packed the same way in every file.
+
+    Args:
+        chunk_files (Sequence[str]): The files to compare.
+        time_dim (str): The name of the time dimension.
+
+    Returns:
+        List[str]: The names of the variables whose data type, `scale_factor`,
+            `add_offset`, `_FillValue` or `missing_value` differ between files.
+    """
+    packings = {}
+    for chunk_file in chunk_files:
+        with netCDF4.Dataset(chunk_file) as src:
+            for name, var in src.variables.items():
+                if time_dim in var.dimensions:
+                    packings.setdefault(name, set()).add(_packing(var))
+    return sorted(name for name, packing in packings.items() if len(packing) > 1)
+
+
+def _copy_along_time(
+    var: netCDF4.Variable,
+    new_var: netCDF4.Variable,
+    time_dim: str,
+    offset: int = 0,
+    index: Dict[str, slice] = None,
+) -> None:
+    """Copy the values of a variable, a block of time steps at a time.
+
+    Args:
+        var (netCDF4.Variable): The variable to copy.
+        new_var (netCDF4.Variable): The variable to write to.
+        time_dim (str): The name of the time dimension.
+        offset (int, optional): The time step of `new_var` to start writing at.
+        index (Dict[str, slice], optional): Slices of `var` to copy along other
+            dimensions, by dimension name.
+    """
+    index = index or {}
+    axis = var.dimensions.index(time_dim)
+    n_times = var.shape[axis]
+    for start in range(0, n_times, MERGE_BLOCK):
+        stop = min(start + MERGE_BLOCK, n_times)
+        src_idx = [index.get(dim, slice(None)) for dim in var.dimensions]
+        dst_idx = [slice(None)] * var.ndim
+        src_idx[axis] = slice(start, stop)
+        dst_idx[axis] = slice(offset + start, offset + stop)
+        new_var[tuple(dst_idx)] = var[tuple(src_idx)]
+
+
+def find_time_dim(ds: netCDF4.Dataset, fname: str) -> str:
+    """Find the name of the time dimension of a CDS file.
+
+    Args:
+        ds (netCDF4.Dataset): The open file.
+        fname (str): Its path, for the error message.
+
+    Returns:
+        str: "valid_time" for files from the current CDS, "time" for legacy ones.
+
+    Raises:
+        ValueError: If the file has no time dimension.
+    """
+    for dim in TIME_DIMS:
+        if dim in ds.dimensions:
+            return dim
+    raise ValueError(f"No time dimension in {fname}")
+
+
+def data_variables(ds: netCDF4.Dataset, time_dim: str) -> List[str]:
+    """Find the numeric variables along time and space of a CDS file.
+
+    These are the ERA5 variables themselves, not the coordinates or the `expver`
+    and `number` variables that come with them.
+
+    Args:
+        ds (netCDF4.Dataset): The open file.
+        time_dim (str): The name of its time dimension.
+
+    Returns:
+        List[str]: The variable names.
+    """
+    return [
+        name
+        for name, var in ds.variables.items()
+        if var.dimensions[:1] == (time_dim,)
+        and set(SPACE_DIMS) <= set(var.dimensions)
+        and np.issubdtype(var.dtype, np.number)
+    ]
+
+
+@contextmanager
+def create_netcdf(outfile: str) -> Iterator[netCDF4.Dataset]:
+    """Write a NetCDF4 file under a temporary name, and move it into place when done.
+
+    A failed write leaves no partial file behind under `outfile`.
+
+    Args:
+        outfile (str): Path of the NetCDF4 file.
+
+    Yields:
+        netCDF4.Dataset: The file open for writing.
+    """
+    fd, tmpfile = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(outfile)), suffix=".part"
+    )
+    os.close(fd)
+    try:
+        with netCDF4.Dataset(tmpfile, "w", format="NETCDF4") as dst:
+            yield dst
+        os.replace(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def merge_chunks(chunk_files: Sequence[str], outfile: str) -> None:
+    """Concatenate NetCDF files along time without loading them into memory.
+
+    Variables along time are copied block by block. Other variables, such as the
+    coordinates, are taken from the first file. Values are copied as stored, so
+    packed variables are not unpacked and packed again. The CDS packs each request
+    on its own, though, so a variable whose packing differs between the files is
+    unpacked and written as float32 instead.
+
+    Args:
+        chunk_files (Sequence[str]): The files to merge, in time order.
+        outfile (str): Path to the merged NetCDF4 file.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the files have no time dimension.
+    """
+    with netCDF4.Dataset(chunk_files[0]) as first, create_netcdf(outfile) as dst:
+        first.set_auto_maskandscale(False)
+        time_dim = find_time_dim(first, chunk_files[0])
+        unpacked = _mixed_packing(chunk_files, time_dim)
+        for name in unpacked:
+            print(f"{name} is packed differently across chunks; writing float32")
+        dst.setncatts(first.__dict__)
+        for name, dim in first.dimensions.items():
+            dst.createDimension(name, None if name == time_dim else len(dim))
+        for name, var in first.variables.items():
+            new_var = _create_variable(dst, var, unpack=name in unpacked)
+            if time_dim not in var.dimensions:
+                new_var[...] = var[...]
+
+        offset = 0
+        for chunk_file in chunk_files:
+            with netCDF4.Dataset(chunk_file) as src:
+                src.set_auto_maskandscale(False)
+                for name, var in src.variables.items():
+                    if time_dim in var.dimensions:
+                        var.set_auto_maskandscale(name in unpacked)
+                        _copy_along_time(var, dst[name], time_dim, offset=offset)
+                offset += len(src.dimensions[time_dim])
+
+
+def short_name(variable: str) -> str:
+    """Get the name of an ERA5 variable in the NetCDF files from the CDS.
+
+    Args:
+        variable (str): The variable name used in CDS requests, e.g. "2m_temperature".
+
+    Returns:
+        str: The variable name in the NetCDF file, e.g. "t2m".
+
+    Raises:
+        KeyError: If the variable is not in `SHORT_NAMES`.
+    """
+    try:
+        return SHORT_NAMES[variable]
+    except KeyError:
+        raise KeyError(
+            f"Unknown NetCDF name for {variable}; add it to SHORT_NAMES in {__file__}"
+        ) from None
+
+
+def split_variables(
+    batch_file: str, outputs: Sequence[Tuple[str, Optional[float], str]]
+) -> None:
+    """Split a file with several variables and levels into one file per variable.
+
+    Each output file holds one variable, on one pressure level if given, with the
+    coordinates of the batch file. It is written a block of time steps at a time.
+
+    Args:
+        batch_file (str): A CDS NetCDF file with several variables.
+        outputs (Sequence[Tuple[str, Optional[float], str]]): For each output file,
+            the CDS variable name, the pressure level (None for single levels) and
+            the path to save it to.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If a pressure level is not in the batch file.
+
+    Example:
+        split_variables(
+            "batch_2020.nc",
+            [("u_component_of_wind", 500, "u_500_2020.nc"),
+             ("v_component_of_wind", 500, "v_500_2020.nc")],
+        )
+    """
+    requested = {short_name(variable) for variable, _, _ in outputs}
+    with netCDF4.Dataset(batch_file) as src:
+        src.set_auto_maskandscale(False)
+        time_dim = find_time_dim(src, batch_file)
+        level_dim = next((dim for dim in LEVEL_DIMS if dim in src.dimensions), None)
+
+        for variable, level, outfile in outputs:
+            index = {}
+            if level is not None:
+                levels = src[level_dim][:] if level_dim else np.array([])
+                matches = np.flatnonzero(np.isclose(levels, float(level)))
+                if len(matches) == 0:
+                    raise ValueError(f"Pressure level {level} is not in {batch_file}")
+                index[level_dim] = slice(matches[0], matches[0] + 1)
+
+            with create_netcdf(outfile) as dst:
+                dst.setncatts(src.__dict__)
+                for name, dim in src.dimensions.items():
+                    size = 1 if name in index else len(dim)
+                    dst.createDimension(name, None if name == time_dim else size)
+                # keep the coordinates, but not the other requested variables
+                skip = requested - {short_name(variable)}
+                for name, var in src.variables.items():
+                    if name in skip:
+                        continue
+                    new_var = _create_variable(dst, var)
+                    if time_dim in var.dimensions:
+                        _copy_along_time(var, new_var, time_dim, index=index)
+                    else:
+                        new_var[...] = var[
+                            tuple(index.get(dim, slice(None)) for dim in var.dimensions)
+                        ]
+
+
+def retrieve_chunked(
+    dataset: str,
+    request: Dict,
+    outfile: str,
+    months_per_chunk: int = 1,
+    max_workers: int = 4,
+    client=None,
+) -> None:
+    """Retrieve a CDS request as chunks of a few months, and merge them into one file.
+
+    Finished chunks are kept in the directory `{outfile}.chunks/{hash}` until the
+    merge has succeeded, so that a failed run can be resumed. The hash is of the
+    dataset and the request, so chunks left by a different request are not merged.
+
+    Args:
+        dataset (str): The CDS dataset, e.g. "reanalysis-era5-single-levels".
+        request (Dict): The CDS request for the whole period, with NetCDF output.
+        outfile (str): Path to save the merged data.
+        months_per_chunk (int, optional): Number of months per sub-request.
+        max_workers (int, optional): Number of sub-requests submitted at once.
+        client (optional): A client as for `retrieve`, shared by all workers.
+            Defaults to a new `cdsapi.Client`.
+
+    Returns:
+        None
+
+    Raises:
+        RuntimeError: If some chunks could not be retrieved.
+
+    Example:
+        retrieve_chunked(dataset, request, "2m_temperature_2020.nc", max_workers=6)
+    """
+    if client is None:
+        # imported here so that a fake client does not need cdsapi
+        import cdsapi
+
+        client = cdsapi.Client()
+
+    # name the chunks after the request, so that those of a stale one are not reused
+    content = json.dumps([dataset, request], sort_keys=True).encode()
+    chunk_dir = os.path.join(outfile + ".chunks", hashlib.md5(content).hexdigest()[:8])
+    os.makedirs(chunk_dir, exist_ok=True)
+    chunks = split_request(request, months_per_chunk)
+    chunk_files = [os.path.join(chunk_dir, f"{label}.nc") for label, _ in chunks]
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                _retrieve_chunk, client, dataset, sub_request, target
+            ): target
+            for (_, sub_request), target in zip(chunks, chunk_files)
+            if not os.path.exists(target)
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to retrieve {futures[future]}: {e}", file=sys.stderr)
+                failed.append(futures[future])
+
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(chunks)} chunks of {outfile} failed; "
+            "run again to retry them"
+        )
+
+    with span(
+        "merge", bytes_in=sum(file_size(fname) for fname in chunk_files)
+    ) as merge:
+        merge_chunks(chunk_files, outfile)
+        merge.bytes_out = file_size(outfile)
+    shutil.rmtree(outfile + ".chunks")
@@ -0,0 +1,192 @@
+"""
+This script will download ONE YEAR OF ERA5 HOURLY REANALYSIS DATA for several
+variables in a single CDS request, and split it into one file per variable.
+
+Every CDS request waits in the queue, so one request for all the variables of a year
+is much faster than one request per variable. The output files are the same as those
+of `download_era5_single_level.py` and `download_era5_pressure.py`.
+
+For pressure level data, give one `--pressure` per `--variable`. The request covers
+every combination of the requested variables and levels, and only the requested
+pairs are kept.
+
+The combined download is kept next to the output files until it has been split, so
+that a failed split does not download it again.
+
+Example:
+    python download_era5_batch.py --year 2020 \
+        --variable 2m_temperature --outfile 2m_temperature_2020.nc \
+        --variable total_precipitation --outfile total_precipitation_2020.nc
+
+    python download_era5_batch.py --year 2020 \
+        --variable u_component_of_wind --pressure 500 --outfile u_500_2020.nc \
+        --variable v_component_of_wind --pressure 500 --outfile v_500_2020.nc
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from typing import Optional, Sequence
+
+from cds_download import report_bytes_saved, split_variables
+from download_era5_pressure import download_era5_pressure
+from download_era5_single_level import download_era5_single_level
+from util.instrument import file_size, job, span
+
+
+def download_era5_batch(
+    year: int,
+    variables: Sequence[str],
+    pressure_levels: Sequence[Optional[float]],
+    outfiles: Sequence[str],
+    months_per_chunk: int = 0,
+    max_workers: int = 4,
+    client=None,
+    bbox: Sequence[float] = None,
+    resolution: float = None,
+) -> None:
+    """Download several ERA5 variables of a year in one request, one file each.
+
+    Args:
+        year (int): The year to download data for.
+        variables (Sequence[str]): The ERA5 variable name of each output file.
+        pressure_levels (Sequence[Optional[float]]): The pressure level in hPa of
+            each output file, or None for single level variables.
+        outfiles (Sequence[str]): Path to save each variable.
+        months_per_chunk (int, optional): Split the year into sub-requests of this
+            many months, see `cds_download.retrieve_chunked`.
+        max_workers (int, optional): Number of sub-requests submitted at once.
+        client (optional): The CDS client. Defaults to a new `cdsapi.Client`.
+        bbox (Sequence[float], optional): The `(lon_min, lon_max, lat_min, lat_max)`
+            to crop to on the server. Defaults to the whole globe.
+        resolution (float, optional): The grid spacing in degrees, used with `bbox`.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the arguments differ in length, or mix single and pressure
+            level variables.
+
+    Example:
+        download_era5_batch(
+            2020,
+            ["u_component_of_wind", "v_component_of_wind"],
+            [500, 500],
+            ["u_500_2020.nc", "v_500_2020.nc"],
+        )
+    """
+    if not len(variables) == len(pressure_levels) == len(outfiles):
+        raise ValueError("Give one pressure level and output file per variable")
+    is_pressure = [level is not None for level in pressure_levels]
+    if any(is_pressure) and not all(is_pressure):
+        raise ValueError("Cannot mix single level and pressure level variables")
+
+    unique_variables = sorted(set(variables))
+    unique_levels = sorted(
+        {float(level) for level in pressure_levels if level is not None}
+    )
+
+    # name the combined file after its content, so that a stale one is not reused
+    content = json.dumps(
+        [year, unique_variables, unique_levels, bbox and list(bbox), resolution]
+    ).encode()
+    batch_file = os.path.join(
+        os.path.dirname(os.path.abspath(outfiles[0])),
+        f".batch_{year}_{hashlib.md5(content).hexdigest()[:8]}.nc",
+    )
+
+    if not os.path.exists(batch_file):
+        kwargs = dict(
+            year=year,
+            variable=unique_variables,
+            outfile=batch_file + ".part",
+            months_per_chunk=months_per_chunk,
+            max_workers=max_workers,
+            client=client,
+            bbox=bbox,
+            resolution=resolution,
+        )
+        if unique_levels:
+            download_era5_pressure(pressure_level=unique_levels, **kwargs)
+        else:
+            download_era5_single_level(**kwargs)
+        os.replace(batch_file + ".part", batch_file)
+
+    with span("split", bytes_in=file_size(batch_file)) as split:
+        split_variables(batch_file, list(zip(variables, pressure_levels, outfiles)))
+        split.bytes_out = sum(file_size(outfile) for outfile in outfiles)
+    os.remove(batch_file)
+
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description="Download several ERA5 variables in one request."
+    )
+    parser.add_argument(
+        "--variable",
+        type=str,
+        required=True,
+        action="append",
+        help="ERA5 variable name. Repeat for each variable.",
+    )
+    parser.add_argument(
+        "--pressure",
+        type=float,
+        action="append",
+        help="Pressure level in hPa. Repeat once per --variable.",
+    )
+    parser.add_argument(
+        "-o",
+        "--outfile",
+        type=str,
+        required=True,
+        action="append",
+        help="Output file path. Repeat once per --variable.",
+    )
+    parser.add_argument(
+        "--year", type=int, required=True, help="Year to download data for."
+    )
+    parser.add_argument(
+        "--months-per-chunk",
+        type=int,
+        default=0,
+        help="Retrieve the year as sub-requests of this many months (0: one request).",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of sub-requests at once."
+    )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("LONMIN", "LONMAX", "LATMIN", "LATMAX"),
+        help="Bounding box to crop to on the server.",
+    )
+    parser.add_argument(
+        "--resolution", type=float, help="Grid spacing in degrees, used with --bbox."
+    )
+    args = parser.parse_args()
+
+    pressure_levels = args.pressure or [None] * len(args.variable)
+    if not len(args.variable) == len(pressure_levels) == len(args.outfile):
+        parser.error("give one --outfile (and --pressure) per --variable")
+
+    # Call the function
+    with job("download_era5_batch", year=args.year, variables=args.variable) as j:
+        download_era5_batch(
+            year=args.year,
+            variables=args.variable,
+            pressure_levels=pressure_levels,
+            outfiles=args.outfile,
+            months_per_chunk=args.months_per_chunk,
+            max_workers=args.workers,
+            bbox=args.bbox,
+            resolution=args.resolution,
+        )
+        j.bytes_out = sum(file_size(outfile) for outfile in args.outfile)
+    if args.bbox:
+        for outfile in args.outfile:
+            report_bytes_saved(outfile, args.resolution or 0.25)
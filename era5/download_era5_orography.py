@@ -7,13 +7,22 @@ https://confluence.ecmwf.int/pages/viewpage.action?pageId=228854952
 
 import argparse
 import cdsapi
+from typing import Sequence
 
+from cds_download import crop_request, report_bytes_saved, retrieve
+from util.instrument import file_size, job
 
-def download_era5_orography(outfile: str) -> None:
+
+def download_era5_orography(
+    outfile: str, bbox: Sequence[float] = None, resolution: float = None
+) -> None:
     """Download ERA5 orography data.
 
     Args:
         outfile (str): Path to save the downloaded data.
+        bbox (Sequence[float], optional): The `(lon_min, lon_max, lat_min, lat_max)`
+            to crop to on the server. Defaults to the whole globe.
+        resolution (float, optional): The grid spacing in degrees, used with `bbox`.
 
     Returns:
         None
@@ -32,10 +41,10 @@ def download_era5_orography(outfile: str) -> None:
         "data_format": "netcdf",
         "download_format": "unarchived",
     }
+    if bbox is not None:
+        request.update(crop_request(bbox, resolution))
 
-    c = cdsapi.Client()
-    r = c.retrieve(dataset, request)
-    r.download(outfile)
+    retrieve(cdsapi.Client(), dataset, request, outfile)
 
 
 if __name__ == "__main__":
@@ -44,7 +53,23 @@ if __name__ == "__main__":
     parser.add_argument(
         "-o", "--outfile", type=str, required=True, help="Output file path."
     )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("LONMIN", "LONMAX", "LATMIN", "LATMAX"),
+        help="Bounding box to crop to on the server.",
+    )
+    parser.add_argument(
+        "--resolution", type=float, help="Grid spacing in degrees, used with --bbox."
+    )
     args = parser.parse_args()
 
     # Call the function
-    download_era5_orography(outfile=args.outfile)
+    with job("download_era5_orography") as j:
+        download_era5_orography(
+            outfile=args.outfile, bbox=args.bbox, resolution=args.resolution
+        )
+        j.bytes_out = file_size(args.outfile)
+    if args.bbox:
+        report_bytes_saved(args.outfile, args.resolution or 0.25)
@@ -9,6 +9,9 @@ The variable should follow the ERA5 documentation. Some common ones:
 - temperature
 - u_component_of_wind
 
+With `--months-per-chunk`, the year is retrieved as several smaller requests that
+are submitted concurrently and merged into the same yearly file.
+
 To access the data you will need a password saved in a local file. See CDASAPI
 documentation for details!
 
@@ -21,21 +24,39 @@ cdsapi documentation: https://cds.climate.copernicus.eu/api-how-to
 import argparse
 import cdsapi
 import numpy as np
+from typing import List, Sequence, Union
+
+from cds_download import crop_request, report_bytes_saved, retrieve, retrieve_chunked
+from util.instrument import file_size, job
 
 
 def download_era5_pressure(
     year: int,
-    variable: str,
-    pressure_level: float,
+    variable: Union[str, List[str]],
+    pressure_level: Union[float, List[float]],
     outfile: str,
+    months_per_chunk: int = 0,
+    max_workers: int = 4,
+    client=None,
+    bbox: Sequence[float] = None,
+    resolution: float = None,
 ) -> None:
     """Download pressure level ERA5 data for a given year, variable, and pressure level.
 
     Args:
         year (int): The year to download data for.
-        variable (str): The ERA5 variable name.
-        pressure_level (float): The pressure level in hPa.
+        variable (Union[str, List[str]]): The ERA5 variable name, or several names.
+        pressure_level (Union[float, List[float]]): The pressure level in hPa, or
+            several levels.
         outfile (str): Path to save the downloaded data.
+        months_per_chunk (int, optional): Split the year into sub-requests of this
+            many months, see `cds_download.retrieve_chunked`. With 0 (default), the
+            year is retrieved in one request.
+        max_workers (int, optional): Number of sub-requests submitted at once.
+        client (optional): The CDS client. Defaults to a new `cdsapi.Client`.
+        bbox (Sequence[float], optional): The `(lon_min, lon_max, lat_min, lat_max)`
+            to crop to on the server. Defaults to the whole globe.
+        resolution (float, optional): The grid spacing in degrees, used with `bbox`.
 
     Returns:
         None
@@ -51,7 +72,7 @@ def download_era5_pressure(
     request = {
         "product_type": ["reanalysis"],
         "variable": variable,
-        "pressure_level": [pressure_level],
+        "pressure_level": np.atleast_1d(pressure_level).tolist(),
         "year": [year],
         "month": months,
         "day": days,
@@ -59,12 +80,20 @@ def download_era5_pressure(
         "data_format": "netcdf",
         "download_format": "unarchived",
     }
-
-    print(request)
-
-    c = cdsapi.Client()
-    r = c.retrieve(dataset, request)
-    r.download(outfile)
+    if bbox is not None:
+        request.update(crop_request(bbox, resolution))
+
+    if months_per_chunk:
+        retrieve_chunked(
+            dataset,
+            request,
+            outfile,
+            months_per_chunk=months_per_chunk,
+            max_workers=max_workers,
+            client=client,
+        )
+    else:
+        retrieve(client or cdsapi.Client(), dataset, request, outfile)
 
 
 if __name__ == "__main__":
@@ -82,12 +111,44 @@ if __name__ == "__main__":
     parser.add_argument(
         "--year", type=int, required=True, help="Year to download data for."
     )
+    parser.add_argument(
+        "--months-per-chunk",
+        type=int,
+        default=0,
+        help="Retrieve the year as sub-requests of this many months (0: one request).",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of sub-requests at once."
+    )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("LONMIN", "LONMAX", "LATMIN", "LATMAX"),
+        help="Bounding box to crop to on the server.",
+    )
+    parser.add_argument(
+        "--resolution", type=float, help="Grid spacing in degrees, used with --bbox."
+    )
     args = parser.parse_args()
 
     # Call the function
-    download_era5_pressure(
+    with job(
+        "download_era5_pressure",
         year=args.year,
         variable=args.variable,
         pressure_level=args.pressure_level,
-        outfile=args.outfile,
-    )
+    ) as j:
+        download_era5_pressure(
+            year=args.year,
+            variable=args.variable,
+            pressure_level=args.pressure_level,
+            outfile=args.outfile,
+            months_per_chunk=args.months_per_chunk,
+            max_workers=args.workers,
+            bbox=args.bbox,
+            resolution=args.resolution,
+        )
+        j.bytes_out = file_size(args.outfile)
+    if args.bbox:
+        report_bytes_saved(args.outfile, args.resolution or 0.25)
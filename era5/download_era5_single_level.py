@@ -9,6 +9,9 @@ The variable should follow the ERA5 documentation. Some common ones:
 - 2m_temperature
 - u_component_of_wind
 
+With `--months-per-chunk`, the year is retrieved as several smaller requests that
+are submitted concurrently and merged into the same yearly file.
+
 To access the data you will need a password saved in a local file. See CDASAPI
 documentation for details!
 
@@ -21,19 +24,36 @@ cdsapi documentation: https://cds.climate.copernicus.eu/api-how-to
 import argparse
 import cdsapi
 import numpy as np
+from typing import List, Sequence, Union
+
+from cds_download import crop_request, report_bytes_saved, retrieve, retrieve_chunked
+from util.instrument import file_size, job
 
 
 def download_era5_single_level(
     year: int,
-    variable: str,
+    variable: Union[str, List[str]],
     outfile: str,
+    months_per_chunk: int = 0,
+    max_workers: int = 4,
+    client=None,
+    bbox: Sequence[float] = None,
+    resolution: float = None,
 ) -> None:
     """Download a single level of ERA5 data for a given year and variable.
 
     Args:
         year (int): The year to download data for.
-        variable (str): The ERA5 variable name.
+        variable (Union[str, List[str]]): The ERA5 variable name, or several names.
         outfile (str): Path to save the downloaded data.
+        months_per_chunk (int, optional): Split the year into sub-requests of this
+            many months, see `cds_download.retrieve_chunked`. With 0 (default), the
+            year is retrieved in one request.
+        max_workers (int, optional): Number of sub-requests submitted at once.
+        client (optional): The CDS client. Defaults to a new `cdsapi.Client`.
+        bbox (Sequence[float], optional): The `(lon_min, lon_max, lat_min, lat_max)`
+            to crop to on the server. Defaults to the whole globe.
+        resolution (float, optional): The grid spacing in degrees, used with `bbox`.
 
     Returns:
         None
@@ -57,10 +77,20 @@ def download_era5_single_level(
         "data_format": "netcdf",
         "download_format": "unarchived",
     }
-
-    c = cdsapi.Client()
-    r = c.retrieve(dataset, request)
-    r.download(outfile)
+    if bbox is not None:
+        request.update(crop_request(bbox, resolution))
+
+    if months_per_chunk:
+        retrieve_chunked(
+            dataset,
+            request,
+            outfile,
+            months_per_chunk=months_per_chunk,
+            max_workers=max_workers,
+            client=client,
+        )
+    else:
+        retrieve(client or cdsapi.Client(), dataset, request, outfile)
 
 
 if __name__ == "__main__":
@@ -75,11 +105,38 @@ if __name__ == "__main__":
     parser.add_argument(
         "--year", type=int, required=True, help="Year to download data for."
     )
+    parser.add_argument(
+        "--months-per-chunk",
+        type=int,
+        default=0,
+        help="Retrieve the year as sub-requests of this many months (0: one request).",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of sub-requests at once."
+    )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("LONMIN", "LONMAX", "LATMIN", "LATMAX"),
+        help="Bounding box to crop to on the server.",
+    )
+    parser.add_argument(
+        "--resolution", type=float, help="Grid spacing in degrees, used with --bbox."
+    )
     args = parser.parse_args()
 
     # Call the function
-    download_era5_single_level(
-        year=args.year,
-        variable=args.variable,
-        outfile=args.outfile,
-    )
+    with job("download_era5_single_level", year=args.year, variable=args.variable) as j:
+        download_era5_single_level(
+            year=args.year,
+            variable=args.variable,
+            outfile=args.outfile,
+            months_per_chunk=args.months_per_chunk,
+            max_workers=args.workers,
+            bbox=args.bbox,
+            resolution=args.resolution,
+        )
+        j.bytes_out = file_size(args.outfile)
+    if args.bbox:
+        report_bytes_saved(args.outfile, args.resolution or 0.25)
@@ -10,6 +10,25 @@ configfile: os.path.join(ERA5_SRC_DIR, "era5_config.yml")
 
 era5_env = os.path.join(ERA5_SRC_DIR, "era5_env.yml")
 
+# Each yearly download is split into sub-requests of a few months, see cds_download.py
+era5_chunk_args = (
+    f"--months-per-chunk {config['era5']['months_per_request']} "
+    f"--workers {config['era5']['request_workers']}"
+)
+
+# Each bounding box in the config is cropped on the server,
+# and its files are stored in a directory named after it
+era5_bboxes = {bbox["name"]: bbox for bbox in config["bbox"]}
+
+
+def era5_bbox_args(wildcards):
+    """Command line arguments that crop a download to a bounding box."""
+    bbox = era5_bboxes[wildcards.bbox_name]
+    return (
+        f"--bbox {bbox['lon_min']} {bbox['lon_max']} {bbox['lat_min']} {bbox['lat_max']} "
+        f"--resolution {bbox['resolution']}"
+    )
+
 
 # Rule: Download ERA5 elevation data.
 # This rule downloads the orography data and saves it as a NetCDF file.
@@ -17,13 +36,17 @@ rule era5_elevation:
     input:
         os.path.join(ERA5_SRC_DIR, "download_era5_orography.py"),
     output:
-        os.path.join(ERA5_DATA_DIR, "single_level", "elevation.nc"),
+        os.path.join(ERA5_DATA_DIR, "{bbox_name}", "single_level", "elevation.nc"),
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
     log:
-        os.path.join(LOGS, "era5_elevation.log"),
+        os.path.join(LOGS, "era5_elevation", "{bbox_name}.log"),
+    params:
+        bbox_args=era5_bbox_args,
     conda:
         era5_env
     shell:
-        "python {input} --outfile {output}"
+        "python {input} --outfile {output} {params.bbox_args}"
 
 
 # Rule: Download ERA5 pressure level data.
@@ -32,13 +55,25 @@ rule era5_pressure:
     input:
         os.path.join(ERA5_SRC_DIR, "download_era5_pressure.py"),
     output:
-        os.path.join(ERA5_DATA_DIR, "pressure_level", "{variable}_{pressure}_{year}.nc"),
+        os.path.join(
+            ERA5_DATA_DIR,
+            "{bbox_name}",
+            "pressure_level",
+            "{variable}_{pressure}_{year}.nc",
+        ),
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
     log:
-        os.path.join(LOGS, "era5_pressure", "{variable}_{pressure}_{year}.log"),
+        os.path.join(
+            LOGS, "era5_pressure", "{bbox_name}", "{variable}_{pressure}_{year}.log"
+        ),
+    params:
+        chunk_args=era5_chunk_args,
+        bbox_args=era5_bbox_args,
     conda:
         era5_env
     shell:
-        "python {input} --outfile {output} --variable {wildcards.variable} --pressure {wildcards.pressure} --year {wildcards.year}"
+        "python {input} --outfile {output} --variable {wildcards.variable} --pressure {wildcards.pressure} --year {wildcards.year} {params.chunk_args} {params.bbox_args}"
 
 
 # Rule: Download ERA5 single level data.
@@ -47,13 +82,231 @@ rule era5_single_level:
     input:
         os.path.join(ERA5_SRC_DIR, "download_era5_single_level.py"),
     output:
-        os.path.join(ERA5_DATA_DIR, "single_level", "{variable}_{year}.nc"),
+        os.path.join(
+            ERA5_DATA_DIR, "{bbox_name}", "single_level", "{variable}_{year}.nc"
+        ),
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
     log:
-        os.path.join(LOGS, "era5_single_level", "{variable}_{year}.log"),
+        os.path.join(LOGS, "era5_single_level", "{bbox_name}", "{variable}_{year}.log"),
+    params:
+        chunk_args=era5_chunk_args,
+        bbox_args=era5_bbox_args,
     conda:
         era5_env
     shell:
-        "python {input} --outfile {output} --variable {wildcards.variable} --year {wildcards.year}"
+        "python {input} --outfile {output} --variable {wildcards.variable} --year {wildcards.year} {params.chunk_args} {params.bbox_args}"
+
+
+# Rule: Download all single level variables of a year in one CDS request.
+# The download is split into the same files as `era5_single_level` makes.
+rule era5_single_level_batch:
+    input:
+        os.path.join(ERA5_SRC_DIR, "download_era5_batch.py"),
+    output:
+        [
+            os.path.join(
+                ERA5_DATA_DIR, "{bbox_name}", "single_level", f"{var}_{{year}}.nc"
+            )
+            for var in config["era5"]["vars"]["single_level"]
+        ],
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
+        year=r"\d{4}",
+    log:
+        os.path.join(LOGS, "era5_single_level_batch", "{bbox_name}", "{year}.log"),
+    params:
+        split_args=lambda wildcards, output: " ".join(
+            f"--variable {var} --outfile {outfile}"
+            for var, outfile in zip(config["era5"]["vars"]["single_level"], output)
+        ),
+        chunk_args=era5_chunk_args,
+        bbox_args=era5_bbox_args,
+    conda:
+        era5_env
+    shell:
+        "python {input} --year {wildcards.year} {params.split_args} {params.chunk_args} {params.bbox_args}"
+
+
+# All (variable, level) pairs on pressure levels
+era5_pressure_pairs = [
+    (var["name"], level)
+    for var in config["era5"]["vars"]["pressure_level"]
+    for level in var["levels"]
+]
+
+
+# Rule: Download all pressure level variables and levels of a year in one CDS request.
+# The download is split into the same files as `era5_pressure` makes.
+rule era5_pressure_batch:
+    input:
+        os.path.join(ERA5_SRC_DIR, "download_era5_batch.py"),
+    output:
+        [
+            os.path.join(
+                ERA5_DATA_DIR,
+                "{bbox_name}",
+                "pressure_level",
+                f"{var}_{level}_{{year}}.nc",
+            )
+            for var, level in era5_pressure_pairs
+        ],
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
+        year=r"\d{4}",
+    log:
+        os.path.join(LOGS, "era5_pressure_batch", "{bbox_name}", "{year}.log"),
+    params:
+        split_args=lambda wildcards, output: " ".join(
+            f"--variable {var} --pressure {level} --outfile {outfile}"
+            for (var, level), outfile in zip(era5_pressure_pairs, output)
+        ),
+        chunk_args=era5_chunk_args,
+        bbox_args=era5_bbox_args,
+    conda:
+        era5_env
+    shell:
+        "python {input} --year {wildcards.year} {params.split_args} {params.chunk_args} {params.bbox_args}"
+
+
+# Use one request per year for all variables, or one request per variable and year
+if config["era5"]["batch_requests"]:
+
+    ruleorder: era5_single_level_batch > era5_single_level
+    ruleorder: era5_pressure_batch > era5_pressure
+
+else:
+
+    ruleorder: era5_single_level > era5_single_level_batch
+    ruleorder: era5_pressure > era5_pressure_batch
+
+
+# Rule: Rechunk the yearly files of a variable into one Zarr store for time series.
+# Years that are not yet in the store are appended, the others are left as they are.
+rule era5_timeseries:
+    input:
+        script=os.path.join(ERA5_SRC_DIR, "rechunk_era5.py"),
+        yearly_files=lambda wildcards: [
+            os.path.join(
+                ERA5_DATA_DIR,
+                wildcards.bbox_name,
+                wildcards.level_type,
+                f"{wildcards.name}_{year}.nc",
+            )
+            for year in era5_years
+        ],
+    output:
+        touch(
+            os.path.join(
+                ERA5_DATA_DIR, "{bbox_name}", "{level_type}", "{name}.zarr.done"
+            )
+        ),
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
+        level_type="single_level|pressure_level",
+    log:
+        os.path.join(
+            LOGS, "era5_timeseries", "{bbox_name}", "{level_type}", "{name}.log"
+        ),
+    params:
+        store=lambda wildcards: os.path.join(
+            ERA5_DATA_DIR,
+            wildcards.bbox_name,
+            wildcards.level_type,
+            f"{wildcards.name}.zarr",
+        ),
+        rechunk_args=(
+            f"--time-chunk {config['era5']['timeseries']['time_chunk']} "
+            f"--space-chunk {config['era5']['timeseries']['space_chunk']} "
+            f"--max-memory {config['era5']['timeseries']['max_memory_mb']}"
+        ),
+    conda:
+        era5_env
+    shell:
+        "python {input.script} --store {params.store} {input.yearly_files} {params.rechunk_args}"
+
+
+# Rule: Compute the hourly magnitude of the integrated vapour transport of a year.
+# It is stored like a downloaded variable, so that it can be aggregated as well.
+rule era5_ivt:
+    input:
+        script=os.path.join(ERA5_SRC_DIR, "aggregate_era5.py"),
+        eastward=os.path.join(
+            ERA5_DATA_DIR,
+            "{bbox_name}",
+            "single_level",
+            "vertical_integral_of_eastward_water_vapour_flux_{year}.nc",
+        ),
+        northward=os.path.join(
+            ERA5_DATA_DIR,
+            "{bbox_name}",
+            "single_level",
+            "vertical_integral_of_northward_water_vapour_flux_{year}.nc",
+        ),
+    output:
+        os.path.join(
+            ERA5_DATA_DIR,
+            "{bbox_name}",
+            "derived",
+            "integrated_vapour_transport_{year}.nc",
+        ),
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
+        year=r"\d{4}",
+    log:
+        os.path.join(LOGS, "era5_ivt", "{bbox_name}", "{year}.log"),
+    params:
+        max_memory=config["era5"]["derived"]["max_memory_mb"],
+    conda:
+        era5_env
+    shell:
+        "python {input.script} --max-memory {params.max_memory} ivt --eastward {input.eastward} --northward {input.northward} --outfile {output}"
+
+
+def era5_hourly_file(wildcards):
+    """The hourly file of a variable, downloaded or derived, for one box and year."""
+    if wildcards.name == "integrated_vapour_transport":
+        level_type = "derived"
+    elif wildcards.name in config["era5"]["vars"]["single_level"]:
+        level_type = "single_level"
+    else:
+        level_type = "pressure_level"
+    return os.path.join(
+        ERA5_DATA_DIR,
+        wildcards.bbox_name,
+        level_type,
+        f"{wildcards.name}_{wildcards.year}.nc",
+    )
+
+
+# Rule: Aggregate the hourly data of a variable and year to days or months.
+# The statistics are set in era5_config.yml, see aggregate_era5.py
+rule era5_resample:
+    input:
+        script=os.path.join(ERA5_SRC_DIR, "aggregate_era5.py"),
+        hourly=era5_hourly_file,
+    output:
+        os.path.join(
+            ERA5_DATA_DIR, "{bbox_name}", "derived", "{name}_{frequency}_{year}.nc"
+        ),
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
+        frequency="daily|monthly",
+        year=r"\d{4}",
+    log:
+        os.path.join(
+            LOGS, "era5_resample", "{bbox_name}", "{name}_{frequency}_{year}.log"
+        ),
+    params:
+        max_memory=config["era5"]["derived"]["max_memory_mb"],
+        statistic_args=" ".join(
+            f"--statistic {statistic}"
+            for statistic in config["era5"]["derived"]["statistics"]
+        ),
+    conda:
+        era5_env
+    shell:
+        "python {input.script} --max-memory {params.max_memory} resample --infile {input.hourly} --outfile {output} --frequency {wildcards.frequency} {params.statistic_args}"
 
 
 # Get all the ERA5 data
@@ -64,31 +317,65 @@ pressure_files = []
 single_level_files = []
 
 # Add pressure level files
-for year in era5_years:
-    for var in config["era5"]["vars"]["pressure_level"]:
-        varname = var["name"]
-        levels = var["levels"]
-        for level in levels:
+for bbox_name in era5_bboxes:
+    for year in era5_years:
+        for varname, level in era5_pressure_pairs:
             pressure_files.append(
                 os.path.join(
-                    ERA5_DATA_DIR, "pressure_level", f"{varname}_{level}_{year}.nc"
+                    ERA5_DATA_DIR,
+                    bbox_name,
+                    "pressure_level",
+                    f"{varname}_{level}_{year}.nc",
                 )
             )
 
 # Add single level files
-for year in era5_years:
-    for var in config["era5"]["vars"]["single_level"]:
-        single_level_files.append(
-            os.path.join(ERA5_DATA_DIR, "single_level", f"{var}_{year}.nc")
-        )
+for bbox_name in era5_bboxes:
+    for year in era5_years:
+        for var in config["era5"]["vars"]["single_level"]:
+            single_level_files.append(
+                os.path.join(
+                    ERA5_DATA_DIR, bbox_name, "single_level", f"{var}_{year}.nc"
+                )
+            )
 
 # Explicitly list the files to download
-elevation_file = [os.path.join(ERA5_DATA_DIR, "single_level", "elevation.nc")]
+elevation_file = [
+    os.path.join(ERA5_DATA_DIR, bbox_name, "single_level", "elevation.nc")
+    for bbox_name in era5_bboxes
+]
 all_era5_files = elevation_file + pressure_files + single_level_files
 
+# Daily and monthly aggregates, for each bounding box and year
+all_era5_derived_files = [
+    os.path.join(ERA5_DATA_DIR, bbox_name, "derived", f"{name}_{frequency}_{year}.nc")
+    for bbox_name in era5_bboxes
+    for name in config["era5"]["derived"]["variables"]
+    for frequency in config["era5"]["derived"]["frequencies"]
+    for year in era5_years
+]
+
+# One time series store for each variable (and pressure level) of each bounding box
+all_era5_timeseries_files = [
+    os.path.join(ERA5_DATA_DIR, bbox_name, level_type, f"{name}.zarr.done")
+    for bbox_name in era5_bboxes
+    for level_type, names in [
+        ("single_level", config["era5"]["vars"]["single_level"]),
+        ("pressure_level", [f"{var}_{level}" for var, level in era5_pressure_pairs]),
+    ]
+    for name in names
+]
+
 
 # The rule to download all the ERA5 data.
 # This combines elevation, pressure level, and single level data downloads.
 rule ERA5:
     input:
         all_era5_files[1],  # List of all files to be downloaded
+        all_era5_derived_files,  # Daily and monthly aggregates
+
+
+# Rechunk all the ERA5 data into time series stores
+rule ERA5_timeseries:
+    input:
+        all_era5_timeseries_files,
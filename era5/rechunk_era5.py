@@ -0,0 +1,375 @@
+"""
+Rechunk the yearly ERA5 files of one variable into one Zarr store for time series.
+
+The yearly `{variable}_{year}.nc` files from the CDS store one time step per chunk,
+which suits maps, but a time series at a point then reads every chunk of every year.
+This script copies the years into one store whose chunks span many hours but only a
+small area, so that a long time series at a point or over a small region only reads
+a few chunks.
+
+Each year is copied in two passes, like rechunker, so that no more than
+`--max-memory` MB of data are held at once:
+
+1. the year is read in blocks of whole time steps, which is how the NetCDF file is
+   chunked, and written to an intermediate store with small spatial chunks;
+2. each spatial tile is read back from the intermediate store, which only touches
+   that tile, and written to the store one time chunk at a time.
+
+Running the script again only adds the years that are not yet in the store, so a new
+year is appended without rewriting the others. Years that fall before the end of the
+store cannot be inserted and are reported; use `--rebuild` to start over.
+
+The data type, packing (`scale_factor`, `add_offset`) and fill value of the store are
+those of the first year. The CDS packs each request on its own, so a later year that
+is stored differently is unpacked and packed again like the store, rather than
+copied as stored.
+
+Example:
+    python rechunk_era5.py --store /data/ERA5/CONUS/single_level/2m_temperature.zarr \
+        /data/ERA5/CONUS/single_level/2m_temperature_*.nc
+"""
+
+import argparse
+import itertools
+import os
+import re
+import shutil
+import sys
+import warnings
+from typing import Dict, Iterator, Sequence, Tuple
+
+import netCDF4
+import numpy as np
+import zarr
+
+from cds_download import SPACE_DIMS, data_variables, find_time_dim
+
+# the yearly files are named like `2m_temperature_2020.nc`
+YEAR_PATTERN = re.compile(r"_(\d{4})\.nc$")
+
+
+def list_yearly_files(fnames: Sequence[str]) -> Dict[int, str]:
+    """Find the year of each yearly ERA5 file.
+
+    Args:
+        fnames (Sequence[str]): Files named like `{variable}_{year}.nc`.
+
+    Returns:
+        Dict[int, str]: The file paths by year, sorted by year.
+
+    Raises:
+        ValueError: If a file name does not end with a year.
+    """
+    years = {}
+    for fname in fnames:
+        match = YEAR_PATTERN.search(fname)
+        if not match:
+            raise ValueError(f"Cannot find the year in {fname}")
+        years[int(match.group(1))] = fname
+    return dict(sorted(years.items()))
+
+
+def _attrs(var) -> Dict:
+    """Get the attributes of a NetCDF variable or dataset as JSON-friendly values."""
+    return {
+        key: value.tolist() if hasattr(value, "tolist") else value
+        for key, value in var.__dict__.items()
+        if key != "_FillValue"
+    }
+
+
+def _chunks(
+    dims: Sequence[str], shape: Sequence[int], time_chunk: int, space_chunk: int
+) -> Tuple[int, ...]:
+    """Chunk sizes along each dimension, with time first."""
+    return (time_chunk,) + tuple(
+        min(space_chunk, size) if dim in SPACE_DIMS else size
+        for dim, size in zip(dims[1:], shape[1:])
+    )
+
+
+def _tiles(shape: Sequence[int], chunks: Sequence[int]) -> Iterator[Tuple[slice, ...]]:
+    """Iterate over the chunks of an array that has no time dimension."""
+    ranges = [
+        [slice(start, min(start + chunk, size)) for start in range(0, size, chunk)]
+        for size, chunk in zip(shape, chunks)
+    ]
+    return itertools.product(*ranges)
+
+
+def _time_blocks(offset: int, n_times: int, time_chunk: int) -> Iterator[slice]:
+    """Split the time steps `offset` to `offset + n_times` at the chunk boundaries."""
+    start = offset
+    while start < offset + n_times:
+        stop = min((start // time_chunk + 1) * time_chunk, offset + n_times)
+        yield slice(start, stop)
+        start = stop
+
+
+def _same_value(a, b) -> bool:
+    """Compare two attribute values, where NaN equals NaN."""
+    a = a.tolist() if hasattr(a, "tolist") else a
+    b = b.tolist() if hasattr(b, "tolist") else b
+    return a == b or (a != a and b != b)
+
+
+def _same_packing(var: netCDF4.Variable, target: zarr.Array) -> bool:
+    """Check whether a variable of a yearly file is stored like the array of the store."""
+    attrs = _attrs(var)
+    fill_value = var.__dict__.get("_FillValue")
+    return (
+        np.dtype(var.dtype) == target.dtype
+        and _same_value(attrs.get("scale_factor"), target.attrs.get("scale_factor"))
+        and _same_value(attrs.get("add_offset"), target.attrs.get("add_offset"))
+        and (fill_value is None or _same_value(fill_value, target.fill_value))
+    )
+
+
+def _repack(
+    values: np.ndarray, var: netCDF4.Variable, target: zarr.Array
+) -> np.ndarray:
+    """Convert values of a yearly file, as stored, to how the store stores them.
+
+    Args:
+        values (np.ndarray): Values of `var` as stored, without masking or scaling.
+        var (netCDF4.Variable): The variable of the yearly file.
+        target (zarr.Array): The array of the store.
+
+    Returns:
+        np.ndarray: The values in the data type, packing and fill value of `target`.
+
+    Raises:
+        ValueError: If a value does not fit in the integer data type of the store.
+    """
+    attrs = var.__dict__
+    data = values.astype(np.float64)
+    missing = np.isnan(data)
+    for key in ("_FillValue", "missing_value"):
+        if key in attrs:
+            missing |= np.isin(values, np.atleast_1d(attrs[key]))
+    data = data * attrs.get("scale_factor", 1.0) + attrs.get("add_offset", 0.0)
+
+    if np.issubdtype(target.dtype, np.integer):
+        data = np.round(
+            (data - target.attrs.get("add_offset", 0.0))
+            / target.attrs.get("scale_factor", 1.0)
+        )
+        info = np.iinfo(target.dtype)
+        valid = data[~missing]
+        if valid.size and (valid.min() < info.min or valid.max() > info.max):
+            raise ValueError(
+                f"Values of {var.name} do not fit in the {target.dtype} packing of "
+                "the store; use --rebuild"
+            )
+    data[missing] = target.fill_value
+    return data.astype(target.dtype)
+
+
+def _create_store(
+    store: str, fname: str, time_chunk: int, space_chunk: int, max_bytes: int
+) -> zarr.Group:
+    """Create an empty store with the variables and coordinates of a yearly file."""
+    with netCDF4.Dataset(fname) as src:
+        src.set_auto_maskandscale(False)
+        time_dim = find_time_dim(src, fname)
+        names = data_variables(src, time_dim)
+        for name in names:
+            var = src[name]
+            chunks = _chunks(var.dimensions, var.shape, time_chunk, space_chunk)
+            if np.prod(chunks) * var.dtype.itemsize > max_bytes:
+                raise ValueError(
+                    f"A chunk of {chunks} values of {name} does not fit in "
+                    f"{max_bytes / 2**20:.0f} MB; use smaller chunks"
+                )
+
+        root = zarr.open_group(store, mode="w")
+        root.attrs.update(_attrs(src))
+        root.attrs.update({"years": [], "n_times": 0, "time_dim": time_dim})
+        for name in names:
+            var = src[name]
+            root.create_array(
+                name,
+                shape=(0,) + var.shape[1:],
+                chunks=_chunks(var.dimensions, var.shape, time_chunk, space_chunk),
+                dtype=var.dtype,
+                fill_value=var.__dict__.get("_FillValue"),
+                dimension_names=var.dimensions,
+                attributes=_attrs(var),
+            )
+        # the time coordinate grows with the data, the others are copied now
+        for name in src.dimensions:
+            if name not in src.variables:
+                continue
+            var = src[name]
+            size = 0 if name == time_dim else len(var)
+            coord = root.create_array(
+                name,
+                shape=(size,),
+                chunks=(time_chunk if name == time_dim else max(size, 1),),
+                dtype=var.dtype,
+                dimension_names=(name,),
+                attributes=_attrs(var),
+            )
+            if size:
+                coord[:] = var[:]
+    return root
+
+
+def _append_year(
+    root: zarr.Group, store: str, fname: str, space_chunk: int, max_bytes: int
+) -> None:
+    """Copy one yearly file to the end of the store, in two passes."""
+    time_dim = root.attrs["time_dim"]
+    offset = root.attrs["n_times"]
+    tmp_store = store + ".tmp"
+    with netCDF4.Dataset(fname) as src:
+        src.set_auto_maskandscale(False)
+        n_times = len(src.dimensions[time_dim])
+
+        # drop the time steps of a year that was not finished, then make room
+        coord = root[time_dim]
+        coord.resize((offset + n_times,))
+        coord[offset:] = src[time_dim][:]
+
+        tmp = zarr.open_group(tmp_store, mode="w")
+        for name in data_variables(src, time_dim):
+            var = src[name]
+            target = root[name]
+            target.resize((offset + n_times,) + target.shape[1:])
+            repack = not _same_packing(var, target)
+            if repack:
+                print(f"{name} in {fname} is packed differently; repacking it")
+
+            # Pass 1: read whole time steps, write small spatial chunks
+            itemsize = 8 if repack else var.dtype.itemsize
+            step_bytes = itemsize * int(np.prod(var.shape[1:]))
+            n_steps = int(min(n_times, max(1, max_bytes // step_bytes)))
+            inter = tmp.create_array(
+                name,
+                shape=var.shape,
+                chunks=_chunks(var.dimensions, var.shape, n_steps, space_chunk),
+                dtype=target.dtype,
+            )
+            for start in range(0, n_times, n_steps):
+                values = var[start : start + n_steps]
+                if repack:
+                    values = _repack(values, var, target)
+                inter[start : start + n_steps] = values
+
+            # Pass 2: read one tile at a time, write whole target chunks
+            time_chunk = target.chunks[0]
+            for tile in _tiles(target.shape[1:], target.chunks[1:]):
+                for block in _time_blocks(offset, n_times, time_chunk):
+                    src_block = slice(block.start - offset, block.stop - offset)
+                    target[(block,) + tile] = inter[(src_block,) + tile]
+    shutil.rmtree(tmp_store)
+
+
+def rechunk_to_store(
+    fnames: Sequence[str],
+    store: str,
+    time_chunk: int = 8760,
+    space_chunk: int = 10,
+    max_memory: float = 1024,
+    rebuild: bool = False,
+) -> None:
+    """Add yearly ERA5 files of one variable to a store chunked for time series.
+
+    Args:
+        fnames (Sequence[str]): The yearly files, named like `{variable}_{year}.nc`.
+        store (str): Path to the Zarr store, which is created if needed.
+        time_chunk (int, optional): Number of hours per chunk. Only used when the
+            store is created.
+        space_chunk (int, optional): Number of grid cells per chunk along latitude
+            and longitude. Only used when the store is created.
+        max_memory (float, optional): Memory budget in MB for the data held at once.
+        rebuild (bool, optional): Delete the store and create it again.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If a chunk does not fit in the memory budget, or if the values
+            of a year do not fit in the packing of the store.
+
+    Example:
+        rechunk_to_store(
+            ["t2m_2019.nc", "t2m_2020.nc"], "t2m.zarr", time_chunk=8760, space_chunk=10
+        )
+    """
+    if rebuild and os.path.exists(store):
+        shutil.rmtree(store)
+
+    files = list_yearly_files(fnames)
+    if not files:
+        return
+    max_bytes = int(max_memory * 2**20)
+
+    if os.path.exists(store):
+        root = zarr.open_group(store, mode="r+")
+    else:
+        first = next(iter(files.values()))
+        root = _create_store(store, first, time_chunk, space_chunk, max_bytes)
+
+    stored = list(root.attrs["years"])
+    last = stored[-1] if stored else None
+    in_gap = [year for year in files if year not in stored and last and year < last]
+    if in_gap:
+        print(
+            f"{len(in_gap)} years fall before the end of {store} and were not added, "
+            f"starting with {in_gap[0]}; use --rebuild to add them",
+            file=sys.stderr,
+        )
+
+    for year, fname in files.items():
+        if year in stored or year in in_gap:
+            continue
+        _append_year(root, store, fname, space_chunk, max_bytes)
+        # only count the year once all of it is written
+        stored.append(year)
+        root.attrs.update(
+            {"years": stored, "n_times": root[root.attrs["time_dim"]].shape[0]}
+        )
+        with warnings.catch_warnings():
+            # consolidated metadata is not part of the Zarr 3 spec, but xarray reads it
+            warnings.simplefilter("ignore", UserWarning)
+            zarr.consolidate_metadata(store)
+        print(f"Added {year} to {store}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rechunk yearly ERA5 files into one Zarr store for time series."
+    )
+    parser.add_argument("--store", required=True, help="Path to the Zarr store.")
+    parser.add_argument(
+        "files", nargs="+", help="Yearly NetCDF files named like {variable}_{year}.nc."
+    )
+    parser.add_argument(
+        "--time-chunk", type=int, default=8760, help="Number of hours per chunk."
+    )
+    parser.add_argument(
+        "--space-chunk",
+        type=int,
+        default=10,
+        help="Number of grid cells per chunk along latitude and longitude.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=1024,
+        help="Memory budget in MB for the data held at once.",
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Delete the store and start over."
+    )
+    args = parser.parse_args()
+
+    rechunk_to_store(
+        fnames=args.files,
+        store=args.store,
+        time_chunk=args.time_chunk,
+        space_chunk=args.space_chunk,
+        max_memory=args.max_memory,
+        rebuild=args.rebuild,
+    )
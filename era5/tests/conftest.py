@@ -0,0 +1,9 @@
+"""
+The ERA5 scripts import each other as top-level modules, as when they are run from
+`era5/`, so that directory is put on the path for the tests.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
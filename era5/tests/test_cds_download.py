@@ -0,0 +1,162 @@
+"""
+Tests of `cds_download.retrieve_chunked` with a local stand-in for the CDS.
+
+The fake client writes a small NetCDF file for each request, with a few time steps
+per month, so that the split into chunks and their merge can be checked without a
+CDS account. Run from the repository root:
+
+    python -m pytest era5/tests
+"""
+
+import os
+
+import netCDF4
+import numpy as np
+import pytest
+
+from cds_download import retrieve_chunked
+
+DATASET = "reanalysis-era5-single-levels"
+
+REQUEST = {
+    "product_type": "reanalysis",
+    "variable": ["2m_temperature"],
+    "year": ["2020"],
+    "month": ["01", "02", "03", "04", "05"],
+    "data_format": "netcdf",
+}
+
+# time steps per month in the fake files
+STEPS = 3
+
+SHAPE = (2, 3)
+
+
+def values(month: str) -> np.ndarray:
+    """The unpacked values of a month, distinct for each month and time step."""
+    steps = np.arange(STEPS, dtype=float)[:, None, None] + 10 * int(month)
+    return steps + np.zeros((1,) + SHAPE)
+
+
+class FakeResult:
+    """The result of a request, which writes the file on `download`."""
+
+    def __init__(self, request: dict, scale_factor: float) -> None:
+        self.request = request
+        self.scale_factor = scale_factor
+
+    def download(self, target: str) -> None:
+        months = self.request["month"]
+        with netCDF4.Dataset(target, "w", format="NETCDF4") as ds:
+            ds.createDimension("valid_time", None)
+            ds.createDimension("latitude", SHAPE[0])
+            ds.createDimension("longitude", SHAPE[1])
+            time = ds.createVariable("valid_time", "i8", ("valid_time",))
+            time.units = "hours since 2020-01-01"
+            ds.createVariable("latitude", "f4", ("latitude",))[:] = [40.0, 39.75]
+            ds.createVariable("longitude", "f4", ("longitude",))[:] = [
+                -80,
+                -79.75,
+                -79.5,
+            ]
+            t2m = ds.createVariable(
+                "t2m",
+                "i2",
+                ("valid_time", "latitude", "longitude"),
+                fill_value=np.int16(-32767),
+            )
+            t2m.scale_factor = self.scale_factor
+            t2m.add_offset = 0.0
+            for i, month in enumerate(months):
+                steps = slice(i * STEPS, (i + 1) * STEPS)
+                time[steps] = 24 * 31 * (int(month) - 1) + np.arange(STEPS)
+                t2m[steps] = values(month)
+
+
+class FakeClient:
+    """Answer requests locally, and fail those of some months once.
+
+    With `mixed_packing`, each request is packed with its own scale factor, as the
+    CDS does.
+    """
+
+    def __init__(self, fail_months=(), mixed_packing: bool = False) -> None:
+        self.fail_months = set(fail_months)
+        self.mixed_packing = mixed_packing
+        self.requests = []
+
+    def retrieve(self, dataset: str, request: dict) -> FakeResult:
+        self.requests.append(request["month"])
+        failing = self.fail_months.intersection(request["month"])
+        if failing:
+            self.fail_months -= failing
+            raise RuntimeError(f"request for {sorted(failing)} failed")
+        scale_factor = 0.5 / len(self.requests) if self.mixed_packing else 0.25
+        return FakeResult(request, scale_factor)
+
+
+def expected_values() -> np.ndarray:
+    """The unpacked values of the whole request, in time order."""
+    return np.concatenate([values(month) for month in REQUEST["month"]])
+
+
+def test_split_and_merge(tmp_path):
+    """The chunks are merged into one file, and removed afterwards."""
+    outfile = str(tmp_path / "t2m_2020.nc")
+    client = FakeClient()
+    retrieve_chunked(DATASET, REQUEST, outfile, months_per_chunk=2, client=client)
+    assert sorted(client.requests) == [["01", "02"], ["03", "04"], ["05"]]
+    with netCDF4.Dataset(outfile) as ds:
+        assert len(ds["valid_time"]) == STEPS * len(REQUEST["month"])
+        assert np.all(np.diff(ds["valid_time"][:]) > 0)
+        assert ds["t2m"].dtype == np.int16
+        np.testing.assert_allclose(ds["t2m"][:], expected_values())
+    assert os.listdir(tmp_path) == ["t2m_2020.nc"]
+
+
+def test_resume_after_failure(tmp_path):
+    """A second run only fetches the chunks that failed in the first."""
+    outfile = str(tmp_path / "t2m_2020.nc")
+    client = FakeClient(fail_months=["03"])
+    with pytest.raises(RuntimeError, match="1 of 5 chunks"):
+        retrieve_chunked(DATASET, REQUEST, outfile, client=client)
+    assert not os.path.exists(outfile)
+    assert len(client.requests) == 5
+
+    client.requests.clear()
+    retrieve_chunked(DATASET, REQUEST, outfile, client=client)
+    assert client.requests == [["03"]]
+    with netCDF4.Dataset(outfile) as ds:
+        np.testing.assert_allclose(ds["t2m"][:], expected_values())
+
+
+def test_stale_chunks_are_not_reused(tmp_path):
+    """Chunks left by another request are fetched again for a changed request."""
+    outfile = str(tmp_path / "t2m_2020.nc")
+    client = FakeClient(fail_months=["03"])
+    with pytest.raises(RuntimeError):
+        retrieve_chunked(DATASET, REQUEST, outfile, client=client)
+
+    client.requests.clear()
+    cropped = {**REQUEST, "area": [40, -80, 39.75, -79.5]}
+    retrieve_chunked(DATASET, cropped, outfile, client=client)
+    assert len(client.requests) == 5
+    assert os.listdir(tmp_path) == ["t2m_2020.nc"]
+
+
+def test_mixed_packing(tmp_path):
+    """A variable packed differently in each chunk is merged as float32."""
+    outfile = str(tmp_path / "t2m_2020.nc")
+    retrieve_chunked(
+        DATASET,
+        REQUEST,
+        outfile,
+        months_per_chunk=2,
+        max_workers=1,
+        client=FakeClient(mixed_packing=True),
+    )
+    with netCDF4.Dataset(outfile) as ds:
+        t2m = ds["t2m"]
+        assert t2m.dtype == np.float32
+        assert "scale_factor" not in t2m.ncattrs()
+        np.testing.assert_allclose(t2m[:], expected_values())
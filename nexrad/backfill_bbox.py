@@ -0,0 +1,321 @@
+"""
+Backfill the hourly NetCDF4 files of a new bounding box from the CONUS stores.
+
+Adding a bounding box to `nexrad_config.yml` otherwise means converting every hour
+of the archive again, and each conversion decodes a full GRIB2 file. The hours that
+are in the CONUS stores of `grib2_to_zarr.py` are already decoded, so this script
+cuts the box out of the stores instead: the index window of the box is looked up
+once per store (see `bbox_window`), and a day or a month of hours is read per call,
+which only reads the chunks that overlap the box. Each hour is then written as the
+same NetCDF4 file that `grib2_to_netcdf4.py` would write.
+
+Hours that are not in the stores are converted from their GRIB2 files, if these
+exist. The written hours are recorded in the manifest, so that incremental planning
+does not schedule them again. Values from the stores are rounded to 0.1 mm.
+
+Example:
+    python backfill_bbox.py --store-dir /data/NEXRAD/CONUS --dirname /data/NEXRAD \
+        --bbox-name Philadelphia --bbox 280.0 282.0 39.0 41.0 \
+        --etime 2024-12-31T23 --manifest .nexrad_manifest.sqlite
+"""
+
+import argparse
+import json
+import os
+from datetime import datetime
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from grib2_to_netcdf4 import bbox_window, convert_batch, netcdf_encoding, write_netcdf
+from grib2_to_zarr import VARIABLE, ingested_hours, open_store, store_path
+from nexrad_utils.const import GAUGECORR_BEGINTIME
+from nexrad_utils.manifest import DONE, Manifest
+from nexrad_utils.namingconventions import (
+    get_grib2_fname_many,
+    get_nc_fname_many,
+    get_varname_many,
+)
+from nexrad_utils.nexrad import TimeRange
+
+from util.instrument import file_size, job, span
+
+# the hours read from a store per call
+BLOCK_FORMATS = {"day": "%Y/%m/%d", "month": "%Y/%m"}
+
+
+def _existing(fnames: np.ndarray) -> np.ndarray:
+    """Check which files exist, listing each directory once."""
+    listings = {}
+    exists = np.zeros(len(fnames), dtype=bool)
+    for i, fname in enumerate(fnames):
+        dirname, basename = os.path.split(fname)
+        if dirname not in listings:
+            listings[dirname] = (
+                set(os.listdir(dirname)) if os.path.isdir(dirname) else set()
+            )
+        exists[i] = basename in listings[dirname]
+    return exists
+
+
+def backfill_from_store(
+    store: str,
+    dirname: str,
+    bbox: Dict,
+    dts: pd.DatetimeIndex,
+    block: str = "day",
+    index_cache: str = None,
+) -> pd.DatetimeIndex:
+    """Write the hourly NetCDF4 files of a bounding box from one CONUS store.
+
+    Args:
+        store (str): Path to the store of one product.
+        dirname (str): The NEXRAD data directory.
+        bbox (Dict): The bounding box as in `nexrad_config.yml`, with `name`,
+            `lon_min`, `lon_max`, `lat_min` and `lat_max`, and an optional
+            `encoding` with the arguments of `netcdf_encoding`.
+        dts (pd.DatetimeIndex): The hours to write, which must be in the store.
+        block (str, optional): "day" or "month", the hours read per call.
+        index_cache (str, optional): Directory of the index window cache, see
+            `bbox_window`.
+
+    Returns:
+        pd.DatetimeIndex: The hours written.
+    """
+    ds = open_store(store)
+    da = ds[VARIABLE]
+    window = bbox_window(
+        da,
+        (bbox["lon_min"], bbox["lon_max"], bbox["lat_min"], bbox["lat_max"]),
+        index_cache,
+    )
+    latitude = da["latitude"].values[window[0]]
+    longitude = da["longitude"].values[window[1]]
+    encoding = netcdf_encoding(**bbox.get("encoding", {}))
+    origin = pd.Timestamp(ds["time"].values[0])
+    fnames = get_nc_fname_many(dts, dirname=dirname, bbox_name=bbox["name"])
+
+    for _, hours in pd.Series(np.arange(len(dts)), index=dts).groupby(
+        dts.strftime(BLOCK_FORMATS[block])
+    ):
+        idx = ((hours.index - origin) // pd.Timedelta(hours=1)).to_numpy()
+        # one read of the block; zarr only decodes the chunks under the window
+        with span("read", store=os.path.basename(store)) as read:
+            values = (
+                da.isel(
+                    time=slice(idx[0], idx[-1] + 1),
+                    latitude=window[0],
+                    longitude=window[1],
+                )
+                .values[idx - idx[0]]
+                .astype(np.float32)
+            )
+            read.bytes_in = values.nbytes
+        for i, (dt, position) in enumerate(hours.items()):
+            output_file = fnames[position]
+            with span("write") as write:
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                hour = xr.DataArray(
+                    values[i],
+                    dims=("latitude", "longitude"),
+                    coords={"time": dt, "latitude": latitude, "longitude": longitude},
+                    name=VARIABLE,
+                    attrs={"units": "mm"},
+                )
+                write_netcdf(hour, output_file, encoding=encoding)
+                write.bytes_out = file_size(output_file)
+    return dts
+
+
+def backfill_bboxes(
+    store_dir: str,
+    dirname: str,
+    bboxes: Sequence[Dict],
+    trange: TimeRange,
+    block: str = "day",
+    manifest_path: str = None,
+    index_cache: str = None,
+    overwrite: bool = False,
+) -> Dict[str, Dict[str, int]]:
+    """Write the hourly NetCDF4 files of some bounding boxes for a time range.
+
+    The hours in the CONUS stores are cut out of them, and the others are converted
+    from their GRIB2 files, if these exist.
+
+    Args:
+        store_dir (str): Directory of the CONUS stores.
+        dirname (str): The NEXRAD data directory.
+        bboxes (Sequence[Dict]): Bounding boxes as in `nexrad_config.yml`.
+        trange (TimeRange): The hours to backfill.
+        block (str, optional): "day" or "month", the hours read from a store per
+            call.
+        manifest_path (str, optional): Path to the SQLite manifest in which to
+            record the written hours.
+        index_cache (str, optional): Directory of the index window cache, see
+            `bbox_window`.
+        overwrite (bool, optional): Also write the hours whose file exists.
+
+    Returns:
+        Dict[str, Dict[str, int]]: For each bounding box, the number of hours
+            written "from_store" and "from_grib2", that "existed" already, and
+            that are "missing" from both the stores and the GRIB2 files.
+
+    Example:
+        backfill_bboxes(
+            "/data/NEXRAD/CONUS",
+            "/data/NEXRAD",
+            [{"name": "Philadelphia", "lon_min": 280.0, "lon_max": 282.0,
+              "lat_min": 39.0, "lat_max": 41.0}],
+            TimeRange(datetime(2017, 8, 1), datetime(2017, 8, 31, 23)),
+        )
+    """
+    dts = trange.dt_valid
+    varnames = get_varname_many(dts)
+    in_store = np.zeros(len(dts), dtype=bool)
+    for varname in pd.unique(varnames):
+        in_store |= (varnames == varname) & dts.isin(
+            ingested_hours(store_path(store_dir, varname))
+        )
+    manifest = Manifest(manifest_path) if manifest_path else None
+
+    counts = {}
+    for bbox in bboxes:
+        todo = np.ones(len(dts), dtype=bool)
+        if not overwrite:
+            todo = ~_existing(get_nc_fname_many(dts, dirname, bbox["name"]))
+        written: List[pd.DatetimeIndex] = []
+        for varname in pd.unique(varnames):
+            hours = dts[todo & in_store & (varnames == varname)]
+            if len(hours):
+                store = store_path(store_dir, varname)
+                written.append(
+                    backfill_from_store(store, dirname, bbox, hours, block, index_cache)
+                )
+        n_store = sum(len(hours) for hours in written)
+
+        # hours that are not in the stores, from the GRIB2 files that exist
+        rest = dts[todo & ~in_store]
+        grib2_files = get_grib2_fname_many(rest, dirname=dirname)
+        on_disk = _existing(grib2_files)
+        if on_disk.any():
+            convert_batch(
+                input_files=grib2_files[on_disk],
+                output_files=[
+                    [fname]
+                    for fname in get_nc_fname_many(rest[on_disk], dirname, bbox["name"])
+                ],
+                bboxes=[
+                    (bbox["lon_min"], bbox["lon_max"], bbox["lat_min"], bbox["lat_max"])
+                ],
+                encodings=[netcdf_encoding(**bbox.get("encoding", {}))],
+                index_cache=index_cache,
+            )
+            written.append(rest[on_disk])
+
+        if manifest is not None:
+            for hours in written:
+                manifest.record(bbox["name"], hours, DONE)
+        counts[bbox["name"]] = {
+            "from_store": n_store,
+            "from_grib2": int(on_disk.sum()),
+            "existed": int((~todo).sum()),
+            "missing": int((~on_disk).sum()),
+        }
+        print(
+            f"{bbox['name']}: {n_store} hours from the stores, "
+            f"{counts[bbox['name']]['from_grib2']} from GRIB2 files, "
+            f"{counts[bbox['name']]['existed']} existed, "
+            f"{counts[bbox['name']]['missing']} missing"
+        )
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Backfill the NetCDF4 files of new bounding boxes from the CONUS stores."
+    )
+    parser.add_argument(
+        "--store-dir", required=True, help="Directory of the CONUS stores."
+    )
+    parser.add_argument("--dirname", required=True, help="The NEXRAD data directory.")
+    parser.add_argument(
+        "--bbox-name",
+        required=True,
+        action="append",
+        help="Name of a bounding box. Repeat once per --bbox.",
+    )
+    parser.add_argument(
+        "--bbox",
+        required=True,
+        type=float,
+        nargs=4,
+        action="append",
+        metavar=("LONMIN", "LONMAX", "LATMIN", "LATMAX"),
+        help="A bounding box to backfill. Repeat for several boxes.",
+    )
+    parser.add_argument(
+        "--encoding",
+        type=json.loads,
+        action="append",
+        help="Encoding options of one bounding box as a JSON object. Repeat once "
+        "per --bbox.",
+    )
+    parser.add_argument(
+        "--stime",
+        type=datetime.fromisoformat,
+        default=GAUGECORR_BEGINTIME,
+        help="First hour to backfill.",
+    )
+    parser.add_argument(
+        "--etime", type=datetime.fromisoformat, required=True, help="Last hour."
+    )
+    parser.add_argument(
+        "--block",
+        choices=list(BLOCK_FORMATS),
+        default="day",
+        help="Hours read from a store per call.",
+    )
+    parser.add_argument("--manifest", help="SQLite manifest to record the hours in.")
+    parser.add_argument(
+        "--index-cache",
+        help="Directory to cache the index window of each bounding box per grid.",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Also rewrite the hours whose file exists.",
+    )
+    args = parser.parse_args()
+
+    if len(args.bbox_name) != len(args.bbox):
+        parser.error("give one --bbox per --bbox-name")
+    encodings = args.encoding or [{}] * len(args.bbox)
+    if len(encodings) != len(args.bbox):
+        parser.error("give one --encoding per --bbox")
+    bboxes = [
+        {
+            "name": name,
+            "lon_min": lon_min,
+            "lon_max": lon_max,
+            "lat_min": lat_min,
+            "lat_max": lat_max,
+            "encoding": encoding,
+        }
+        for name, (lon_min, lon_max, lat_min, lat_max), encoding in zip(
+            args.bbox_name, args.bbox, encodings
+        )
+    ]
+
+    with job("backfill_bbox", bboxes=args.bbox_name):
+        backfill_bboxes(
+            store_dir=args.store_dir,
+            dirname=args.dirname,
+            bboxes=bboxes,
+            trange=TimeRange(args.stime, args.etime),
+            block=args.block,
+            manifest_path=args.manifest,
+            index_cache=args.index_cache,
+            overwrite=args.overwrite,
+        )
@@ -4,14 +4,307 @@ Subset a GRIB2 file and save it as a NetCDF4 file.
 This script allows you to extract a specific geographical region from a GRIB2 file
 and save the subset as a NetCDF4 file for further analysis.
 
+Several bounding boxes can be extracted from the same GRIB2 file in one call by
+repeating `--bbox` and `--output`. The GRIB2 file is then decoded only once and
+every subset is taken from the in-memory array.
+
+Many hours can be converted by one process by repeating `--input`. The outputs are
+then listed input by input, with one `--output` per bounding box for each input.
+Use `--workers` to spread the files over a pool of processes. Alternatively, give
+`--input-dir` and one `--output-dir` per bounding box to convert every GRIB2 file
+below a directory, keeping the same relative paths. With `--manifest`, the hours
+converted into each output directory are then recorded in the manifest under the
+`--bbox-name` of the box, and the hours from `--stime` to `--etime` without a file
+are recorded as failed.
+
+The NetCDF4 encoding of the output can be set with `--dtype`, `--scale-factor`,
+`--add-offset`, `--compression`, `--complevel` and `--chunks`, which apply to every
+bounding box, or per bounding box with one `--encoding` JSON object per `--bbox`.
+
+The time spent decoding, subsetting and writing each file is recorded by
+`util.instrument` in `logs/metrics.jsonl`.
+
+Bounding boxes are cut out by integer index rather than by coordinate labels. The
+index window of each box is looked up once per grid definition and reused for every
+file on that grid; with `--index-cache` the windows are also saved to disk, keyed by
+a hash of the grid coordinates, so that later runs skip the lookup as well.
+
 Example:
     python grib2_to_netcdf4.py --input input.grib2 --output output.nc \
         --lonmin -125 --lonmax -66 --latmin 24 --latmax 50
+
+    python grib2_to_netcdf4.py --input input.grib2 \
+        --bbox 264.0 265.5 28.5 30.5 --output houston.nc \
+        --bbox 280.0 282.0 39.0 41.0 --output philadelphia.nc
+
+    python grib2_to_netcdf4.py --workers 4 \
+        --input hour00.grib2 --input hour01.grib2 \
+        --bbox 264.0 265.5 28.5 30.5 --output hour00.nc --output hour01.nc
+
+    python grib2_to_netcdf4.py --workers 4 --input-dir /data/NEXRAD/2017/08 \
+        --bbox 264.0 265.5 28.5 30.5 --output-dir /data/NEXRAD/Houston/2017/08
+
+    python grib2_to_netcdf4.py --input input.grib2 --output output.nc \
+        --bbox 264.0 265.5 28.5 30.5 --dtype int16 --scale-factor 0.1 \
+        --compression zlib --complevel 4
 """
 
 import argparse
+import glob
+import hashlib
+import json
+import numpy as np
 import xarray as xr
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from datetime import datetime
+from typing import Dict, List, Sequence, Tuple
+
+from nexrad_utils.manifest import Manifest, record_directory
+from nexrad_utils.nexrad import TimeRange
+
+from util.instrument import file_size, job, span
+
+# a bounding box given as (lon_min, lon_max, lat_min, lat_max)
+BBox = Tuple[float, float, float, float]
+
+# the integer index window of a bounding box, as (latitude, longitude) slices
+Window = Tuple[slice, slice]
+
+# index windows that were already looked up, keyed by grid hash and bounding box
+_WINDOWS: Dict[Tuple[str, BBox], Window] = {}
+
+# the arguments of `netcdf_encoding`, which can be set for each bounding box
+ENCODING_OPTIONS = [
+    "dtype",
+    "scale_factor",
+    "add_offset",
+    "compression",
+    "complevel",
+    "chunks",
+]
+
+
+def open_grib2(input_file: str, indexpath: str = None) -> xr.DataArray:
+    """Open a GRIB2 file as a labeled precipitation array.
+
+    Args:
+        input_file (str): Path to the input GRIB2 file.
+        indexpath (str, optional): Where cfgrib saves its index of the file. By
+            default a `.idx` file next to it; "" to not save one.
+
+    Returns:
+        xr.DataArray: The (lazily loaded) precipitation field.
+
+    Example:
+        open_grib2("input.grib2")
+    """
+    backend_kwargs = {} if indexpath is None else {"indexpath": indexpath}
+    ds = xr.open_dataarray(
+        input_file,
+        engine="cfgrib",
+        decode_timedelta=False,
+        backend_kwargs=backend_kwargs,
+    )
+    ds.name = "precipitation"
+    ds.attrs = {"units": "mm"}
+    return ds
+
+
+def subset_bbox(
+    ds: xr.DataArray,
+    lon_min: float,
+    lon_max: float,
+    lat_min: float,
+    lat_max: float,
+) -> xr.DataArray:
+    """Subset a precipitation field to a bounding box.
+
+    Args:
+        ds (xr.DataArray): The full precipitation field.
+        lon_min (float): Minimum longitude of the bounding box.
+        lon_max (float): Maximum longitude of the bounding box.
+        lat_min (float): Minimum latitude of the bounding box.
+        lat_max (float): Maximum latitude of the bounding box.
+
+    Returns:
+        xr.DataArray: The subset of the field.
+    """
+    # latitudes are stored north to south
+    return ds.sel(longitude=slice(lon_min, lon_max), latitude=slice(lat_max, lat_min))
+
+
+def grid_hash(ds: xr.DataArray) -> str:
+    """Identify the grid of a field by hashing its latitude and longitude.
+
+    Args:
+        ds (xr.DataArray): The precipitation field.
+
+    Returns:
+        str: A short hexadecimal hash, equal for fields on the same grid.
+    """
+    h = hashlib.sha1()
+    for dim in ("latitude", "longitude"):
+        h.update(np.ascontiguousarray(ds[dim].values, dtype="float64").tobytes())
+    return h.hexdigest()[:16]
+
+
+def _bbox_key(bbox: BBox) -> str:
+    """Format a bounding box as a key of the on-disk index cache."""
+    return ",".join(repr(float(bound)) for bound in bbox)
+
+
+def _read_index_cache(cache_file: str) -> Dict[str, List[int]]:
+    """Read the index windows saved for one grid, or nothing if there are none."""
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index_cache(cache_file: str, windows: Dict[str, List[int]]) -> None:
+    """Save the index windows of one grid, replacing the file in one step."""
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    fd, tmpfile = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(cache_file)), suffix=".part"
+    )
+    with os.fdopen(fd, "w") as f:
+        json.dump(windows, f, indent=1)
+    os.replace(tmpfile, cache_file)
+
+
+def bbox_window(ds: xr.DataArray, bbox: BBox, index_cache: str = None) -> Window:
+    """Find the integer index window of a bounding box on the grid of a field.
+
+    The window selects the same cells as `subset_bbox`. It is computed once per grid
+    and bounding box, and then kept in memory and, optionally, on disk.
+
+    Args:
+        ds (xr.DataArray): The precipitation field, which defines the grid.
+        bbox (BBox): The `(lon_min, lon_max, lat_min, lat_max)` of the box.
+        index_cache (str, optional): Directory of the on-disk cache, with one JSON
+            file of windows per grid hash.
+
+    Returns:
+        Window: The `(latitude, longitude)` slices of the box.
+
+    Example:
+        window = bbox_window(ds, (264.0, 265.5, 28.5, 30.5))
+        ds.isel(latitude=window[0], longitude=window[1])
+    """
+    ghash = grid_hash(ds)
+    window = _WINDOWS.get((ghash, tuple(bbox)))
+    if window is not None:
+        return window
+
+    key = _bbox_key(bbox)
+    cache_file = index_cache and os.path.join(index_cache, f"{ghash}.json")
+    cached = _read_index_cache(cache_file) if cache_file else {}
+
+    if key in cached:
+        lat_start, lat_stop, lon_start, lon_stop = cached[key]
+    else:
+        lon_min, lon_max, lat_min, lat_max = bbox
+        # the same label lookups as `subset_bbox`; latitudes are stored north to south
+        lat_start, lat_stop, _ = (
+            ds.indexes["latitude"]
+            .slice_indexer(lat_max, lat_min)
+            .indices(ds.sizes["latitude"])
+        )
+        lon_start, lon_stop, _ = (
+            ds.indexes["longitude"]
+            .slice_indexer(lon_min, lon_max)
+            .indices(ds.sizes["longitude"])
+        )
+        if cache_file:
+            cached[key] = [lat_start, lat_stop, lon_start, lon_stop]
+            _write_index_cache(cache_file, cached)
+
+    window = (slice(lat_start, lat_stop), slice(lon_start, lon_stop))
+    _WINDOWS[(ghash, tuple(bbox))] = window
+    return window
+
+
+def subset_window(ds: xr.DataArray, window: Window) -> xr.DataArray:
+    """Subset a precipitation field to an index window from `bbox_window`.
+
+    Args:
+        ds (xr.DataArray): The full precipitation field.
+        window (Window): The `(latitude, longitude)` slices.
+
+    Returns:
+        xr.DataArray: The subset of the field.
+    """
+    lat_slice, lon_slice = window
+    return ds.isel(latitude=lat_slice, longitude=lon_slice)
+
+
+def netcdf_encoding(
+    dtype: str = None,
+    scale_factor: float = None,
+    add_offset: float = None,
+    compression: str = None,
+    complevel: int = None,
+    chunks: Sequence[int] = None,
+) -> Dict:
+    """Build the NetCDF4 encoding of the precipitation variable.
+
+    Args:
+        dtype (str, optional): Data type on disk, e.g. "float32" or "int16".
+        scale_factor (float, optional): Packing scale. With an integer `dtype`,
+            values are stored as `round((x - add_offset) / scale_factor)`.
+        add_offset (float, optional): Packing offset.
+        compression (str, optional): Compression codec, e.g. "zlib" or "zstd".
+        complevel (int, optional): Compression level.
+        chunks (Sequence[int], optional): Chunk shape as `(latitude, longitude)`.
+
+    Returns:
+        Dict: The encoding of the variable, as expected by `to_netcdf`.
+
+    Example:
+        netcdf_encoding(dtype="int16", scale_factor=0.1, compression="zlib")
+    """
+    encoding = {}
+    if dtype is not None:
+        encoding["dtype"] = dtype
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            # integer types need a fill value for the missing data
+            encoding["_FillValue"] = np.iinfo(dtype).min
+    if scale_factor is not None:
+        encoding["scale_factor"] = scale_factor
+    if add_offset is not None:
+        encoding["add_offset"] = add_offset
+    if compression is not None:
+        encoding["compression"] = compression
+        encoding["shuffle"] = True
+    if complevel is not None:
+        encoding["complevel"] = complevel
+    if chunks is not None:
+        encoding["chunksizes"] = tuple(chunks)
+    return encoding
+
+
+def write_netcdf(da: xr.DataArray, output_file: str, encoding: Dict = None) -> None:
+    """Save a precipitation field as a NetCDF4 file.
+
+    Args:
+        da (xr.DataArray): The field to save.
+        output_file (str): Path to the output NetCDF4 file.
+        encoding (Dict, optional): The encoding from `netcdf_encoding`.
+
+    Returns:
+        None
+    """
+    encoding = dict(encoding or {})
+    if "chunksizes" in encoding:
+        # chunks cannot be larger than the subset
+        encoding["chunksizes"] = tuple(
+            min(chunk, size) for chunk, size in zip(encoding["chunksizes"], da.shape)
+        )
+    da.to_netcdf(output_file, format="NETCDF4", encoding={da.name: encoding})
 
 
 def subset_and_convert(
@@ -21,6 +314,8 @@ def subset_and_convert(
     lon_max: float,
     lat_min: float,
     lat_max: float,
+    encoding: Dict = None,
+    index_cache: str = None,
 ) -> None:
     """Subset a GRIB2 file and save it as a NetCDF4 file.
 
@@ -31,6 +326,9 @@ def subset_and_convert(
         lon_max (float): Maximum longitude of the bounding box.
         lat_min (float): Minimum latitude of the bounding box.
         lat_max (float): Maximum latitude of the bounding box.
+        encoding (Dict, optional): The encoding from `netcdf_encoding`.
+        index_cache (str, optional): Directory of the index window cache, see
+            `bbox_window`.
 
     Returns:
         None
@@ -38,60 +336,415 @@ def subset_and_convert(
     Example:
         subset_and_convert("input.grib2", "output.nc", -125, -66, 24, 50)
     """
-    # Open the GRIB2 file
-    ds = xr.open_dataarray(input_file, engine="cfgrib", decode_timedelta=False)
-    ds.name = "precipitation"
-    ds.attrs = {"units": "mm"}
+    # Open the GRIB2 file lazily and select the window; only the coordinates are read
+    with span("subset"):
+        ds = open_grib2(input_file)
+        window = bbox_window(ds, (lon_min, lon_max, lat_min, lat_max), index_cache)
+        ds_subset = subset_window(ds, window)
 
-    # Subset the data
-    ds_subset = ds.sel(
-        longitude=slice(lon_min, lon_max), latitude=slice(lat_max, lat_min)
-    )
+    # Decode the window only, so that the write below does not read the GRIB2 file
+    with span("decode", bytes_in=file_size(input_file)):
+        ds_subset = ds_subset.load()
 
     # Save the subset as a NetCDF4 file
-    ds_subset.to_netcdf(output_file, format="NETCDF4")
+    with span("write") as write:
+        write_netcdf(ds_subset, output_file, encoding=encoding)
+        write.bytes_out = file_size(output_file)
+
+
+def subset_and_convert_bboxes(
+    input_file: str,
+    output_files: Sequence[str],
+    bboxes: Sequence[BBox],
+    encodings: Sequence[Dict] = None,
+    index_cache: str = None,
+) -> None:
+    """Subset a GRIB2 file to several bounding boxes, decoding it only once.
+
+    Args:
+        input_file (str): Path to the input GRIB2 file.
+        output_files (Sequence[str]): Path to the output NetCDF4 file for each box.
+        bboxes (Sequence[BBox]): The `(lon_min, lon_max, lat_min, lat_max)` of each box.
+        encodings (Sequence[Dict], optional): The encoding of each box, from
+            `netcdf_encoding`.
+        index_cache (str, optional): Directory of the index window cache, see
+            `bbox_window`.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the number of output files and bounding boxes differ.
+
+    Example:
+        subset_and_convert_bboxes(
+            "input.grib2",
+            ["houston.nc", "philadelphia.nc"],
+            [(264.0, 265.5, 28.5, 30.5), (280.0, 282.0, 39.0, 41.0)],
+        )
+    """
+    if len(output_files) != len(bboxes):
+        raise ValueError(
+            f"Got {len(output_files)} output files for {len(bboxes)} bounding boxes"
+        )
+    if encodings is None:
+        encodings = [None] * len(bboxes)
+
+    # Decode the full grid once; the cfgrib backend would otherwise re-read the
+    # GRIB2 message for every subset that we write
+    with span("decode", bytes_in=file_size(input_file)):
+        ds = open_grib2(input_file).load()
+
+    for output_file, bbox, encoding in zip(output_files, bboxes, encodings):
+        with span("subset"):
+            ds_subset = subset_window(ds, bbox_window(ds, bbox, index_cache))
+        with span("write") as write:
+            os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+            write_netcdf(ds_subset, output_file, encoding=encoding)
+            write.bytes_out = file_size(output_file)
+
+
+def convert_batch(
+    input_files: Sequence[str],
+    output_files: Sequence[Sequence[str]],
+    bboxes: Sequence[BBox],
+    max_workers: int = 1,
+    encodings: Sequence[Dict] = None,
+    index_cache: str = None,
+) -> None:
+    """Convert many GRIB2 files in one long-lived process.
+
+    Importing xarray and cfgrib takes longer than subsetting a single file, so
+    converting a day or a month of files per process is much cheaper than starting
+    one process per file.
+
+    Args:
+        input_files (Sequence[str]): Paths to the input GRIB2 files.
+        output_files (Sequence[Sequence[str]]): For each input file, the path to the
+            output NetCDF4 file for each bounding box.
+        bboxes (Sequence[BBox]): The `(lon_min, lon_max, lat_min, lat_max)` of each box.
+        max_workers (int, optional): Number of worker processes. With 1 (default),
+            the files are converted one after another in this process.
+        encodings (Sequence[Dict], optional): The encoding of each box, from
+            `netcdf_encoding`.
+        index_cache (str, optional): Directory of the index window cache, see
+            `bbox_window`.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the number of input files and lists of output files differ.
+
+    Example:
+        convert_batch(
+            ["hour00.grib2", "hour01.grib2"],
+            [["hour00.nc"], ["hour01.nc"]],
+            [(264.0, 265.5, 28.5, 30.5)],
+            max_workers=2,
+        )
+    """
+    if len(input_files) != len(output_files):
+        raise ValueError(
+            f"Got {len(output_files)} lists of output files for {len(input_files)} input files"
+        )
+
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # consume the results so that errors in the workers are raised here
+            list(
+                executor.map(
+                    subset_and_convert_bboxes,
+                    input_files,
+                    output_files,
+                    repeat(bboxes),
+                    repeat(encodings),
+                    repeat(index_cache),
+                )
+            )
+    else:
+        for input_file, outputs in zip(input_files, output_files):
+            subset_and_convert_bboxes(
+                input_file, outputs, bboxes, encodings, index_cache
+            )
+
+
+def convert_directory(
+    input_dir: str,
+    output_dirs: Sequence[str],
+    bboxes: Sequence[BBox],
+    max_workers: int = 1,
+    encodings: Sequence[Dict] = None,
+    index_cache: str = None,
+) -> None:
+    """Convert every GRIB2 file below a directory.
+
+    Each output file has the same path relative to its output directory as the
+    input file has relative to `input_dir`, with the `.grib2` extension replaced by
+    `.nc`.
+
+    Args:
+        input_dir (str): The directory to search for `.grib2` files.
+        output_dirs (Sequence[str]): The output directory for each bounding box.
+        bboxes (Sequence[BBox]): The `(lon_min, lon_max, lat_min, lat_max)` of each box.
+        max_workers (int, optional): Number of worker processes.
+        encodings (Sequence[Dict], optional): The encoding of each box, from
+            `netcdf_encoding`.
+        index_cache (str, optional): Directory of the index window cache, see
+            `bbox_window`.
+
+    Returns:
+        None
+
+    Example:
+        convert_directory(
+            "/data/NEXRAD/2017/08",
+            ["/data/NEXRAD/Houston/2017/08"],
+            [(264.0, 265.5, 28.5, 30.5)],
+        )
+    """
+    input_files = sorted(
+        glob.glob(os.path.join(input_dir, "**", "*.grib2"), recursive=True)
+    )
+    output_files = []
+    for input_file in input_files:
+        relpath = os.path.splitext(os.path.relpath(input_file, input_dir))[0] + ".nc"
+        output_files.append(
+            [os.path.join(output_dir, relpath) for output_dir in output_dirs]
+        )
+    convert_batch(
+        input_files,
+        output_files,
+        bboxes,
+        max_workers=max_workers,
+        encodings=encodings,
+        index_cache=index_cache,
+    )
+
+
+def convert_timerange(
+    trange,
+    dirname: str,
+    bboxes: Sequence[Dict],
+    max_workers: int = 1,
+    index_cache: str = None,
+) -> None:
+    """Convert every valid hour of a `TimeRange` for the given bounding boxes.
+
+    File names follow `nexrad_utils.namingconventions`, which must be installed.
+
+    Args:
+        trange (nexrad_utils.nexrad.TimeRange): The hours to convert.
+        dirname (str): The NEXRAD data directory.
+        bboxes (Sequence[Dict]): Bounding boxes as in `nexrad_config.yml`, with
+            `name`, `lon_min`, `lon_max`, `lat_min` and `lat_max` keys, and an
+            optional `encoding` with the arguments of `netcdf_encoding`.
+        max_workers (int, optional): Number of worker processes.
+        index_cache (str, optional): Directory of the index window cache, see
+            `bbox_window`.
+
+    Returns:
+        None
+
+    Example:
+        convert_timerange(trange, "/data/NEXRAD", config["bounding_boxes"])
+    """
+    from nexrad_utils.namingconventions import get_grib2_fname, get_nc_fname
+
+    input_files = [get_grib2_fname(dt, dirname=dirname) for dt in trange.dt_valid]
+    output_files = [
+        [get_nc_fname(dt, dirname=dirname, bbox_name=bbox["name"]) for bbox in bboxes]
+        for dt in trange.dt_valid
+    ]
+    convert_batch(
+        input_files=input_files,
+        output_files=output_files,
+        bboxes=[
+            (bbox["lon_min"], bbox["lon_max"], bbox["lat_min"], bbox["lat_max"])
+            for bbox in bboxes
+        ],
+        max_workers=max_workers,
+        encodings=[netcdf_encoding(**bbox.get("encoding", {})) for bbox in bboxes],
+        index_cache=index_cache,
+    )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Subset a GRIB2 file and save as NetCDF4."
     )
-    parser.add_argument("--input", required=True, help="Path to the input GRIB2 file.")
     parser.add_argument(
-        "--output", required=True, help="Path to the output NetCDF4 file."
+        "--input",
+        action="append",
+        help="Path to the input GRIB2 file. Repeat to convert several files.",
+    )
+    parser.add_argument(
+        "--output",
+        action="append",
+        help="Path to the output NetCDF4 file. Repeat once per --bbox and --input.",
+    )
+    parser.add_argument(
+        "--input-dir",
+        help="Convert every GRIB2 file below this directory instead of --input.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        action="append",
+        help="Output directory for use with --input-dir. Repeat once per --bbox.",
     )
     parser.add_argument(
         "--lonmin",
         type=float,
-        required=True,
         help="Minimum longitude of the bounding box.",
     )
     parser.add_argument(
         "--lonmax",
         type=float,
-        required=True,
         help="Maximum longitude of the bounding box.",
     )
     parser.add_argument(
         "--latmin",
         type=float,
-        required=True,
         help="Minimum latitude of the bounding box.",
     )
     parser.add_argument(
         "--latmax",
         type=float,
-        required=True,
         help="Maximum latitude of the bounding box.",
     )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        action="append",
+        metavar=("LONMIN", "LONMAX", "LATMIN", "LATMAX"),
+        help="A bounding box to extract. Repeat to extract several boxes in one pass.",
+    )
+    parser.add_argument("--dtype", help="Data type on disk, e.g. float32 or int16.")
+    parser.add_argument(
+        "--scale-factor", type=float, help="Scale factor for packing into --dtype."
+    )
+    parser.add_argument(
+        "--add-offset", type=float, help="Offset for packing into --dtype."
+    )
+    parser.add_argument("--compression", help="Compression codec, e.g. zlib or zstd.")
+    parser.add_argument("--complevel", type=int, help="Compression level.")
+    parser.add_argument(
+        "--chunks",
+        type=int,
+        nargs=2,
+        metavar=("NLAT", "NLON"),
+        help="Chunk shape on disk.",
+    )
+    parser.add_argument(
+        "--encoding",
+        type=json.loads,
+        action="append",
+        help="Encoding options of one bounding box as a JSON object, e.g. "
+        '\'{"dtype": "int16", "scale_factor": 0.1}\'. Repeat once per --bbox. '
+        "These override the options above.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to convert several input files.",
+    )
+    parser.add_argument(
+        "--index-cache",
+        help="Directory to cache the index window of each bounding box per grid.",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="SQLite manifest to record the converted hours in, with --input-dir.",
+    )
+    parser.add_argument(
+        "--bbox-name",
+        action="append",
+        help="Name of a bounding box in the manifest. Repeat once per --output-dir.",
+    )
+    parser.add_argument(
+        "--stime",
+        type=datetime.fromisoformat,
+        help="First expected hour; expected hours without a file are recorded as failed.",
+    )
+    parser.add_argument(
+        "--etime", type=datetime.fromisoformat, help="Last expected hour."
+    )
 
     args = parser.parse_args()
 
-    subset_and_convert(
-        input_file=args.input,
-        output_file=args.output,
-        lon_min=args.lonmin,
-        lon_max=args.lonmax,
-        lat_min=args.latmin,
-        lat_max=args.latmax,
-    )
+    if args.bbox:
+        bboxes: List[BBox] = [tuple(bbox) for bbox in args.bbox]
+    else:
+        bounds = [args.lonmin, args.lonmax, args.latmin, args.latmax]
+        if any(bound is None for bound in bounds):
+            parser.error(
+                "use --bbox, or give --lonmin, --lonmax, --latmin and --latmax"
+            )
+        bboxes = [tuple(bounds)]
+
+    n_boxes = len(bboxes)
+    options = {
+        option: getattr(args, option)
+        for option in ENCODING_OPTIONS
+        if getattr(args, option) is not None
+    }
+    bbox_options = args.encoding or [{}] * n_boxes
+    if len(bbox_options) != n_boxes:
+        parser.error("give one --encoding per bounding box")
+    encodings = [netcdf_encoding(**{**options, **opts}) for opts in bbox_options]
+
+    with job("grib2_to_netcdf4", n_inputs=len(args.input or []), n_boxes=n_boxes):
+        if args.input_dir:
+            if not args.output_dir or len(args.output_dir) != n_boxes:
+                parser.error("give one --output-dir per bounding box with --input-dir")
+            if args.manifest and (not args.bbox_name or len(args.bbox_name) != n_boxes):
+                parser.error("give one --bbox-name per bounding box with --manifest")
+            convert_directory(
+                input_dir=args.input_dir,
+                output_dirs=args.output_dir,
+                bboxes=bboxes,
+                max_workers=args.workers,
+                encodings=encodings,
+                index_cache=args.index_cache,
+            )
+            if args.manifest:
+                manifest = Manifest(args.manifest)
+                expected = None
+                if args.stime and args.etime:
+                    expected = TimeRange(args.stime, args.etime)
+                for bbox_name, output_dir in zip(args.bbox_name, args.output_dir):
+                    record_directory(manifest, bbox_name, output_dir, expected=expected)
+        elif not args.input or not args.output:
+            parser.error("give --input and --output, or --input-dir and --output-dir")
+        elif len(args.output) != len(args.input) * n_boxes:
+            parser.error(
+                f"expected {len(args.input) * n_boxes} --output arguments "
+                f"({len(args.input)} inputs x {n_boxes} bounding boxes), "
+                f"got {len(args.output)}"
+            )
+        elif args.bbox or len(args.input) > 1:
+            convert_batch(
+                input_files=args.input,
+                output_files=[
+                    args.output[i * n_boxes : (i + 1) * n_boxes]
+                    for i in range(len(args.input))
+                ],
+                bboxes=bboxes,
+                max_workers=args.workers,
+                encodings=encodings,
+                index_cache=args.index_cache,
+            )
+        else:
+            lon_min, lon_max, lat_min, lat_max = bboxes[0]
+            subset_and_convert(
+                input_file=args.input[0],
+                output_file=args.output[0],
+                lon_min=lon_min,
+                lon_max=lon_max,
+                lat_min=lat_min,
+                lat_max=lat_max,
+                encoding=encodings[0],
+                index_cache=args.index_cache,
+            )
@@ -0,0 +1,426 @@
+"""
+Ingest hourly GRIB2 files into one compact CONUS Zarr store per product.
+
+Each unzipped `.grib2` file holds one hour on the full MRMS CONUS grid, and every
+reprocessing decodes it again. This script decodes each hour once and writes it
+into a time x latitude x longitude store, one per product era (`get_varname`):
+
+    {store_dir}/GaugeCorr_QPE_01H.zarr
+    {store_dir}/MultiSensor_QPE_01H_Pass2.zarr
+
+Values are quantized to int16 in steps of `SCALE_FACTOR` (0.1 mm) and compressed
+with zstd. Missing values are stored as the fill value and read back as NaN. The
+chunks hold `time_chunk` hours (24 by default) over a small area, so that a bounding
+box subset or a backfill only reads the chunks it needs. The chunks are grouped into
+a few large shard files per block of hours to keep the number of files small.
+
+The time axis of a store is regular and hourly, starting at midnight of the first
+day of its product, so the position of an hour never changes. Blocks of
+`time_chunk` hours are written in one go. When only some hours of a block are
+given, its other hours are kept. The `ingested`
+variable records which hours hold data; missing snapshots stay empty.
+
+Jobs that write different blocks can run at the same time. Growing the time axis is
+serialized by a lock file next to the store. Open the stores with `open_store`,
+which reads the current metadata, since the stores are not consolidated.
+
+Example:
+    python grib2_to_zarr.py --store-dir /data/NEXRAD/CONUS \
+        --input-dir /data/NEXRAD/2017/08/17
+
+    python grib2_to_zarr.py --store-dir /data/NEXRAD/CONUS \
+        --input hour00.grib2 --input hour01.grib2
+"""
+
+import argparse
+import glob
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from zarr.codecs import ZstdCodec
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from grib2_to_netcdf4 import open_grib2
+from nexrad_utils.const import GAUGECORR_BEGINTIME, MULTISENSOR_BEGINTIME
+from nexrad_utils.namingconventions import fname2dt_many, get_varname, get_varname_many
+
+from util.instrument import file_size, job, span
+
+VARIABLE = "precipitation"
+
+# the precision of the stored values, in mm
+SCALE_FACTOR = 0.1
+
+# stored for missing values, and for hours that were never written
+FILL_VALUE = np.iinfo(np.int16).min
+
+# the first hour of each product
+BEGINTIMES = {
+    get_varname(begintime): begintime
+    for begintime in (GAUGECORR_BEGINTIME, MULTISENSOR_BEGINTIME)
+}
+
+# number of hours per chunk of the time coordinate
+TIME_COORD_CHUNK = 24 * 366
+
+
+def store_path(store_dir: str, varname: str) -> str:
+    """The store of a product, `{store_dir}/{varname}.zarr`."""
+    return os.path.join(store_dir, f"{varname}.zarr")
+
+
+def time_origin(varname: str) -> datetime:
+    """The first hour of the time axis of a product's store.
+
+    Args:
+        varname (str): The product, from `get_varname`.
+
+    Returns:
+        datetime: Midnight of the first day of the product.
+    """
+    begintime = BEGINTIMES[varname]
+    return datetime(begintime.year, begintime.month, begintime.day)
+
+
+def quantize(values: np.ndarray) -> np.ndarray:
+    """Round precipitation in mm to int16 steps of `SCALE_FACTOR`.
+
+    Args:
+        values (np.ndarray): The precipitation, with NaN where it is missing.
+
+    Returns:
+        np.ndarray: The int16 values, with `FILL_VALUE` where they are missing.
+    """
+    steps = np.round(values / SCALE_FACTOR)
+    limit = np.iinfo(np.int16).max
+    steps = np.clip(steps, -limit, limit, out=steps)
+    return np.where(np.isnan(steps), FILL_VALUE, steps).astype(np.int16)
+
+
+@contextmanager
+def _store_lock(store: str) -> Iterator[None]:
+    """Hold an exclusive lock on a store while its metadata is changed."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(store)), exist_ok=True)
+    with open(store + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def create_store(
+    store: str,
+    latitude: np.ndarray,
+    longitude: np.ndarray,
+    origin: datetime,
+    time_chunk: int = 24,
+    chunks: Tuple[int, int] = (250, 250),
+    shards: Tuple[int, int] = (1750, 3500),
+    complevel: int = 3,
+) -> None:
+    """Create an empty store for one product on the grid of its GRIB2 files.
+
+    Args:
+        store (str): Path to the Zarr store.
+        latitude (np.ndarray): The latitudes of the grid, north to south.
+        longitude (np.ndarray): The longitudes of the grid, west to east.
+        origin (datetime): The first hour of the time axis.
+        time_chunk (int, optional): Number of hours per chunk, and per write.
+        chunks (Tuple[int, int], optional): Chunk shape as `(latitude, longitude)`.
+        shards (Tuple[int, int], optional): Shape of the shard files, as
+            `(latitude, longitude)`, in whole chunks.
+        complevel (int, optional): The zstd compression level.
+
+    Returns:
+        None
+    """
+    ds = xr.Dataset(
+        {
+            VARIABLE: (
+                ("time", "latitude", "longitude"),
+                np.zeros((0, len(latitude), len(longitude)), dtype=np.float32),
+                {"units": "mm"},
+            ),
+            "ingested": (("time",), np.zeros(0, dtype=bool)),
+        },
+        coords={
+            "time": (
+                "time",
+                np.zeros(0, dtype=np.int64),
+                {
+                    "units": f"hours since {origin:%Y-%m-%d %H:%M:%S}",
+                    "calendar": "proleptic_gregorian",
+                },
+            ),
+            "latitude": latitude,
+            "longitude": longitude,
+        },
+    )
+    encoding = {
+        VARIABLE: {
+            "dtype": "int16",
+            "scale_factor": SCALE_FACTOR,
+            "_FillValue": FILL_VALUE,
+            "fill_value": FILL_VALUE,
+            "chunks": (time_chunk, *chunks),
+            "shards": (time_chunk, *shards),
+            "compressors": [ZstdCodec(level=complevel)],
+        },
+        "ingested": {"chunks": (time_chunk,)},
+        "time": {"chunks": (TIME_COORD_CHUNK,)},
+    }
+    ds.to_zarr(store, mode="w", encoding=encoding, consolidated=False, zarr_format=3)
+
+
+def _ensure_store(store: str, da: xr.DataArray, origin: datetime, **options) -> None:
+    """Create a store on the grid of a decoded hour, or check that it is on it.
+
+    Args:
+        store (str): Path to the Zarr store.
+        da (xr.DataArray): A decoded hour.
+        origin (datetime): The first hour of the time axis.
+        **options: The chunking and compression of `create_store`.
+
+    Raises:
+        ValueError: If the existing store is on another grid.
+    """
+    if not os.path.exists(store):
+        with _store_lock(store):
+            if not os.path.exists(store):
+                # build it aside, so that a failed creation leaves nothing behind
+                create_store(
+                    store + ".part",
+                    da["latitude"].values,
+                    da["longitude"].values,
+                    origin,
+                    **options,
+                )
+                os.replace(store + ".part", store)
+    group = zarr.open_group(store, mode="r")
+    grid = (group["latitude"].shape[0], group["longitude"].shape[0])
+    if grid != (da.sizes["latitude"], da.sizes["longitude"]):
+        raise ValueError(
+            f"The {da.shape} grid of the file is not the {grid} of {store}"
+        )
+
+
+def _grow_store(store: str, n_hours: int) -> None:
+    """Extend the time axis of a store to at least `n_hours`, under its lock."""
+    with _store_lock(store):
+        group = zarr.open_group(store, mode="r+")
+        n_stored = group["time"].shape[0]
+        if n_hours <= n_stored:
+            return
+        group[VARIABLE].resize((n_hours, *group[VARIABLE].shape[1:]))
+        group["ingested"].resize((n_hours,))
+        group["time"].resize((n_hours,))
+        group["time"][n_stored:] = np.arange(n_stored, n_hours)
+
+
+def _write_block(
+    store: str, start: int, stop: int, hours: np.ndarray, values: np.ndarray
+) -> None:
+    """Write some hours of one block of the time axis, keeping its other hours.
+
+    Args:
+        store (str): Path to the Zarr store.
+        start (int): Index of the first hour of the block.
+        stop (int): Index after the last hour of the block.
+        hours (np.ndarray): Indices of the given hours within the block.
+        values (np.ndarray): Their quantized values, `(hour, latitude, longitude)`.
+    """
+    _grow_store(store, stop)
+    group = zarr.open_group(store, mode="r+")
+    # one slice per run of consecutive hours; zarr reads and rewrites the shards of
+    # a partial block, with its other hours
+    breaks = np.flatnonzero(np.diff(hours) != 1) + 1
+    for run, run_values in zip(np.split(hours, breaks), np.split(values, breaks)):
+        first, last = start + run[0], start + run[-1] + 1
+        group[VARIABLE][first:last] = run_values
+        group["ingested"][first:last] = True
+
+
+def ingest_hours(
+    input_files: Sequence[str],
+    store_dir: str,
+    time_chunk: int = 24,
+    chunks: Tuple[int, int] = (250, 250),
+    shards: Tuple[int, int] = (1750, 3500),
+    complevel: int = 3,
+) -> int:
+    """Decode hourly GRIB2 files and write them into the store of their product.
+
+    The stores are created on first use. One block of `time_chunk` hours is held in
+    memory at a time, about `time_chunk` x 49 MB on the full CONUS grid.
+
+    Args:
+        input_files (Sequence[str]): Paths to the GRIB2 files, named as in
+            `nexrad_utils.namingconventions`.
+        store_dir (str): Directory of the stores.
+        time_chunk (int, optional): Number of hours per chunk. Only used when a
+            store is created.
+        chunks (Tuple[int, int], optional): Chunk shape as `(latitude, longitude)`.
+            Only used when a store is created.
+        shards (Tuple[int, int], optional): Shard shape as `(latitude, longitude)`.
+            Only used when a store is created.
+        complevel (int, optional): The zstd compression level. Only used when a
+            store is created.
+
+    Returns:
+        int: The number of hours written.
+
+    Raises:
+        ValueError: If a file is not on the grid of the existing store.
+
+    Example:
+        ingest_hours(glob.glob("/data/NEXRAD/2017/08/17/*.grib2"), "/data/NEXRAD/CONUS")
+    """
+    input_files = list(input_files)
+    files = pd.Series(input_files, index=fname2dt_many(input_files)).sort_index()
+    varnames = get_varname_many(files.index)
+    n_hours = 0
+    for varname in pd.unique(varnames):
+        store = store_path(store_dir, varname)
+        origin = pd.Timestamp(time_origin(varname))
+        era = files[varnames == varname]
+        idx = ((era.index - origin) // pd.Timedelta(hours=1)).to_numpy()
+
+        if os.path.exists(store):
+            block_size = zarr.open_group(store, mode="r")[VARIABLE].chunks[0]
+        else:
+            block_size = time_chunk
+        for block in np.unique(idx // block_size):
+            in_block = idx // block_size == block
+            hours = idx[in_block] - block * block_size
+            values = None
+            for i, fname in enumerate(era[in_block]):
+                with span("decode", bytes_in=file_size(fname)):
+                    da = open_grib2(fname, indexpath="").load()
+                if values is None:
+                    _ensure_store(
+                        store,
+                        da,
+                        origin,
+                        time_chunk=time_chunk,
+                        chunks=chunks,
+                        shards=shards,
+                        complevel=complevel,
+                    )
+                    values = np.empty((len(hours), *da.shape), dtype=np.int16)
+                values[i] = quantize(da.values)
+            with span("write", store=varname) as write:
+                _write_block(
+                    store,
+                    int(block * block_size),
+                    int((block + 1) * block_size),
+                    hours,
+                    values,
+                )
+                write.bytes_out = values.nbytes
+            n_hours += len(hours)
+    return n_hours
+
+
+def open_store(store: str) -> xr.Dataset:
+    """Open a store with its current metadata.
+
+    Args:
+        store (str): Path to the Zarr store.
+
+    Returns:
+        xr.Dataset: The lazily loaded store, with `precipitation` in mm.
+
+    Example:
+        ds = open_store("/data/NEXRAD/CONUS/MultiSensor_QPE_01H_Pass2.zarr")
+        ds["precipitation"].sel(latitude=slice(30.5, 28.5), longitude=slice(264, 265.5))
+    """
+    return xr.open_zarr(store, consolidated=False)
+
+
+def ingested_hours(store: str) -> pd.DatetimeIndex:
+    """The hours that were written into a store.
+
+    Args:
+        store (str): Path to the Zarr store.
+
+    Returns:
+        pd.DatetimeIndex: The hours, in time order.
+    """
+    if not os.path.exists(store):
+        return pd.DatetimeIndex([])
+    ds = open_store(store)
+    return pd.DatetimeIndex(ds["time"].values[ds["ingested"].values])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Ingest hourly GRIB2 files into compact CONUS Zarr stores."
+    )
+    parser.add_argument(
+        "--store-dir", required=True, help="Directory of the Zarr stores."
+    )
+    parser.add_argument(
+        "--input",
+        action="append",
+        help="Path to a GRIB2 file. Repeat to ingest several files.",
+    )
+    parser.add_argument(
+        "--input-dir", help="Ingest every GRIB2 file below this directory."
+    )
+    parser.add_argument(
+        "--time-chunk", type=int, default=24, help="Number of hours per chunk."
+    )
+    parser.add_argument(
+        "--chunks",
+        type=int,
+        nargs=2,
+        default=(250, 250),
+        metavar=("NLAT", "NLON"),
+        help="Chunk shape along latitude and longitude.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        nargs=2,
+        default=(1750, 3500),
+        metavar=("NLAT", "NLON"),
+        help="Shard file shape along latitude and longitude, in whole chunks.",
+    )
+    parser.add_argument(
+        "--complevel", type=int, default=3, help="zstd compression level."
+    )
+    args = parser.parse_args()
+
+    input_files = list(args.input or [])
+    if args.input_dir:
+        input_files += glob.glob(
+            os.path.join(args.input_dir, "**", "*.grib2"), recursive=True
+        )
+    if not input_files:
+        parser.error("give --input or an --input-dir with GRIB2 files")
+
+    with job("grib2_to_zarr", n_inputs=len(input_files)) as j:
+        n_hours = ingest_hours(
+            input_files,
+            args.store_dir,
+            time_chunk=args.time_chunk,
+            chunks=tuple(args.chunks),
+            shards=tuple(args.shards),
+            complevel=args.complevel,
+        )
+        j.bytes_in = sum(file_size(fname) for fname in input_files)
+    print(f"Ingested {n_hours} hours into {args.store_dir}")
@@ -0,0 +1,196 @@
+"""
+Consolidate the hourly NetCDF4 files of a bounding box into one Zarr store.
+
+Reading a decade of hourly data from one file per hour means opening ~90k files.
+This script appends the hourly files into a single chunked, compressed store with
+a `time` dimension. The chunks span many hours but only a small area, which suits
+long time series at a point or over a small region.
+
+Running the script again only adds the hours that are not yet in the store. Hours
+after the end of the store are appended. Hours that are already in the store are
+skipped, or rewritten in place with `--overwrite`. Hours that fall in a gap inside
+the store cannot be inserted and are reported; use `--rebuild` to start over.
+
+Example:
+    python netcdf4_to_zarr.py --store /data/NEXRAD/Houston.zarr \
+        --input-dir /data/NEXRAD/Houston/2017 --input-dir /data/NEXRAD/Houston/2018
+"""
+
+import argparse
+import glob
+import os
+import re
+import shutil
+import sys
+from datetime import datetime
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# the hourly files are named like `GaugeCorr_QPE_01H_00.00_20170817-120000.nc`
+FNAME_PATTERN = re.compile(r"_00\.00_(\d{8}-\d{6})\.nc$")
+DT_FORMAT = "%Y%m%d-%H%M%S"
+
+# scalar coordinates of the hourly files that are not worth keeping for every hour
+DROP_VARS = ["step", "surface", "valid_time"]
+
+
+def list_hourly_files(input_dirs: Sequence[str]) -> pd.Series:
+    """Find the hourly NetCDF4 files below some directories.
+
+    Args:
+        input_dirs (Sequence[str]): The directories to search.
+
+    Returns:
+        pd.Series: The file paths, indexed and sorted by their datetime.
+    """
+    fnames = {}
+    for input_dir in input_dirs:
+        for fname in glob.glob(os.path.join(input_dir, "**", "*.nc"), recursive=True):
+            match = FNAME_PATTERN.search(fname)
+            if match:
+                fnames[datetime.strptime(match.group(1), DT_FORMAT)] = fname
+    return pd.Series(fnames, dtype=object).sort_index()
+
+
+def read_hourly_files(fnames: Sequence[str]) -> xr.Dataset:
+    """Read hourly NetCDF4 files into one dataset along `time`.
+
+    Args:
+        fnames (Sequence[str]): The files to read, in time order.
+
+    Returns:
+        xr.Dataset: The data of all files, loaded into memory.
+    """
+    hours = []
+    for fname in fnames:
+        with xr.open_dataset(fname, decode_timedelta=False) as ds:
+            ds = ds.drop_vars(DROP_VARS, errors="ignore").load()
+        hours.append(ds.expand_dims("time"))
+    return xr.concat(hours, dim="time")
+
+
+def _contiguous_runs(idx: np.ndarray) -> List[Tuple[int, int]]:
+    """Split sorted integer indices into `(start, stop)` runs of consecutive values."""
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    return [(int(run[0]), int(run[-1]) + 1) for run in np.split(idx, breaks)]
+
+
+def append_to_store(
+    input_dirs: Sequence[str],
+    store: str,
+    time_chunk: int = 2160,
+    space_chunk: int = 32,
+    overwrite: bool = False,
+    rebuild: bool = False,
+) -> None:
+    """Add the hourly NetCDF4 files below some directories to a Zarr store.
+
+    Args:
+        input_dirs (Sequence[str]): The directories with the hourly `.nc` files.
+        store (str): Path to the Zarr store, which is created if needed.
+        time_chunk (int, optional): Number of hours per chunk. Only used when the
+            store is created.
+        space_chunk (int, optional): Number of grid cells per chunk along latitude
+            and longitude. Only used when the store is created.
+        overwrite (bool, optional): Rewrite hours that are already in the store.
+        rebuild (bool, optional): Delete the store and create it again.
+
+    Returns:
+        None
+
+    Example:
+        append_to_store(["/data/NEXRAD/Houston/2017"], "/data/NEXRAD/Houston.zarr")
+    """
+    if rebuild and os.path.exists(store):
+        shutil.rmtree(store)
+
+    fnames = list_hourly_files(input_dirs)
+
+    if os.path.exists(store):
+        with xr.open_zarr(store) as ds_store:
+            stored = pd.DatetimeIndex(ds_store["time"].values)
+    else:
+        stored = pd.DatetimeIndex([])
+
+    is_stored = fnames.index.isin(stored)
+    after_end = ~is_stored
+    if len(stored):
+        after_end &= fnames.index > stored[-1]
+    in_gap = ~is_stored & ~after_end
+
+    if in_gap.any():
+        print(
+            f"{in_gap.sum()} hours fall in gaps of {store} and were not added, "
+            f"starting with {fnames[in_gap].iloc[0]}; use --rebuild to add them",
+            file=sys.stderr,
+        )
+
+    # Rewrite hours that are already in the store, one contiguous region at a time
+    if overwrite and is_stored.any():
+        idx = stored.get_indexer(fnames.index[is_stored])
+        for start, stop in _contiguous_runs(idx):
+            ds = read_hourly_files(fnames[stored[start:stop]].values)
+            # region writes may only contain variables along the region dimension
+            ds = ds.drop_vars([v for v in ds.variables if "time" not in ds[v].dims])
+            ds.to_zarr(store, region={"time": slice(start, stop)})
+
+    # Append the new hours in blocks of whole chunks to bound the memory use
+    new_fnames = fnames[after_end]
+    for start in range(0, len(new_fnames), time_chunk):
+        ds = read_hourly_files(new_fnames.iloc[start : start + time_chunk].values)
+        if not os.path.exists(store):
+            encoding = {
+                var: {
+                    "chunks": tuple(
+                        time_chunk if dim == "time" else space_chunk
+                        for dim in ds[var].dims
+                    )
+                }
+                for var in ds.data_vars
+            }
+            ds.to_zarr(store, mode="w", encoding=encoding, consolidated=True)
+        else:
+            ds.to_zarr(store, append_dim="time", consolidated=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Consolidate hourly NetCDF4 files into one Zarr store."
+    )
+    parser.add_argument("--store", required=True, help="Path to the Zarr store.")
+    parser.add_argument(
+        "--input-dir",
+        required=True,
+        action="append",
+        help="Directory with hourly .nc files. Repeat for several directories.",
+    )
+    parser.add_argument(
+        "--time-chunk", type=int, default=2160, help="Number of hours per chunk."
+    )
+    parser.add_argument(
+        "--space-chunk",
+        type=int,
+        default=32,
+        help="Number of grid cells per chunk along latitude and longitude.",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Rewrite hours that are already in the store.",
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Delete the store and start over."
+    )
+    args = parser.parse_args()
+
+    append_to_store(
+        input_dirs=args.input_dir,
+        store=args.store,
+        time_chunk=args.time_chunk,
+        space_chunk=args.space_chunk,
+        overwrite=args.overwrite,
+        rebuild=args.rebuild,
+    )
@@ -1,12 +1,16 @@
 # Import necessary modules
+import json
 import os
+import shlex
 from datetime import timedelta, datetime
 import pandas as pd
 
 # Local packages to handle naming conventions
 from nexrad_utils.nexrad import TimeRange
-from nexrad_utils.const import GAUGECORR_BEGINTIME, MISSING_SNAPSHOTS
-from nexrad_utils.namingconventions import get_nc_fname, fname2url, get_grib2_fname
+from nexrad_utils.const import GAUGECORR_BEGINTIME
+from nexrad_utils.manifest import Manifest
+from nexrad_utils.availability import missing_hours
+from nexrad_utils.namingconventions import fname2url, get_grib2_fname_many
 
 # Specify directories to save the data
 NEXRAD_DATA_DIR = os.path.join(DATADIR, "NEXRAD")  # Final data storage directory
@@ -18,11 +22,15 @@ configfile: os.path.join(NEXRAD_SRC_DIR, "nexrad_config.yml")
 
 
 # Define the time range for data processing
-# Default: All available datetimes up to 10 days before the current date
-current_date = datetime.now().date()
-ENDTIME = datetime.combine(
-    current_date - timedelta(days=10), datetime.min.time()
-) + timedelta(hours=23)
+# Default: All available datetimes up to 10 days before the current date,
+# or up to `endtime` if it is set in the configuration
+if config.get("endtime"):
+    ENDTIME = datetime.fromisoformat(str(config["endtime"]))
+else:
+    current_date = datetime.now().date()
+    ENDTIME = datetime.combine(
+        current_date - timedelta(days=10), datetime.min.time()
+    ) + timedelta(hours=23)
 trange = TimeRange(GAUGECORR_BEGINTIME, ENDTIME)
 
 # Example: Process data for August 17, 2017
@@ -31,76 +39,314 @@ trange = TimeRange(GAUGECORR_BEGINTIME, ENDTIME)
 # t1 = datetime(2017, 8, 17, 23)
 # trange = TimeRange(t0, t1)
 
-t_nonmissing = [t for t in trange.dt_valid if t not in MISSING_SNAPSHOTS]
+# Optionally, also leave out the hours that the archive does not have, found from its
+# daily directory listings, which are cached locally for a while; they are also saved
+# to a file, so that the rolling accumulation treats them as gaps
+NEXRAD_MISSING_FILE = os.path.join(HOMEDIR, config["missing_hours_file"])
+if config["probe_availability"]:
+    nexrad_missing = missing_hours(
+        trange,
+        os.path.join(HOMEDIR, config["availability_cache"]),
+        ttl_hours=config["availability_ttl_hours"],
+    )
+    trange = TimeRange(trange.stime, trange.etime, missing=nexrad_missing)
+    with open(NEXRAD_MISSING_FILE, "w") as f:
+        f.writelines(f"{dt:%Y-%m-%dT%H}\n" for dt in nexrad_missing)
+
+# `dt_valid` already excludes the missing snapshots
+t_nonmissing = trange.dt_valid
+
+# In incremental mode, only plan the hours that the manifest does not list as done
+# for every bounding box, so that the existing files are not checked one by one
+NEXRAD_MANIFEST = os.path.join(HOMEDIR, config["manifest"])
+if config["incremental"]:
+    t_nonmissing = Manifest(NEXRAD_MANIFEST).pending(
+        t_nonmissing, [bbox["name"] for bbox in config["bounding_boxes"]]
+    )
+
+
+# Without `keep_grib2`, the GRIB2 files are temporary: snakemake deletes them once
+# they are ingested into the CONUS stores and converted for every bounding box.
+# A batch that gets new hours is converted again, which needs all of its GRIB2
+# files unless only the pending hours are planned, so this needs `incremental`
+NEXRAD_KEEP_GRIB2 = config["conus_store"]["keep_grib2"]
+if not NEXRAD_KEEP_GRIB2 and not config["incremental"]:
+    raise ValueError(
+        "keep_grib2: false needs incremental: true, or a batch that gets new hours "
+        "downloads all of its GRIB2 files again"
+    )
 
 
 # Rule: Download and unzip GRIB2 files
-# Downloads using curl and unzips using gunzip
+# Streams each file through gunzip into a temporary file, retrying on errors,
+# and only moves it into place once it is complete
 rule download_unzip:
     output:
-        os.path.join(NEXRAD_DATA_DIR, "{fname}.grib2"),
-    conda:
-        os.path.join(NEXRAD_SRC_DIR, "download_unzip.yml")
+        (
+            os.path.join(NEXRAD_DATA_DIR, "{fname}.grib2")
+            if NEXRAD_KEEP_GRIB2
+            else temp(os.path.join(NEXRAD_DATA_DIR, "{fname}.grib2"))
+        ),
     params:
         url=lambda wildcards: fname2url(wildcards.fname),
     log:
         os.path.join(LOGS, "download_unzip", "{fname}.log"),
     shell:
-        "curl -L {params.url} | gunzip > {output}"
+        "python -m nexrad_utils.download --url {params.url} --output {output}"
+
+
+# The prefetch covers the hours from the first planned hour to the end; the hours in
+# between that are not planned, because the archive does not have them or they are
+# already converted, are saved to a file so that it skips them
+NEXRAD_PREFETCH_STIME = t_nonmissing[0] if len(t_nonmissing) else trange.etime
+NEXRAD_PREFETCH_SKIP_FILE = os.path.join(HOMEDIR, ".nexrad_prefetch_skip.txt")
+with open(NEXRAD_PREFETCH_SKIP_FILE, "w") as f:
+    f.writelines(
+        f"{dt:%Y-%m-%dT%H}\n"
+        for dt in pd.date_range(
+            NEXRAD_PREFETCH_STIME, trange.etime, freq="h"
+        ).difference(t_nonmissing)
+    )
+
+
+# Rule: Download all GRIB2 files in the time range over a pool of connections
+# Run this before `nexrad` to fetch many hours without one process per file;
+# only the planned hours are downloaded
+rule prefetch_nexrad:
+    params:
+        stime=NEXRAD_PREFETCH_STIME.strftime("%Y-%m-%dT%H"),
+        etime=trange.etime.strftime("%Y-%m-%dT%H"),
+        dirname=NEXRAD_DATA_DIR,
+        workers=config["download_workers"],
+        missing_file=NEXRAD_PREFETCH_SKIP_FILE,
+    shell:
+        "python -m nexrad_utils.download --stime {params.stime} --etime {params.etime} --dirname {params.dirname} --workers {params.workers} --missing-file {params.missing_file}"
 
 
 # Generate a list of all GRIB2 filenames for valid datetimes
-all_nexrad_grib2_files = [
-    get_grib2_fname(dt, dirname=NEXRAD_DATA_DIR) for dt in t_nonmissing
-]
+all_nexrad_grib2_files = list(
+    get_grib2_fname_many(t_nonmissing, dirname=NEXRAD_DATA_DIR)
+)
 
 # Access bounding boxes from the configuration
 bounding_boxes = config["bounding_boxes"]
 
-# Define NetCDF4 output files for each bounding box and GRIB2 file combination
-all_nexrad_nc_files = [
-    get_nc_fname(dt, dirname=NEXRAD_DATA_DIR, bbox_name=bbox["name"])
-    for dt in t_nonmissing
+# Command line arguments giving the NetCDF4 encoding of each bounding box
+nexrad_encoding_args = " ".join(
+    f"--encoding {shlex.quote(json.dumps(bbox.get('encoding', {})))}"
     for bbox in bounding_boxes
+)
+
+# Index windows of the bounding boxes, cached per grid definition across jobs
+NEXRAD_INDEX_CACHE = os.path.join(NEXRAD_DATA_DIR, ".index_cache")
+
+# Group the hours into one conversion job per day or month
+# so that each job converts many GRIB2 files in one process
+BATCH_FORMATS = {"day": "%Y/%m/%d", "month": "%Y/%m"}
+nexrad_batches = t_nonmissing.groupby(
+    t_nonmissing.strftime(BATCH_FORMATS[config["conversion_batch"]])
+)
+
+# One converted marker for each batch
+all_nexrad_nc_markers = [
+    os.path.join(NEXRAD_DATA_DIR, "converted", f"{period}.done")
+    for period in nexrad_batches
 ]
 
 
-# Rule: Convert GRIB2 files to NetCDF4 format
-rule grib2_to_netcdf4:
+# Rule: Convert a day or month of GRIB2 files to NetCDF4 format in one process
+# Every GRIB2 file below the day or month directory is converted, and the NetCDF4
+# files keep the same relative paths below each bounding box directory;
+# the converted hours are then recorded in the manifest. The output is a `.done`
+# file rather than the NetCDF4 directories, which snakemake would delete before
+# a rerun, together with the hours whose GRIB2 files are already gone
+rule grib2_to_netcdf4_batch:
     input:
         script=os.path.join(NEXRAD_SRC_DIR, "grib2_to_netcdf4.py"),
-        grib2_file=os.path.join(
-            NEXRAD_DATA_DIR, "{year}", "{month}", "{day}", "{fname}.grib2"
+        grib2_files=lambda wildcards: get_grib2_fname_many(
+            nexrad_batches[wildcards.period], dirname=NEXRAD_DATA_DIR
         ),
     output:
-        nc_file=os.path.join(
-            NEXRAD_DATA_DIR, "{bbox_name}", "{year}", "{month}", "{day}", "{fname}.nc"
+        touch(os.path.join(NEXRAD_DATA_DIR, "converted", "{period}.done")),
+    wildcard_constraints:
+        period=r"\d{4}/\d{2}(/\d{2})?",
+    params:
+        bbox_args=" ".join(
+            f"--bbox {bbox['lon_min']} {bbox['lon_max']} {bbox['lat_min']} {bbox['lat_max']}"
+            for bbox in bounding_boxes
+        ),
+        input_dir=lambda wildcards: os.path.join(NEXRAD_DATA_DIR, wildcards.period),
+        output_dir_args=lambda wildcards: " ".join(
+            f"--output-dir {os.path.join(NEXRAD_DATA_DIR, bbox['name'], wildcards.period)}"
+            for bbox in bounding_boxes
         ),
+        encoding_args=nexrad_encoding_args,
+        index_cache=NEXRAD_INDEX_CACHE,
+        manifest=NEXRAD_MANIFEST,
+        record_args=lambda wildcards: " ".join(
+            [f"--bbox-name {bbox['name']}" for bbox in bounding_boxes]
+            + [
+                f"--stime {nexrad_batches[wildcards.period][0].isoformat()}",
+                f"--etime {nexrad_batches[wildcards.period][-1].isoformat()}",
+            ]
+        ),
+    conda:
+        os.path.join(NEXRAD_SRC_DIR, "grib2_to_netcdf4.yml")
+    threads: config["conversion_workers"]
+    shell:
+        "python {input.script} --workers {threads} {params.bbox_args} --input-dir {params.input_dir} {params.output_dir_args} {params.encoding_args} --index-cache {params.index_cache} --manifest {params.manifest} {params.record_args}"
+
+
+# The compact CONUS stores, one per product
+NEXRAD_CONUS_DIR = os.path.join(NEXRAD_DATA_DIR, "CONUS")
+
+
+# Rule: Ingest a day or month of GRIB2 files into the compact CONUS stores
+# Each hour is decoded once and written into the store of its product, so that
+# later subsets and backfills read the stores instead of the GRIB2 files;
+# the `.done` file records that the batch was ingested
+rule grib2_to_zarr:
+    input:
+        script=os.path.join(NEXRAD_SRC_DIR, "grib2_to_zarr.py"),
+        grib2_files=lambda wildcards: get_grib2_fname_many(
+            nexrad_batches[wildcards.period], dirname=NEXRAD_DATA_DIR
+        ),
+    output:
+        touch(os.path.join(NEXRAD_CONUS_DIR, "ingested", "{period}.done")),
+    wildcard_constraints:
+        period=r"\d{4}/\d{2}(/\d{2})?",
     params:
-        lon_min=lambda wildcards: next(
-            bbox["lon_min"]
-            for bbox in config["bounding_boxes"]
-            if bbox["name"] == wildcards.bbox_name
+        store_dir=NEXRAD_CONUS_DIR,
+        input_dir=lambda wildcards: os.path.join(NEXRAD_DATA_DIR, wildcards.period),
+        time_chunk=config["conus_store"]["time_chunk"],
+        chunks=" ".join(str(n) for n in config["conus_store"]["chunks"]),
+        shards=" ".join(str(n) for n in config["conus_store"]["shards"]),
+    log:
+        os.path.join(LOGS, "grib2_to_zarr", "{period}.log"),
+    conda:
+        os.path.join(NEXRAD_SRC_DIR, "grib2_to_netcdf4.yml")
+    shell:
+        "python {input.script} --store-dir {params.store_dir} --input-dir {params.input_dir} --time-chunk {params.time_chunk} --chunks {params.chunks} --shards {params.shards}"
+
+
+# One ingested marker for each batch
+all_nexrad_conus_files = [
+    os.path.join(NEXRAD_CONUS_DIR, "ingested", f"{period}.done")
+    for period in nexrad_batches
+]
+
+
+# Rule: Consolidate the hourly NetCDF4 files of a bounding box into one Zarr store
+# Only the hours that are not yet in the store are added, so the store is updated
+# in place; the `.done` file records when it was last brought up to date
+rule netcdf4_to_zarr:
+    input:
+        script=os.path.join(NEXRAD_SRC_DIR, "netcdf4_to_zarr.py"),
+        converted=all_nexrad_nc_markers,
+    output:
+        touch(os.path.join(NEXRAD_DATA_DIR, "{bbox_name}.zarr.done")),
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
+    params:
+        store=lambda wildcards: os.path.join(
+            NEXRAD_DATA_DIR, f"{wildcards.bbox_name}.zarr"
         ),
-        lon_max=lambda wildcards: next(
-            bbox["lon_max"]
-            for bbox in config["bounding_boxes"]
-            if bbox["name"] == wildcards.bbox_name
+        input_dir=lambda wildcards: os.path.join(NEXRAD_DATA_DIR, wildcards.bbox_name),
+    conda:
+        os.path.join(NEXRAD_SRC_DIR, "grib2_to_netcdf4.yml")
+    shell:
+        "python {input.script} --store {params.store} --input-dir {params.input_dir}"
+
+
+# One Zarr store for each bounding box
+all_nexrad_zarr_files = [
+    os.path.join(NEXRAD_DATA_DIR, f"{bbox['name']}.zarr.done")
+    for bbox in bounding_boxes
+]
+
+
+# Rule: Compute the n-hour accumulations of a bounding box and their annual maxima
+# The hourly NetCDF4 files are streamed in time order with a checkpoint next to the
+# output, so that a rerun only reads the hours that arrived since the last one
+rule rolling_accumulation:
+    input:
+        script=os.path.join(NEXRAD_SRC_DIR, "rolling_accumulation.py"),
+        converted=all_nexrad_nc_markers,
+    output:
+        os.path.join(NEXRAD_DATA_DIR, "{bbox_name}_annual_maxima.nc"),
+    wildcard_constraints:
+        bbox_name=r"[^/]+",
+    params:
+        dirname=NEXRAD_DATA_DIR,
+        stime=trange.stime.isoformat(),
+        etime=trange.etime.isoformat(),
+        durations=" ".join(str(n) for n in config["accumulations"]["durations"]),
+        max_missing=config["accumulations"]["max_missing"],
+        missing_args=(
+            f"--missing-file {NEXRAD_MISSING_FILE}"
+            if config["probe_availability"]
+            else ""
         ),
-        lat_min=lambda wildcards: next(
-            bbox["lat_min"]
-            for bbox in config["bounding_boxes"]
-            if bbox["name"] == wildcards.bbox_name
+    conda:
+        os.path.join(NEXRAD_SRC_DIR, "grib2_to_netcdf4.yml")
+    shell:
+        "python {input.script} --dirname {params.dirname} --bbox-name {wildcards.bbox_name} --stime {params.stime} --etime {params.etime} --durations {params.durations} --max-missing {params.max_missing} {params.missing_args} --output {output}"
+
+
+# Annual maxima for each bounding box
+all_nexrad_accumulation_files = [
+    os.path.join(NEXRAD_DATA_DIR, f"{bbox['name']}_annual_maxima.nc")
+    for bbox in bounding_boxes
+]
+
+
+# Rule: Record the NetCDF4 files that already exist in the manifest
+# Run this once before switching on `incremental` in nexrad_config.yml
+rule init_nexrad_manifest:
+    params:
+        manifest=NEXRAD_MANIFEST,
+        record_args=" ".join(
+            f"--bbox-name {bbox['name']} --dir {os.path.join(NEXRAD_DATA_DIR, bbox['name'])}"
+            for bbox in bounding_boxes
         ),
-        lat_max=lambda wildcards: next(
-            bbox["lat_max"]
-            for bbox in config["bounding_boxes"]
-            if bbox["name"] == wildcards.bbox_name
+    shell:
+        "python -m nexrad_utils.manifest --manifest {params.manifest} record {params.record_args}"
+
+
+# The bounding boxes listed under `backfill` in the config
+nexrad_backfill_bboxes = [
+    bbox for bbox in bounding_boxes if bbox["name"] in config["backfill"]
+]
+unknown_backfill = set(config["backfill"]) - {bbox["name"] for bbox in bounding_boxes}
+if unknown_backfill:
+    raise ValueError(f"Unknown bounding boxes to backfill: {sorted(unknown_backfill)}")
+
+
+# Rule: Backfill the hourly NetCDF4 files of new bounding boxes
+# After adding a bounding box to nexrad_config.yml, list its name under `backfill`
+# and run this before `nexrad`: the hours that are in the CONUS stores are cut out
+# of them a day or a month at a time, instead of decoding every GRIB2 file again,
+# and recorded in the manifest
+rule backfill_nexrad:
+    input:
+        script=os.path.join(NEXRAD_SRC_DIR, "backfill_bbox.py"),
+    params:
+        store_dir=NEXRAD_CONUS_DIR,
+        dirname=NEXRAD_DATA_DIR,
+        bbox_args=" ".join(
+            f"--bbox-name {bbox['name']} --bbox {bbox['lon_min']} {bbox['lon_max']} {bbox['lat_min']} {bbox['lat_max']} "
+            f"--encoding {shlex.quote(json.dumps(bbox.get('encoding', {})))}"
+            for bbox in nexrad_backfill_bboxes
         ),
+        stime=trange.stime.isoformat(),
+        etime=trange.etime.isoformat(),
+        block=config["conversion_batch"],
+        manifest=NEXRAD_MANIFEST,
+        index_cache=NEXRAD_INDEX_CACHE,
     conda:
         os.path.join(NEXRAD_SRC_DIR, "grib2_to_netcdf4.yml")
     shell:
-        "python {input.script} --input {input.grib2_file} --output {output.nc_file} --lonmin {params.lon_min} --lonmax {params.lon_max} --latmin {params.lat_min} --latmax {params.lat_max}"
+        "python {input.script} --store-dir {params.store_dir} --dirname {params.dirname} {params.bbox_args} --stime {params.stime} --etime {params.etime} --block {params.block} --manifest {params.manifest} --index-cache {params.index_cache}"
 
 
 # Rule: Clean up temporary files
@@ -112,5 +358,8 @@ rule clean_nexrad:
 # Rule: Main rule to process all NEXRAD data
 rule nexrad:
     input:
-        all_nexrad_grib2_files,
-        all_nexrad_nc_files,
+        all_nexrad_grib2_files if NEXRAD_KEEP_GRIB2 else [],
+        all_nexrad_conus_files,
+        all_nexrad_nc_markers,
+        all_nexrad_zarr_files,
+        all_nexrad_accumulation_files,
@@ -0,0 +1,343 @@
+"""
+Find out which hours the Iowa State archive has, from its directory listings.
+
+`MISSING_SNAPSHOTS` in `const.py` is maintained by hand. When it is out of date, the
+hours that are missing from the archive fail one by one at download time. This
+module asks the archive instead. It fetches the directory listing of each day and
+product (`get_varname`), one request per day instead of one per file, over a pool
+of threads. The hours whose file is listed are available.
+
+The listings are cached in a small local SQLite database, by the root URL they were
+fetched from. A cached listing is used again until it is older than the TTL. A
+listing fetched more than `SETTLED_DAYS` after its day is kept for good, since the
+archive no longer changes by then. So after the first run, only the recent days are
+fetched again.
+
+Example:
+    # the hours that are missing from the archive, but not from MISSING_SNAPSHOTS
+    python -m nexrad_utils.availability --cache .nexrad_availability.sqlite \
+        --stime 2015-05-06T20 --etime 2024-12-31T23 --workers 16
+
+    # in Python, e.g. against a local mirror
+    missing = missing_hours(trange, ".nexrad_availability.sqlite", base_url=mirror)
+    trange = TimeRange(trange.stime, trange.etime, missing=missing)
+"""
+
+import argparse
+import http.client
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Tuple
+
+import pandas as pd
+
+from util.sqlite import connect
+
+from .const import ARCHIVE_URL, GAUGECORR_BEGINTIME, MISSING_SNAPSHOTS_INDEX
+from .download import RETRY_STATUS, HTTPStatusError, read_url
+from .namingconventions import get_varname_many
+from .nexrad import TimeRange
+
+# listings fetched this many days after their day are not fetched again
+SETTLED_DAYS = 7
+
+# how long other listings are used again, in hours
+DEFAULT_TTL_HOURS = 24.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    base_url TEXT NOT NULL,
+    day TEXT NOT NULL,
+    product TEXT NOT NULL,
+    hours INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (base_url, day, product)
+)
+"""
+
+
+def listing_url(day: datetime, product: str, base_url: str = ARCHIVE_URL) -> str:
+    """Get the URL of the directory listing of a day and product.
+
+    Args:
+        day (datetime): The day.
+        product (str): The product, from `get_varname`.
+        base_url (str, optional): The root URL of the archive (or of a mirror).
+
+    Returns:
+        str: The URL of the directory that holds the hourly files.
+
+    Example:
+        listing_url(datetime(2017, 8, 17), "GaugeCorr_QPE_01H")
+    """
+    return f"{base_url}/{day:%Y/%m/%d}/mrms/ncep/{product}/"
+
+
+def parse_listing(body: str, day: datetime, product: str) -> int:
+    """Find the hours of a day whose file appears in a directory listing.
+
+    Args:
+        body (str): The HTML (or plain text) of the listing.
+        day (datetime): The day of the listing.
+        product (str): The product of the listing.
+
+    Returns:
+        int: A bit mask of the hours, with bit `h` set if hour `h` is listed.
+    """
+    pattern = re.compile(
+        re.escape(f"{product}_00.00_{day:%Y%m%d}-") + r"(\d{2})0000\.grib2\.gz"
+    )
+    hours = 0
+    for match in pattern.finditer(body):
+        hours |= 1 << int(match.group(1))
+    return hours
+
+
+def fetch_listing(
+    day: datetime,
+    product: str,
+    base_url: str = ARCHIVE_URL,
+    retries: int = 3,
+    backoff: float = 1.0,
+    timeout: float = 60.0,
+) -> int:
+    """Fetch the directory listing of a day and product, and parse it.
+
+    Args:
+        day (datetime): The day.
+        product (str): The product, from `get_varname`.
+        base_url (str, optional): The root URL of the archive (or of a mirror).
+        retries (int, optional): How many times to retry a failed request.
+        backoff (float, optional): Seconds to wait before the first retry. The wait
+            doubles after each failed attempt.
+        timeout (float, optional): The socket timeout in seconds.
+
+    Returns:
+        int: A bit mask of the listed hours (see `parse_listing`); 0 if the
+            directory does not exist.
+
+    Raises:
+        HTTPStatusError: If the server still fails after all retries.
+        OSError: If the request still fails after all retries.
+    """
+    url = listing_url(day, product, base_url)
+    for attempt in range(retries + 1):
+        try:
+            body = read_url(url, timeout=timeout).decode("utf-8", errors="replace")
+            return parse_listing(body, day, product)
+        except HTTPStatusError as e:
+            if e.status == 404:
+                return 0
+            if e.status not in RETRY_STATUS or attempt == retries:
+                raise
+        except (OSError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2**attempt)
+
+
+class AvailabilityCache:
+    """The directory listings of the archive and its mirrors, stored in SQLite.
+
+    The listings are kept by the root URL they were fetched from, so that a mirror
+    that lags behind the archive does not stand in for it.
+
+    Attributes:
+        path (str): Path to the SQLite database.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open the cache, creating the database if it does not exist.
+
+        Args:
+            path (str): Path to the SQLite database. It should be on a local disk.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with connect(self.path) as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(listings)")]
+            if columns and "base_url" not in columns:
+                # a cache made before listings were kept by URL; fetch them again
+                conn.execute("DROP TABLE listings")
+            conn.execute(SCHEMA)
+
+    def lookup(
+        self, base_url: str = ARCHIVE_URL, ttl_hours: float = DEFAULT_TTL_HOURS
+    ) -> Dict[Tuple[str, str], int]:
+        """The listings of a root URL that are still fresh.
+
+        Args:
+            base_url (str, optional): The root URL of the archive (or of a mirror).
+            ttl_hours (float, optional): How long a listing is used again, unless it
+                was fetched `SETTLED_DAYS` after its day.
+
+        Returns:
+            Dict[Tuple[str, str], int]: The bit mask of listed hours by
+                `(day, product)`, with the day as "YYYY-MM-DD".
+        """
+        now = time.time()
+        with connect(self.path) as conn:
+            rows = conn.execute(
+                "SELECT day, product, hours, fetched FROM listings "
+                "WHERE base_url = ?",
+                (base_url,),
+            ).fetchall()
+        fresh = {}
+        for day, product, hours, fetched in rows:
+            settled = pd.Timestamp(day) + pd.Timedelta(days=1 + SETTLED_DAYS)
+            if fetched >= settled.timestamp() or now - fetched < ttl_hours * 3600:
+                fresh[(day, product)] = hours
+        return fresh
+
+    def record(
+        self, listings: Dict[Tuple[str, str], int], base_url: str = ARCHIVE_URL
+    ) -> None:
+        """Store some listings that were just fetched.
+
+        Args:
+            listings (Dict[Tuple[str, str], int]): The bit mask of listed hours by
+                `(day, product)`.
+            base_url (str, optional): The root URL they were fetched from.
+        """
+        now = time.time()
+        with connect(self.path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO listings "
+                "(base_url, day, product, hours, fetched) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (base_url, day, product, hours, now)
+                    for (day, product), hours in listings.items()
+                ],
+            )
+
+
+def available_hours(
+    dts,
+    cache_path: str = None,
+    base_url: str = ARCHIVE_URL,
+    max_workers: int = 16,
+    ttl_hours: float = DEFAULT_TTL_HOURS,
+    refresh: bool = False,
+    **kwargs,
+) -> pd.DatetimeIndex:
+    """Find which of some hours have a file in the archive.
+
+    Args:
+        dts: The hours, as a `pd.DatetimeIndex` or anything it accepts.
+        cache_path (str, optional): Path to the SQLite cache of listings.
+        base_url (str, optional): The root URL of the archive (or of a mirror).
+        max_workers (int, optional): Number of listings fetched at the same time.
+        ttl_hours (float, optional): How long a cached listing is used again.
+        refresh (bool, optional): Fetch every listing again.
+        **kwargs: Passed on to `fetch_listing`.
+
+    Returns:
+        pd.DatetimeIndex: The hours that are available.
+
+    Example:
+        available_hours(TimeRange(t0, t1).dt_all, ".nexrad_availability.sqlite")
+    """
+    dts = pd.DatetimeIndex(dts)
+    days = dts.strftime("%Y-%m-%d")
+    products = get_varname_many(dts)
+    wanted = sorted(set(zip(days, products)))
+
+    cache = AvailabilityCache(cache_path) if cache_path else None
+    listings = cache.lookup(base_url, ttl_hours) if cache and not refresh else {}
+    todo = [key for key in wanted if key not in listings]
+    if todo:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetched = list(
+                executor.map(
+                    lambda key: fetch_listing(
+                        datetime.fromisoformat(key[0]), key[1], base_url, **kwargs
+                    ),
+                    todo,
+                )
+            )
+        fetched = dict(zip(todo, fetched))
+        if cache:
+            cache.record(fetched, base_url)
+        listings.update(fetched)
+
+    masks = pd.Series([listings[key] for key in zip(days, products)], dtype="int64")
+    listed = (masks.to_numpy() >> dts.hour.to_numpy()) & 1
+    return dts[listed.astype(bool)]
+
+
+def missing_hours(
+    trange: TimeRange, cache_path: str = None, **kwargs
+) -> pd.DatetimeIndex:
+    """Find the hours of a time range that are not in the archive.
+
+    Args:
+        trange (TimeRange): The hours to check; all of them, including the known
+            missing snapshots.
+        cache_path (str, optional): Path to the SQLite cache of listings.
+        **kwargs: Passed on to `available_hours`.
+
+    Returns:
+        pd.DatetimeIndex: The hours without a file, e.g. to pass as `missing` to
+            `TimeRange`.
+
+    Example:
+        missing_hours(TimeRange(t0, t1), ".nexrad_availability.sqlite")
+    """
+    available = available_hours(trange.dt_all, cache_path, **kwargs)
+    return trange.dt_all[~trange.dt_all.isin(available)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the hours in the NEXRAD archive with MISSING_SNAPSHOTS."
+    )
+    parser.add_argument(
+        "--cache", required=True, help="Path to the SQLite cache of listings."
+    )
+    parser.add_argument(
+        "--stime",
+        type=datetime.fromisoformat,
+        default=GAUGECORR_BEGINTIME,
+        help="First hour to check.",
+    )
+    parser.add_argument(
+        "--etime", type=datetime.fromisoformat, required=True, help="Last hour."
+    )
+    parser.add_argument(
+        "--base-url", default=ARCHIVE_URL, help="Root URL of the archive."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=16, help="Number of concurrent requests."
+    )
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        default=DEFAULT_TTL_HOURS,
+        help="Hours before a cached listing is fetched again.",
+    )
+    parser.add_argument(
+        "--refresh", action="store_true", help="Fetch every listing again."
+    )
+    args = parser.parse_args()
+
+    trange = TimeRange(args.stime, args.etime)
+    missing = missing_hours(
+        trange,
+        args.cache,
+        base_url=args.base_url,
+        max_workers=args.workers,
+        ttl_hours=args.ttl,
+        refresh=args.refresh,
+    )
+    known = MISSING_SNAPSHOTS_INDEX[
+        (MISSING_SNAPSHOTS_INDEX >= trange.dt_all[0])
+        & (MISSING_SNAPSHOTS_INDEX <= trange.dt_all[-1])
+    ]
+    print(f"{len(missing)} of {len(trange.dt_all)} hours are not in the archive")
+    for dt in missing[~missing.isin(known)]:
+        print(f"missing, not in MISSING_SNAPSHOTS: {dt:%Y-%m-%d %H:00}")
+    for dt in known[~known.isin(missing)]:
+        print(f"in MISSING_SNAPSHOTS, but available: {dt:%Y-%m-%d %H:00}")
@@ -1,6 +1,8 @@
 from datetime import datetime
 from typing import List
 
+import pandas as pd
+
 # there are some snapshots that are known to be missing data
 MISSING_SNAPSHOTS = [
     datetime(2015, 10, 26, 23),
@@ -116,6 +118,11 @@ MISSING_SNAPSHOTS = [
     datetime(2024, 3, 19, 22),
 ]
 
+# the same snapshots for fast lookups: a set for single datetimes
+# and a sorted index for vectorized filtering of date ranges
+MISSING_SNAPSHOTS_SET = frozenset(MISSING_SNAPSHOTS)
+MISSING_SNAPSHOTS_INDEX = pd.DatetimeIndex(sorted(MISSING_SNAPSHOTS))
+
 
 # when does the GaugeCorr_QPE_01H data start
 GAUGECORR_BEGINTIME = datetime(2015, 5, 6, 20)
@@ -125,3 +132,6 @@ MULTISENSOR_BEGINTIME = datetime(2020, 10, 13, 19)
 
 # the datetime format used by the Iowa State archive
 DT_FORMAT = "%Y%m%d-%H%M%S"
+
+# the root URL of the Iowa State archive
+ARCHIVE_URL = "https://mtarchive.geol.iastate.edu"
@@ -0,0 +1,370 @@
+"""
+Download NEXRAD files from the Iowa State archive.
+
+Files are fetched by a bounded pool of worker threads. Each worker keeps its HTTP
+connection open from one file to the next, so a long time range does not pay for a
+new TCP/TLS handshake per file. Each file is decompressed while it streams to disk
+into a temporary file, which is renamed into place only once it is complete. An
+interrupted run therefore never leaves a partial `.grib2` file behind, and running
+it again resumes where it stopped because existing files are skipped.
+
+Example:
+    python -m nexrad_utils.download --stime 2017-08-17T00 --etime 2017-08-17T23 \
+        --dirname /data/NEXRAD --workers 8 --missing-file missing_hours.txt
+
+    python -m nexrad_utils.download --output /data/NEXRAD/file.grib2 \
+        --url https://mtarchive.geol.iastate.edu/.../file.grib2.gz
+"""
+
+import argparse
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import BinaryIO, List, Sequence, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import pandas as pd
+from tqdm import tqdm
+
+from .const import ARCHIVE_URL
+from .namingconventions import get_grib2_fname_many, get_url_many
+from .nexrad import TimeRange
+
+# HTTP status codes that are worth retrying because the server may just be busy
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+
+# size of the blocks read from the network
+CHUNK_SIZE = 1 << 20
+
+
+class HTTPStatusError(OSError):
+    """The server answered with an unexpected HTTP status.
+
+    Attributes:
+        url (str): The requested URL.
+        status (int): The HTTP status code.
+    """
+
+    def __init__(self, url: str, status: int, reason: str) -> None:
+        super().__init__(f"HTTP {status} {reason} for {url}")
+        self.url = url
+        self.status = status
+
+
+class _ConnectionCache(threading.local):
+    """One open HTTP(S) connection per host, kept separately by each thread."""
+
+    def __init__(self) -> None:
+        self.connections = {}
+
+    def get(
+        self, scheme: str, netloc: str, timeout: float
+    ) -> http.client.HTTPConnection:
+        """Get the open connection to a host, or open a new one."""
+        conn = self.connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=timeout)
+            self.connections[(scheme, netloc)] = conn
+        return conn
+
+    def discard(self, scheme: str, netloc: str) -> None:
+        """Close the connection to a host, for example after an error."""
+        conn = self.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+
+_CONNECTIONS = _ConnectionCache()
+
+
+def _get(url: str, timeout: float) -> Tuple[http.client.HTTPResponse, Tuple[str, str]]:
+    """Send a GET request over a cached connection, following redirects.
+
+    Args:
+        url (str): The URL to request.
+        timeout (float): The socket timeout in seconds.
+
+    Returns:
+        Tuple[http.client.HTTPResponse, Tuple[str, str]]: The response, whose body
+            has not been read yet, and the `(scheme, netloc)` of its connection.
+
+    Raises:
+        HTTPStatusError: If the final response is not `200 OK`.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        conn = _CONNECTIONS.get(*host, timeout=timeout)
+        try:
+            conn.request("GET", path, headers={"Accept-Encoding": "identity"})
+            response = conn.getresponse()
+            if response.status == 200:
+                return response, host
+            # read the body so that the connection can be reused
+            response.read()
+        except (OSError, http.client.HTTPException):
+            # the server may have closed an idle connection
+            _CONNECTIONS.discard(*host)
+            raise
+        if response.status not in REDIRECT_STATUS:
+            raise HTTPStatusError(url, response.status, response.reason)
+        url = urljoin(url, response.getheader("Location"))
+    raise HTTPStatusError(url, response.status, "too many redirects")
+
+
+def read_url(url: str, timeout: float = 60.0) -> bytes:
+    """Read the whole body of a URL over the cached connection of the thread.
+
+    Args:
+        url (str): The URL to request.
+        timeout (float, optional): The socket timeout in seconds.
+
+    Returns:
+        bytes: The body of the response.
+
+    Raises:
+        HTTPStatusError: If the final response is not `200 OK`.
+
+    Example:
+        read_url(f"{ARCHIVE_URL}/2017/08/17/mrms/ncep/GaugeCorr_QPE_01H/")
+    """
+    response, host = _get(url, timeout=timeout)
+    try:
+        return response.read()
+    except BaseException:
+        # the connection is in an unknown state after a failed transfer
+        _CONNECTIONS.discard(*host)
+        raise
+
+
+def _gunzip_stream(src: BinaryIO, dst: BinaryIO) -> None:
+    """Decompress a gzip stream block by block.
+
+    Args:
+        src (BinaryIO): The compressed stream.
+        dst (BinaryIO): The file to write the decompressed data to.
+
+    Raises:
+        zlib.error: If the stream is corrupt or ends early.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    n_members = 0
+    pending = False
+    while chunk := src.read(CHUNK_SIZE):
+        # a gzip file may hold several members back to back
+        while chunk:
+            pending = True
+            dst.write(decompressor.decompress(chunk))
+            chunk = b""
+            if decompressor.eof:
+                n_members += 1
+                pending = False
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if pending or n_members == 0:
+        raise zlib.error("compressed stream ended early")
+
+
+def _download_once(url: str, outfile: str, timeout: float) -> None:
+    """Download and decompress one file, replacing `outfile` only on success."""
+    response, host = _get(url, timeout=timeout)
+    fd, tmpfile = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(outfile)),
+        prefix=os.path.basename(outfile) + ".",
+        suffix=".part",
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            _gunzip_stream(response, f)
+        os.replace(tmpfile, outfile)
+    except BaseException:
+        # the connection is in an unknown state after a failed transfer
+        _CONNECTIONS.discard(*host)
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+def download_file(
+    url: str,
+    outfile: str,
+    retries: int = 5,
+    backoff: float = 1.0,
+    timeout: float = 60.0,
+) -> None:
+    """Download a `.gz` file and save it decompressed.
+
+    Args:
+        url (str): The URL of the compressed file.
+        outfile (str): Path to save the decompressed file.
+        retries (int, optional): How many times to retry a failed download.
+        backoff (float, optional): Seconds to wait before the first retry. The wait
+            doubles after each failed attempt.
+        timeout (float, optional): The socket timeout in seconds.
+
+    Returns:
+        None
+
+    Raises:
+        HTTPStatusError: If the file does not exist on the server, or if the server
+            still fails after all retries.
+        OSError: If the download still fails after all retries.
+
+    Example:
+        download_file(get_url(dt), get_grib2_fname(dt, dirname="/data"))
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+    for attempt in range(retries + 1):
+        try:
+            _download_once(url, outfile, timeout=timeout)
+            return
+        except HTTPStatusError as e:
+            if e.status not in RETRY_STATUS or attempt == retries:
+                raise
+        except (OSError, http.client.HTTPException, zlib.error):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2**attempt)
+
+
+def download_many(
+    urls: Sequence[str],
+    outfiles: Sequence[str],
+    max_workers: int = 8,
+    overwrite: bool = False,
+    progress: bool = True,
+    **kwargs,
+) -> List[str]:
+    """Download many files over a bounded pool of connections.
+
+    Args:
+        urls (Sequence[str]): The URLs of the compressed files.
+        outfiles (Sequence[str]): Path to save each decompressed file.
+        max_workers (int, optional): Number of concurrent downloads.
+        overwrite (bool, optional): Download files that already exist again.
+        progress (bool, optional): Show a progress bar.
+        **kwargs: Passed on to `download_file`.
+
+    Returns:
+        List[str]: The files that could not be downloaded.
+
+    Example:
+        download_many(get_url_many(trange), get_grib2_fname_many(trange, "/data"))
+    """
+    jobs = [
+        (url, outfile)
+        for url, outfile in zip(urls, outfiles)
+        if overwrite or not os.path.exists(outfile)
+    ]
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(download_file, url, outfile, **kwargs): outfile
+            for url, outfile in jobs
+        }
+        for future in tqdm(
+            as_completed(futures), total=len(futures), disable=not progress
+        ):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to download {futures[future]}: {e}", file=sys.stderr)
+                failed.append(futures[future])
+
+    return sorted(failed)
+
+
+def download_timerange(
+    trange: TimeRange,
+    dirname: str,
+    base_url: str = ARCHIVE_URL,
+    **kwargs,
+) -> List[str]:
+    """Download the GRIB2 files of every valid hour in a time range.
+
+    Args:
+        trange (TimeRange): The hours to download.
+        dirname (str): The NEXRAD data directory.
+        base_url (str, optional): The root URL of the archive (or of a mirror).
+        **kwargs: Passed on to `download_many`.
+
+    Returns:
+        List[str]: The files that could not be downloaded.
+
+    Example:
+        download_timerange(TimeRange(t0, t1), "/data/NEXRAD", max_workers=8)
+    """
+    return download_many(
+        get_url_many(trange, base_url=base_url),
+        get_grib2_fname_many(trange, dirname=dirname),
+        **kwargs,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Download and decompress NEXRAD GRIB2 files."
+    )
+    parser.add_argument("--url", help="URL of a single file to download.")
+    parser.add_argument("--output", help="Path to save the single file.")
+    parser.add_argument(
+        "--stime",
+        type=datetime.fromisoformat,
+        help="Start of the time range to download, e.g. 2017-08-17T00.",
+    )
+    parser.add_argument(
+        "--etime",
+        type=datetime.fromisoformat,
+        help="End of the time range to download, e.g. 2017-08-17T23.",
+    )
+    parser.add_argument("--dirname", help="The NEXRAD data directory.")
+    parser.add_argument(
+        "--base-url", default=ARCHIVE_URL, help="Root URL of the archive."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="Number of concurrent downloads."
+    )
+    parser.add_argument(
+        "--retries", type=int, default=5, help="Number of retries per file."
+    )
+    parser.add_argument(
+        "--missing-file",
+        help="Text file of hours to leave out of the time range, one per line, e.g. "
+        "2020-10-13T19; such as those the archive does not have.",
+    )
+    args = parser.parse_args()
+
+    missing = None
+    if args.missing_file:
+        with open(args.missing_file) as f:
+            missing = pd.DatetimeIndex(pd.to_datetime(f.read().split()))
+
+    if args.url and args.output:
+        download_file(args.url, args.output, retries=args.retries)
+    elif args.stime and args.etime and args.dirname:
+        failed = download_timerange(
+            TimeRange(args.stime, args.etime, missing=missing),
+            args.dirname,
+            base_url=args.base_url,
+            max_workers=args.workers,
+            retries=args.retries,
+        )
+        if failed:
+            sys.exit(f"{len(failed)} files could not be downloaded")
+    else:
+        parser.error(
+            "give either --url and --output, or --stime, --etime and --dirname"
+        )
@@ -0,0 +1,253 @@
+"""
+Keep track of the hours that have been converted for each bounding box.
+
+Planning the full NEXRAD archive means asking the file system about every file that
+was ever produced, which is slow on a network mount. The manifest is a small local
+SQLite database that records, for each bounding box and hour, whether the hour was
+converted (`done`) or expected but not produced (`failed`). The planner can then
+ask the manifest instead of the file system which hours still need work.
+
+Example:
+    # seed the manifest once from the files that already exist
+    python -m nexrad_utils.manifest --manifest .nexrad_manifest.sqlite record \
+        --bbox-name Houston --dir /data/NEXRAD/Houston
+
+    # show what is recorded for each bounding box
+    python -m nexrad_utils.manifest --manifest .nexrad_manifest.sqlite status
+"""
+
+import argparse
+import glob
+import os
+from datetime import datetime
+from typing import Dict, Sequence
+
+import pandas as pd
+
+from util.sqlite import connect
+
+from .namingconventions import fname2dt_many
+from .nexrad import TimeRange
+
+DONE = "done"
+FAILED = "failed"
+
+# how times are stored, which also sorts them in time order
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hours (
+    bbox TEXT NOT NULL,
+    time TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (bbox, time)
+)
+"""
+
+
+class Manifest:
+    """The conversion status of each hour and bounding box, stored in SQLite.
+
+    Attributes:
+        path (str): Path to the SQLite database.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open the manifest, creating the database if it does not exist.
+
+        Args:
+            path (str): Path to the SQLite database. It should be on a local disk.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with connect(self.path) as conn:
+            conn.execute(SCHEMA)
+
+    def record(self, bbox_name: str, dts, status: str = DONE) -> None:
+        """Set the status of some hours of a bounding box.
+
+        Args:
+            bbox_name (str): The name of the bounding box.
+            dts: The hours, as a `TimeRange` or anything `pd.DatetimeIndex` accepts.
+            status (str, optional): `DONE` or `FAILED`.
+
+        Returns:
+            None
+
+        Example:
+            manifest.record("Houston", pd.DatetimeIndex(["2017-08-17 12:00"]))
+        """
+        dts = pd.DatetimeIndex(getattr(dts, "dt_valid", dts))
+        updated = datetime.now().strftime(TIME_FORMAT)
+        rows = [(bbox_name, t, status, updated) for t in dts.strftime(TIME_FORMAT)]
+        with connect(self.path) as conn:
+            conn.executemany(
+                "INSERT INTO hours (bbox, time, status, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (bbox, time) DO UPDATE "
+                "SET status = excluded.status, updated = excluded.updated",
+                rows,
+            )
+
+    def hours(self, bbox_name: str, status: str = DONE) -> pd.DatetimeIndex:
+        """Get the hours of a bounding box that have a given status.
+
+        Args:
+            bbox_name (str): The name of the bounding box.
+            status (str, optional): `DONE` or `FAILED`.
+
+        Returns:
+            pd.DatetimeIndex: The hours, in time order.
+        """
+        with connect(self.path) as conn:
+            rows = conn.execute(
+                "SELECT time FROM hours WHERE bbox = ? AND status = ? ORDER BY time",
+                (bbox_name, status),
+            ).fetchall()
+        return pd.DatetimeIndex(
+            pd.to_datetime([row[0] for row in rows], format=TIME_FORMAT)
+        )
+
+    def high_water_mark(self, bbox_name: str) -> datetime:
+        """Get the last hour of a bounding box that was converted.
+
+        Args:
+            bbox_name (str): The name of the bounding box.
+
+        Returns:
+            datetime: The last `done` hour, or None if there is none.
+        """
+        with connect(self.path) as conn:
+            (last,) = conn.execute(
+                "SELECT MAX(time) FROM hours WHERE bbox = ? AND status = ?",
+                (bbox_name, DONE),
+            ).fetchone()
+        return None if last is None else datetime.strptime(last, TIME_FORMAT)
+
+    def pending(self, dts, bbox_names: Sequence[str]) -> pd.DatetimeIndex:
+        """Find the hours that still need to be converted for some bounding box.
+
+        These are the hours after the high-water mark of a bounding box, and the
+        hours up to it that failed or were never recorded. Only the manifest is
+        read, not the converted files.
+
+        Args:
+            dts: The hours to consider, as a `TimeRange` or a `pd.DatetimeIndex`.
+            bbox_names (Sequence[str]): The names of the bounding boxes.
+
+        Returns:
+            pd.DatetimeIndex: The hours that are not `done` for every bounding box.
+
+        Example:
+            manifest.pending(TimeRange(t0, t1), ["Houston"])
+        """
+        dts = pd.DatetimeIndex(getattr(dts, "dt_valid", dts))
+        is_pending = pd.Series(False, index=dts)
+        for bbox_name in bbox_names:
+            hwm = self.high_water_mark(bbox_name)
+            if hwm is None:
+                return dts
+            # hours after the high-water mark, or up to it but not done
+            is_pending |= (dts > hwm) | ~dts.isin(self.hours(bbox_name, DONE))
+        return dts[is_pending.values]
+
+    def summary(self) -> Dict[str, Dict[str, object]]:
+        """Count the recorded hours of each bounding box.
+
+        Returns:
+            Dict[str, Dict[str, object]]: For each bounding box, the number of
+                `done` and `failed` hours and the high-water mark.
+        """
+        with connect(self.path) as conn:
+            rows = conn.execute(
+                "SELECT bbox, SUM(status = ?), SUM(status = ?), "
+                "MAX(CASE WHEN status = ? THEN time END) "
+                "FROM hours GROUP BY bbox ORDER BY bbox",
+                (DONE, FAILED, DONE),
+            ).fetchall()
+        return {
+            bbox: {"done": n_done, "failed": n_failed, "high_water_mark": hwm}
+            for bbox, n_done, n_failed, hwm in rows
+        }
+
+
+def record_directory(
+    manifest: Manifest,
+    bbox_name: str,
+    nc_dir: str,
+    expected: TimeRange = None,
+) -> None:
+    """Record the NetCDF4 files below a directory as converted.
+
+    Args:
+        manifest (Manifest): The manifest to update.
+        bbox_name (str): The name of the bounding box.
+        nc_dir (str): A directory with converted `.nc` files of the bounding box.
+        expected (TimeRange, optional): The hours that should have been converted.
+            Those without a file are recorded as failed.
+
+    Returns:
+        None
+
+    Example:
+        record_directory(manifest, "Houston", "/data/NEXRAD/Houston/2017/08/17")
+    """
+    fnames = glob.glob(os.path.join(nc_dir, "**", "*.nc"), recursive=True)
+    done = fname2dt_many(fnames)
+    manifest.record(bbox_name, done, DONE)
+    if expected is not None:
+        missing = expected.dt_valid[~expected.dt_valid.isin(done)]
+        manifest.record(bbox_name, missing, FAILED)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Record and query the converted NEXRAD hours."
+    )
+    parser.add_argument(
+        "--manifest", required=True, help="Path to the SQLite manifest."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_record = subparsers.add_parser(
+        "record", help="Record the .nc files below some directories as converted."
+    )
+    parser_record.add_argument(
+        "--bbox-name",
+        required=True,
+        action="append",
+        help="Name of a bounding box. Repeat once per --dir.",
+    )
+    parser_record.add_argument(
+        "--dir",
+        required=True,
+        action="append",
+        help="Directory with .nc files of the bounding box.",
+    )
+    parser_record.add_argument(
+        "--stime",
+        type=datetime.fromisoformat,
+        help="First expected hour; expected hours without a file are recorded as failed.",
+    )
+    parser_record.add_argument(
+        "--etime", type=datetime.fromisoformat, help="Last expected hour."
+    )
+
+    subparsers.add_parser("status", help="Show the recorded hours of each box.")
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    if args.command == "record":
+        if len(args.bbox_name) != len(args.dir):
+            parser.error("give one --dir per --bbox-name")
+        expected = None
+        if args.stime and args.etime:
+            expected = TimeRange(args.stime, args.etime)
+        for bbox_name, nc_dir in zip(args.bbox_name, args.dir):
+            record_directory(manifest, bbox_name, nc_dir, expected=expected)
+    else:
+        for bbox, counts in manifest.summary().items():
+            print(
+                f"{bbox}: {counts['done']} done, {counts['failed']} failed, "
+                f"up to {counts['high_water_mark']}"
+            )
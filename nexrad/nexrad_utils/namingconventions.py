@@ -3,11 +3,19 @@ Keep track of how the Iowa State archive names files.
 
 This module provides functions to generate filenames, URLs, and parse datetime objects
 for NEXRAD data based on the Iowa State archive naming conventions.
+
+The functions ending in `_many` do the same for a whole `pd.DatetimeIndex` (or
+`TimeRange`) at once and return arrays, which is much faster than calling the
+single-datetime functions in a loop.
 """
 
 from datetime import datetime
+from typing import Iterable, Union
 import os
 
+import numpy as np
+import pandas as pd
+
 from .const import *
 
 
@@ -121,11 +129,12 @@ def get_nc_fname(dt: datetime, dirname: str = None, bbox_name: str = None) -> st
         return get_fname_base(dt=dt, dirname=os.path.join(dirname, bbox_name)) + f".nc"
 
 
-def get_url(dt: datetime) -> str:
+def get_url(dt: datetime, base_url: str = ARCHIVE_URL) -> str:
     """Get the URL of the file for a particular date-time snapshot.
 
     Args:
         dt (datetime): The datetime object for which to generate the URL.
+        base_url (str, optional): The root URL of the archive (or of a mirror).
 
     Returns:
         str: The URL corresponding to the datetime.
@@ -140,7 +149,7 @@ def get_url(dt: datetime) -> str:
     fname = fname.split("/")[-1]
 
     varname = get_varname(dt)
-    return f"https://mtarchive.geol.iastate.edu/{date_str}/mrms/ncep/{varname}/{fname}"
+    return f"{base_url}/{date_str}/mrms/ncep/{varname}/{fname}"
 
 
 def fname2dt(fname: str) -> datetime:
@@ -179,3 +188,195 @@ def fname2url(fname: str) -> str:
     """
     dt = fname2dt(fname)
     return get_url(dt)
+
+
+def _as_datetimeindex(dts) -> pd.DatetimeIndex:
+    """Convert datetimes, or the valid datetimes of a `TimeRange`, to an index.
+
+    Args:
+        dts (Union[pd.DatetimeIndex, TimeRange, Iterable[datetime]]): The datetimes.
+
+    Returns:
+        pd.DatetimeIndex: The datetimes as an index.
+    """
+    # a TimeRange is converted to its valid datetimes
+    return pd.DatetimeIndex(getattr(dts, "dt_valid", dts))
+
+
+def get_varname_many(dts) -> np.ndarray:
+    """Get the variable name for many date-time snapshots.
+
+    Args:
+        dts (Union[pd.DatetimeIndex, TimeRange, Iterable[datetime]]): The datetimes.
+
+    Returns:
+        np.ndarray: The variable name corresponding to each datetime.
+
+    Raises:
+        ValueError: If no data is available for any of the datetimes.
+
+    Example:
+        get_varname_many(pd.date_range("2020-10-13 18:00", "2020-10-13 20:00", freq="h"))
+    """
+    dts = _as_datetimeindex(dts)
+    too_early = dts < GAUGECORR_BEGINTIME
+    if too_early.any():
+        dt_str = dts[too_early][0].strftime(DT_FORMAT)
+        raise ValueError(f"No data for {dt_str}")
+    return np.where(
+        dts >= MULTISENSOR_BEGINTIME, "MultiSensor_QPE_01H_Pass2", "GaugeCorr_QPE_01H"
+    ).astype(object)
+
+
+def _strftime_many(dts: pd.DatetimeIndex, date_fmt: str, time_fmt: str) -> np.ndarray:
+    """Format the date and the time of day of many datetimes.
+
+    An hourly range repeats each date 24 times and each hour every day, so only the
+    unique dates and unique times of day are formatted and then broadcast back.
+
+    Args:
+        dts (pd.DatetimeIndex): The datetimes.
+        date_fmt (str): The format of the date part (no time directives).
+        time_fmt (str): The format of the time part (no date directives).
+
+    Returns:
+        np.ndarray: The formatted date followed by the formatted time.
+    """
+    days = dts.normalize()
+    day_codes, unique_days = pd.factorize(days)
+    time_codes, unique_times = pd.factorize(dts - days)
+    date_strs = unique_days.strftime(date_fmt).to_numpy(dtype=object)
+    time_strs = (pd.Timestamp(2000, 1, 1) + unique_times).strftime(time_fmt)
+    return date_strs[day_codes] + time_strs.to_numpy(dtype=object)[time_codes]
+
+
+def get_fname_base_many(dts, dirname: str = None) -> np.ndarray:
+    """Get the base filenames for many date-time snapshots (no extension).
+
+    Args:
+        dts (Union[pd.DatetimeIndex, TimeRange, Iterable[datetime]]): The datetimes.
+        dirname (str, optional): The directory path to prepend to the filenames.
+
+    Returns:
+        np.ndarray: The base filename for each datetime, with optional directory path.
+
+    Example:
+        get_fname_base_many(trange, dirname="/data")
+    """
+    dts = _as_datetimeindex(dts)
+    varnames = get_varname_many(dts)
+    date_fmt, time_fmt = DT_FORMAT.split("-")
+
+    # Generate the nested path
+    fnames = (
+        _strftime_many(dts, os.path.join("%Y", "%m", "%d", ""), "")
+        + varnames
+        + _strftime_many(dts, f"_00.00_{date_fmt}-", time_fmt)
+    )
+    if dirname:
+        fnames = os.path.join(dirname, "") + fnames
+
+    return fnames
+
+
+def get_gz_fname_many(dts, dirname: str = None) -> np.ndarray:
+    """Get the filenames of the `.grib2.gz` files for many datetimes.
+
+    Args:
+        dts (Union[pd.DatetimeIndex, TimeRange, Iterable[datetime]]): The datetimes.
+        dirname (str, optional): The directory path to prepend to the filenames.
+
+    Returns:
+        np.ndarray: The `.grib2.gz` filenames with optional directory path.
+
+    Example:
+        get_gz_fname_many(trange, dirname="/data")
+    """
+    return get_fname_base_many(dts, dirname=dirname) + ".grib2.gz"
+
+
+def get_grib2_fname_many(dts, dirname: str = None) -> np.ndarray:
+    """Get the local `.grib2` filenames for many datetimes.
+
+    Args:
+        dts (Union[pd.DatetimeIndex, TimeRange, Iterable[datetime]]): The datetimes.
+        dirname (str, optional): The directory path to prepend to the filenames.
+
+    Returns:
+        np.ndarray: The `.grib2` filenames with optional directory path.
+
+    Example:
+        get_grib2_fname_many(trange, dirname="/data")
+    """
+    return get_fname_base_many(dts, dirname=dirname) + ".grib2"
+
+
+def get_nc_fname_many(dts, dirname: str = None, bbox_name: str = None) -> np.ndarray:
+    """Get the local `.netcdf4` filenames for many datetimes.
+
+    Args:
+        dts (Union[pd.DatetimeIndex, TimeRange, Iterable[datetime]]): The datetimes.
+        dirname (str): The directory path to prepend to the filenames.
+        bbox_name (str, optional): The bounding box name to include in the filenames.
+
+    Returns:
+        np.ndarray: The `.netcdf4` filenames with directory path and optional
+            bounding box name.
+
+    Raises:
+        ValueError: If `dirname` is not provided.
+
+    Example:
+        get_nc_fname_many(trange, dirname="/data", bbox_name="bbox1")
+    """
+    if dirname is None:
+        raise ValueError("dirname must be provided")
+    if bbox_name is not None:
+        dirname = os.path.join(dirname, bbox_name)
+    return get_fname_base_many(dts, dirname=dirname) + ".nc"
+
+
+def get_url_many(dts, base_url: str = ARCHIVE_URL) -> np.ndarray:
+    """Get the URLs of the files for many date-time snapshots.
+
+    Args:
+        dts (Union[pd.DatetimeIndex, TimeRange, Iterable[datetime]]): The datetimes.
+        base_url (str, optional): The root URL of the archive (or of a mirror).
+
+    Returns:
+        np.ndarray: The URL corresponding to each datetime.
+
+    Example:
+        get_url_many(trange)
+    """
+    dts = _as_datetimeindex(dts)
+    varnames = get_varname_many(dts)
+    date_fmt, time_fmt = DT_FORMAT.split("-")
+    # escape any % in the URL so that strftime leaves it alone
+    url_fmt = base_url.replace("%", "%%") + "/%Y/%m/%d/mrms/ncep/"
+    date_strs = _strftime_many(dts, url_fmt, "")
+    dt_strs = _strftime_many(dts, f"_00.00_{date_fmt}-", time_fmt + ".grib2.gz")
+    return date_strs + varnames + "/" + varnames + dt_strs
+
+
+def fname2dt_many(fnames: Iterable[str]) -> pd.DatetimeIndex:
+    """Parse many filenames, for example a directory listing, to get their datetimes.
+
+    Args:
+        fnames (Iterable[str]): The filenames to parse.
+
+    Returns:
+        pd.DatetimeIndex: The datetime corresponding to each filename.
+
+    Raises:
+        ValueError: If any of the filenames does not follow the naming convention.
+
+    Example:
+        fname2dt_many(os.listdir("/data/2025/04/07"))
+    """
+    fnames = pd.Series(list(fnames), dtype=object)
+    dt_strs = fnames.str.extract(r"_00\.00_(\d{8}-\d{6})\.[^/\\]*$", expand=False)
+    if dt_strs.isna().any():
+        bad = fnames[dt_strs.isna()].iloc[0]
+        raise ValueError(f"Could not parse a datetime from {bad}")
+    return pd.DatetimeIndex(pd.to_datetime(dt_strs, format=DT_FORMAT))
@@ -6,11 +6,10 @@ with additional checks for missing snapshots.
 """
 
 from datetime import datetime
-from tqdm import tqdm
 
 import pandas as pd
 
-from .const import MISSING_SNAPSHOTS
+from .const import MISSING_SNAPSHOTS_INDEX, MISSING_SNAPSHOTS_SET
 from .namingconventions import *
 
 
@@ -31,7 +30,7 @@ def assert_valid_datetime(dt: datetime) -> None:
     assert dt.minute == 0
     assert dt.second == 0
     assert dt.microsecond == 0
-    assert dt not in MISSING_SNAPSHOTS, f"Data is missing for {dt_str}"
+    assert dt not in MISSING_SNAPSHOTS_SET, f"Data is missing for {dt_str}"
 
 
 class TimeRange:
@@ -41,15 +40,19 @@ class TimeRange:
         stime (datetime): Start time of the range.
         etime (datetime): End time of the range.
         dt_all (pd.DatetimeIndex): All datetime objects in the range.
-        dt_valid (list[datetime]): Valid datetime objects excluding missing snapshots.
+        dt_valid (pd.DatetimeIndex): Valid datetime objects excluding missing snapshots.
     """
 
-    def __init__(self, stime: datetime, etime: datetime) -> None:
+    def __init__(
+        self, stime: datetime, etime: datetime, missing: pd.DatetimeIndex = None
+    ) -> None:
         """Initialize a TimeRange object.
 
         Args:
             stime (datetime): Start time of the range.
             etime (datetime): End time of the range.
+            missing (pd.DatetimeIndex, optional): More hours to leave out of
+                `dt_valid`, e.g. from `availability.missing_hours`.
 
         Raises:
             AssertionError: If the start or end time is invalid.
@@ -59,7 +62,9 @@ class TimeRange:
         self.stime = stime
         self.etime = etime
         self.dt_all = pd.date_range(self.stime, self.etime, freq="h")
-        self.dt_valid = [dt for dt in self.dt_all if dt not in MISSING_SNAPSHOTS]
+        self.dt_valid = self.dt_all[~self.dt_all.isin(MISSING_SNAPSHOTS_INDEX)]
+        if missing is not None:
+            self.dt_valid = self.dt_valid[~self.dt_valid.isin(missing)]
 
     def printbounds(self) -> str:
         """Return a string representation of the time range bounds.
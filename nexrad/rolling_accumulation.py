@@ -0,0 +1,498 @@
+"""
+Stream the hourly NetCDF4 files of a bounding box into n-hour accumulations and
+their annual maxima.
+
+Loading the full hourly stack of a bounding box to compute 3-, 6-, 24- or 72-hour
+accumulations takes memory in proportion to the length of the record. This script
+walks the hours in time order instead, and keeps only a ring buffer of the last
+`max(durations)` hours. For every hour, the running sum of each duration is updated
+by adding the new hour and subtracting the one that leaves the window, and the
+maxima of the year are updated where the new sums are larger. The memory use does
+not depend on the number of hours.
+
+Gaps are handled explicitly. The hours that are not in `TimeRange.dt_valid`, i.e.
+the known missing snapshots (`MISSING_SNAPSHOTS`) and the hours the archive does not
+have (`--missing-file`, one hour per line, as written by the workflow when it probes
+the archive), and cells without a valid value (NaN or negative) count as missing, and a window with
+more than `max_missing` missing hours in a cell is left out of the maxima of that
+cell. The hours before the start of the stream also count as missing, so the first
+windows are only complete once enough hours have been read. A window is attributed
+to the year of its last hour.
+
+The state is saved in a checkpoint after each year and at the end of a run. The
+next run resumes from the checkpoint with the hours that have arrived since. Without
+`--skip-absent`, the stream stops at the first valid hour whose file does not exist
+yet, so that the hour is not counted as missing for good.
+
+The output has the maximum accumulation of each year, duration and cell, the last
+hour of the window in which it occurred, the number of complete windows, and the
+number of hours streamed in the year (fewer than a full year for the first and
+current years).
+
+Example:
+    python rolling_accumulation.py --dirname /data/NEXRAD \
+        --bbox-name Houston_Woodlands_Galveston --etime 2024-12-31T23 \
+        --output /data/NEXRAD/Houston_Woodlands_Galveston_annual_maxima.nc
+"""
+
+import argparse
+import os
+from datetime import datetime
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from nexrad_utils.const import GAUGECORR_BEGINTIME
+from nexrad_utils.namingconventions import get_nc_fname_many
+from nexrad_utils.nexrad import TimeRange
+
+from util.instrument import file_size, job, span
+
+VARIABLE = "precipitation"
+DURATIONS = [3, 6, 24, 72]
+
+# the end time of a window that never occurred
+NO_HOUR = np.iinfo(np.int64).min
+
+
+def _hour_number(dt: datetime) -> int:
+    """Hours since 1970-01-01, which is how window end times are kept."""
+    return int(pd.Timestamp(dt).value // 3_600_000_000_000)
+
+
+class RollingAccumulator:
+    """Running n-hour sums over a stream of hourly fields, and their annual maxima.
+
+    Attributes:
+        durations (np.ndarray): The window lengths in hours.
+        max_missing (int): Windows with more missing hours in a cell are not
+            counted for that cell.
+        latitude (np.ndarray): Latitudes of the grid.
+        longitude (np.ndarray): Longitudes of the grid.
+        next_hour (pd.Timestamp): The hour that is expected next, or None before
+            the first hour.
+    """
+
+    def __init__(
+        self,
+        latitude: np.ndarray,
+        longitude: np.ndarray,
+        durations: Sequence[int] = DURATIONS,
+        max_missing: int = 0,
+    ) -> None:
+        """Start an empty stream, as if every earlier hour were missing.
+
+        Args:
+            latitude (np.ndarray): Latitudes of the grid.
+            longitude (np.ndarray): Longitudes of the grid.
+            durations (Sequence[int], optional): The window lengths in hours.
+            max_missing (int, optional): Missing hours allowed in a window.
+        """
+        self.durations = np.array(sorted(set(durations)), dtype=np.int64)
+        self.max_missing = int(max_missing)
+        self.latitude = np.asarray(latitude)
+        self.longitude = np.asarray(longitude)
+        self.next_hour = None
+        shape = (len(self.latitude), len(self.longitude))
+        n_dur = len(self.durations)
+
+        # the last max(durations) hours, and the slot of the next hour
+        self.ring = np.zeros((self.durations[-1],) + shape, dtype=np.float32)
+        self.ring_missing = np.ones((self.durations[-1],) + shape, dtype=bool)
+        self.position = 0
+        # the sum and the number of missing hours of each window ending now
+        self.sums = np.zeros((n_dur,) + shape, dtype=np.float64)
+        self.missing = np.broadcast_to(
+            self.durations[:, None, None], (n_dur,) + shape
+        ).astype(np.int32)
+
+        # the maxima of the current year
+        self.year = None
+        self.year_max = np.full((n_dur,) + shape, -np.inf, dtype=np.float64)
+        self.year_end = np.full((n_dur,) + shape, NO_HOUR, dtype=np.int64)
+        self.year_windows = np.zeros((n_dur,) + shape, dtype=np.int32)
+        self.year_hours = 0
+        # the maxima of the years before, by year
+        self.years: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray, int]] = {}
+
+    def push(self, dt: datetime, values: np.ndarray = None) -> None:
+        """Add the next hour to the stream.
+
+        Args:
+            dt (datetime): The hour, which must follow the previous one.
+            values (np.ndarray, optional): The precipitation on the grid, with NaN
+                or negative values where it is missing. None if the whole hour is
+                missing.
+
+        Raises:
+            ValueError: If the hour does not follow the previous one.
+        """
+        dt = pd.Timestamp(dt)
+        if self.next_hour is not None and dt != self.next_hour:
+            raise ValueError(f"Expected the hour {self.next_hour}, got {dt}")
+        if dt.year != self.year:
+            self._close_year()
+            self.year = dt.year
+
+        if values is None:
+            new_missing = np.ones(self.ring.shape[1:], dtype=bool)
+            new = np.zeros(self.ring.shape[1:], dtype=np.float32)
+        else:
+            new_missing = ~(values >= 0)  # also True for NaN
+            new = np.where(new_missing, 0, values).astype(np.float32)
+
+        # the hours that leave the window of each duration
+        leaving = (self.position - self.durations) % len(self.ring)
+        self.sums += new - self.ring[leaving]
+        self.missing += new_missing.astype(np.int32) - self.ring_missing[leaving]
+        self.ring[self.position] = new
+        self.ring_missing[self.position] = new_missing
+        self.position = (self.position + 1) % len(self.ring)
+
+        complete = self.missing <= self.max_missing
+        larger = complete & (self.sums > self.year_max)
+        self.year_max[larger] = self.sums[larger]
+        self.year_end[larger] = _hour_number(dt)
+        self.year_windows += complete
+        self.year_hours += 1
+        self.next_hour = dt + pd.Timedelta(hours=1)
+
+    def _close_year(self) -> None:
+        """Move the maxima of the current year to the finished years."""
+        if self.year is None:
+            return
+        self.years[self.year] = (
+            self.year_max.copy(),
+            self.year_end.copy(),
+            self.year_windows.copy(),
+            self.year_hours,
+        )
+        self.year_max.fill(-np.inf)
+        self.year_end.fill(NO_HOUR)
+        self.year_windows.fill(0)
+        self.year_hours = 0
+
+    def annual_maxima(self) -> xr.Dataset:
+        """The maxima of every year so far, including the current one.
+
+        Returns:
+            xr.Dataset: `max_accumulation` (mm, NaN without a complete window),
+                `max_end_time` (the last hour of the window), `n_windows` (the
+                number of complete windows) by year, duration, latitude and
+                longitude, and `n_hours` (the hours streamed) by year.
+        """
+        years = dict(self.years)
+        if self.year is not None:
+            years[self.year] = (
+                self.year_max,
+                self.year_end,
+                self.year_windows,
+                self.year_hours,
+            )
+        shape = (len(years), len(self.durations)) + self.ring.shape[1:]
+        maxima = np.full(shape, np.nan, dtype=np.float32)
+        ends = np.full(shape, np.datetime64("NaT"), dtype="datetime64[ns]")
+        windows = np.zeros(shape, dtype=np.int32)
+        hours = np.zeros(len(years), dtype=np.int32)
+        for i, year in enumerate(sorted(years)):
+            year_max, year_end, year_windows, year_hours = years[year]
+            found = year_end != NO_HOUR
+            maxima[i][found] = year_max[found]
+            ends[i][found] = year_end[found].astype("datetime64[h]")
+            windows[i] = year_windows
+            hours[i] = year_hours
+
+        dims = ("year", "duration", "latitude", "longitude")
+        return xr.Dataset(
+            {
+                "max_accumulation": (dims, maxima, {"units": "mm"}),
+                "max_end_time": (dims, ends),
+                "n_windows": (dims, windows),
+                "n_hours": ("year", hours),
+            },
+            coords={
+                "year": sorted(years),
+                "duration": ("duration", self.durations, {"units": "hours"}),
+                "latitude": self.latitude,
+                "longitude": self.longitude,
+            },
+            attrs={"max_missing": self.max_missing},
+        )
+
+    def save(self, path: str) -> None:
+        """Save the state to a checkpoint, replacing it only once it is complete.
+
+        Args:
+            path (str): Path to the `.npz` checkpoint.
+        """
+        years = sorted(self.years)
+        state = {
+            "durations": self.durations,
+            "max_missing": self.max_missing,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "next_hour": np.datetime64(self.next_hour, "h"),
+            "ring": self.ring,
+            "ring_missing": self.ring_missing,
+            "position": self.position,
+            "sums": self.sums,
+            "missing": self.missing,
+            "year": -1 if self.year is None else self.year,
+            "year_max": self.year_max,
+            "year_end": self.year_end,
+            "year_windows": self.year_windows,
+            "year_hours": self.year_hours,
+            "years": np.array(years, dtype=np.int64),
+        }
+        for name, i in [("max", 0), ("end", 1), ("windows", 2), ("hours", 3)]:
+            state[f"years_{name}"] = np.array([self.years[year][i] for year in years])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".part", "wb") as f:
+            np.savez(f, **state)
+        os.replace(path + ".part", path)
+
+    @classmethod
+    def load(cls, path: str) -> "RollingAccumulator":
+        """Resume from a checkpoint saved by `save`.
+
+        Args:
+            path (str): Path to the `.npz` checkpoint.
+
+        Returns:
+            RollingAccumulator: The stream, expecting the hour after the last one
+                saved.
+        """
+        with np.load(path) as state:
+            acc = cls(
+                state["latitude"],
+                state["longitude"],
+                state["durations"],
+                int(state["max_missing"]),
+            )
+            acc.next_hour = pd.Timestamp(state["next_hour"].item())
+            acc.ring = state["ring"]
+            acc.ring_missing = state["ring_missing"]
+            acc.position = int(state["position"])
+            acc.sums = state["sums"]
+            acc.missing = state["missing"]
+            acc.year = None if int(state["year"]) < 0 else int(state["year"])
+            acc.year_max = state["year_max"]
+            acc.year_end = state["year_end"]
+            acc.year_windows = state["year_windows"]
+            acc.year_hours = int(state["year_hours"])
+            for i, year in enumerate(state["years"]):
+                acc.years[int(year)] = (
+                    state["years_max"][i],
+                    state["years_end"][i],
+                    state["years_windows"][i],
+                    int(state["years_hours"][i]),
+                )
+        return acc
+
+
+def _read_hour(fname: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Read the precipitation, latitudes and longitudes of an hourly file."""
+    with xr.open_dataset(fname, decode_timedelta=False) as ds:
+        return (
+            ds[VARIABLE].values,
+            ds["latitude"].values,
+            ds["longitude"].values,
+        )
+
+
+def accumulate_bbox(
+    dirname: str,
+    bbox_name: str,
+    trange: TimeRange,
+    output: str,
+    checkpoint: str = None,
+    durations: Sequence[int] = DURATIONS,
+    max_missing: int = 0,
+    skip_absent: bool = False,
+    restart: bool = False,
+) -> RollingAccumulator:
+    """Stream the hourly files of a bounding box and write the annual maxima.
+
+    The stream resumes from the checkpoint if there is one, at the hour after the
+    last one it holds, and stops at the end of the time range or at the first hour
+    of `trange.dt_valid` whose file does not exist. The other hours of the time
+    range are gaps.
+
+    Args:
+        dirname (str): The NEXRAD data directory.
+        bbox_name (str): The bounding box, whose hourly files are below
+            `{dirname}/{bbox_name}`.
+        trange (TimeRange): The hours to stream. Its start is only used when
+            there is no checkpoint. Hours that are not in `dt_valid` are gaps.
+        output (str): Path to the NetCDF4 file of annual maxima.
+        checkpoint (str, optional): Path to the checkpoint; by default next to
+            the output.
+        durations (Sequence[int], optional): The window lengths in hours.
+        max_missing (int, optional): Missing hours allowed in a window.
+        skip_absent (bool, optional): Count hours whose file does not exist as
+            missing instead of stopping there.
+        restart (bool, optional): Ignore the checkpoint and start over.
+
+    Returns:
+        RollingAccumulator: The stream at the last hour read.
+
+    Raises:
+        ValueError: If the checkpoint was made with other durations, another
+            `max_missing` or another grid.
+
+    Example:
+        accumulate_bbox(
+            "/data/NEXRAD",
+            "Houston_Woodlands_Galveston",
+            TimeRange(datetime(2017, 1, 1), datetime(2017, 12, 31, 23)),
+            "/data/NEXRAD/Houston_Woodlands_Galveston_annual_maxima.nc",
+        )
+    """
+    checkpoint = checkpoint or os.path.splitext(output)[0] + ".checkpoint.npz"
+    acc = None
+    if os.path.exists(checkpoint) and not restart:
+        acc = RollingAccumulator.load(checkpoint)
+        if acc.durations.tolist() != sorted(set(durations)):
+            raise ValueError(
+                f"{checkpoint} has the durations {acc.durations.tolist()}; "
+                "use --restart to start over with other durations"
+            )
+        if acc.max_missing != max_missing:
+            raise ValueError(
+                f"{checkpoint} has max_missing={acc.max_missing}; "
+                "use --restart to start over with another value"
+            )
+    stime = trange.stime if acc is None else acc.next_hour
+    dts = pd.date_range(stime, trange.etime, freq="h")
+    fnames = get_nc_fname_many(dts, dirname=dirname, bbox_name=bbox_name)
+    is_gap = dts.isin(trange.dt_all[~trange.dt_all.isin(trange.dt_valid)])
+
+    n_read = n_gaps = 0
+    for day, hours in pd.Series(np.arange(len(dts)), index=dts).groupby(
+        dts.strftime("%Y-%m-%d")
+    ):
+        fields = {}
+        stop = False
+        with span("read", day=day) as read:
+            for dt, i in hours.items():
+                if is_gap[i]:
+                    fields[dt] = None
+                elif os.path.exists(fnames[i]):
+                    values, latitude, longitude = _read_hour(fnames[i])
+                    read.bytes_in += file_size(fnames[i])
+                    if acc is None:
+                        acc = RollingAccumulator(
+                            latitude, longitude, durations, max_missing
+                        )
+                    elif values.shape != acc.ring.shape[1:] or not (
+                        np.allclose(latitude, acc.latitude)
+                        and np.allclose(longitude, acc.longitude)
+                    ):
+                        raise ValueError(
+                            f"The grid of {fnames[i]} differs from that of the "
+                            "checkpoint; use --restart to start over"
+                        )
+                    fields[dt] = values
+                elif skip_absent:
+                    fields[dt] = None
+                else:
+                    stop = True
+                    break
+        # hours before the first file are skipped, since the grid is not known
+        if acc is not None:
+            with span("update", day=day):
+                for dt, values in fields.items():
+                    acc.push(dt, values)
+                    n_read += values is not None
+                    n_gaps += values is None
+            if (acc.next_hour.month, acc.next_hour.day, acc.next_hour.hour) == (
+                1,
+                1,
+                0,
+            ):
+                acc.save(checkpoint)
+        if stop:
+            break
+
+    if acc is None:
+        print(f"{bbox_name}: no hourly files from {stime}")
+        return None
+    acc.save(checkpoint)
+    with span("write") as write:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        acc.annual_maxima().to_netcdf(output + ".part", format="NETCDF4")
+        os.replace(output + ".part", output)
+        write.bytes_out = file_size(output)
+    print(
+        f"{bbox_name}: {n_read} hours read, {n_gaps} missing, "
+        f"up to {acc.next_hour - pd.Timedelta(hours=1)}"
+    )
+    return acc
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stream hourly NetCDF4 files into n-hour accumulations and their annual maxima."
+    )
+    parser.add_argument("--dirname", required=True, help="The NEXRAD data directory.")
+    parser.add_argument("--bbox-name", required=True, help="The bounding box.")
+    parser.add_argument(
+        "--output", required=True, help="NetCDF4 file of the annual maxima."
+    )
+    parser.add_argument(
+        "--checkpoint", help="Checkpoint file, by default next to the output."
+    )
+    parser.add_argument(
+        "--stime",
+        type=datetime.fromisoformat,
+        default=GAUGECORR_BEGINTIME,
+        help="First hour, if there is no checkpoint.",
+    )
+    parser.add_argument(
+        "--etime", type=datetime.fromisoformat, required=True, help="Last hour."
+    )
+    parser.add_argument(
+        "--durations",
+        type=int,
+        nargs="+",
+        default=DURATIONS,
+        help="Window lengths in hours.",
+    )
+    parser.add_argument(
+        "--max-missing",
+        type=int,
+        default=0,
+        help="Missing hours allowed in a window.",
+    )
+    parser.add_argument(
+        "--skip-absent",
+        action="store_true",
+        help="Count hours without a file as missing instead of stopping there.",
+    )
+    parser.add_argument(
+        "--missing-file",
+        help="Text file of hours the archive does not have, one per line, e.g. "
+        "2020-10-13T19; they are gaps like the missing snapshots.",
+    )
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint.")
+    args = parser.parse_args()
+
+    missing = None
+    if args.missing_file:
+        with open(args.missing_file) as f:
+            missing = pd.DatetimeIndex(pd.to_datetime(f.read().split()))
+
+    with job("rolling_accumulation", bbox=args.bbox_name):
+        accumulate_bbox(
+            dirname=args.dirname,
+            bbox_name=args.bbox_name,
+            trange=TimeRange(args.stime, args.etime, missing=missing),
+            output=args.output,
+            checkpoint=args.checkpoint,
+            durations=args.durations,
+            max_missing=args.max_missing,
+            skip_absent=args.skip_absent,
+            restart=args.restart,
+        )
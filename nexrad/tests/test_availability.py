@@ -0,0 +1,125 @@
+"""
+Tests of `nexrad_utils.availability` against a local copy of the archive layout.
+
+The archive is a temporary directory served by `http.server`, with an empty file for
+each hour that is available. Run from the repository root:
+
+    python -m pytest nexrad/tests
+"""
+
+import functools
+import os
+import threading
+from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from nexrad_utils import availability
+from nexrad_utils.const import MULTISENSOR_BEGINTIME
+from nexrad_utils.namingconventions import get_url_many
+from nexrad_utils.nexrad import TimeRange
+
+# four days around the switch from GaugeCorr to MultiSensor on 2020-10-13 19:00
+TRANGE = TimeRange(datetime(2020, 10, 12, 0), datetime(2020, 10, 15, 23))
+
+# hours that the archive does not have, on top of the missing day
+DROPPED = pd.DatetimeIndex(
+    ["2020-10-12 05:00", "2020-10-13 18:00", "2020-10-13 20:00", "2020-10-14 23:00"]
+)
+
+# a day without any directory, so that its listings are 404
+MISSING_DAY = "2020-10-15"
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    """Serve a directory, and count the requests."""
+
+    requests = 0
+
+    def do_GET(self) -> None:
+        type(self).requests += 1
+        super().do_GET()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def make_archive(root: str) -> pd.DatetimeIndex:
+    """Create the files of the available hours, and return them."""
+    dts = TRANGE.dt_all
+    available = dts[~dts.isin(DROPPED) & (dts.strftime("%Y-%m-%d") != MISSING_DAY)]
+    for url in get_url_many(available, base_url=root):
+        os.makedirs(os.path.dirname(url), exist_ok=True)
+        open(url, "w").close()
+    # the old product goes on after the switch, but is not what the plan uses
+    day = MULTISENSOR_BEGINTIME.replace(hour=0)
+    decoy = availability.listing_url(day, "GaugeCorr_QPE_01H", root)
+    open(f"{decoy}GaugeCorr_QPE_01H_00.00_20201013-200000.grib2.gz", "w").close()
+    return available
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """Serve a copy of the archive layout, and return its URL and request counter."""
+    root = str(tmp_path / "archive")
+    make_archive(root)
+    handler = type("Handler", (CountingHandler,), {"requests": 0})
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(handler, directory=root)
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", handler
+    server.shutdown()
+    server.server_close()
+
+
+def test_missing_hours(archive, tmp_path):
+    """Dropped hours, the product switch and a missing day are all found."""
+    base_url, handler = archive
+    missing = availability.missing_hours(
+        TRANGE, str(tmp_path / "cache.sqlite"), base_url=base_url, max_workers=4
+    )
+    expected = DROPPED.union(pd.date_range(MISSING_DAY, periods=24, freq="h"))
+    assert missing.equals(expected)
+    # the decoy of the old product does not make 20:00 available
+    assert pd.Timestamp("2020-10-13 20:00") in missing
+    # one listing per day, and two on the day of the switch
+    assert handler.requests == 5
+
+
+def test_cached_rerun(archive, tmp_path):
+    """A second run reads the cache, and a mirror does not share its listings."""
+    base_url, handler = archive
+    cache_path = str(tmp_path / "cache.sqlite")
+    first = availability.missing_hours(TRANGE, cache_path, base_url=base_url)
+    assert handler.requests == 5
+
+    again = availability.missing_hours(TRANGE, cache_path, base_url=base_url)
+    assert again.equals(first)
+    assert handler.requests == 5
+
+    # the same server under another name counts as another mirror
+    mirror = base_url.replace("127.0.0.1", "localhost")
+    availability.missing_hours(TRANGE, cache_path, base_url=mirror)
+    assert handler.requests == 10
+
+    # these days are settled by now, so they are kept even without a TTL
+    availability.missing_hours(TRANGE, cache_path, base_url=base_url, ttl_hours=0)
+    assert handler.requests == 10
+
+    availability.missing_hours(TRANGE, cache_path, base_url=base_url, refresh=True)
+    assert handler.requests == 15
+
+
+def test_time_range_without_missing(archive, tmp_path):
+    """The missing hours are left out of `dt_valid`."""
+    base_url, _ = archive
+    missing = availability.missing_hours(
+        TRANGE, str(tmp_path / "cache.sqlite"), base_url=base_url
+    )
+    trange = TimeRange(TRANGE.stime, TRANGE.etime, missing=missing)
+    assert len(trange.dt_valid) == len(TRANGE.dt_all) - len(missing)
+    assert not trange.dt_valid.isin(missing).any()
@@ -0,0 +1,157 @@
+"""
+Tests of `nexrad_utils.download` against a local stand-in for the archive.
+
+The server is `http.server` on a free port. It answers each path from a table of
+responses, so that a test can make a file fail before it succeeds, or cut a body
+short. Run from the repository root:
+
+    python -m pytest nexrad/tests
+"""
+
+import gzip
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import pytest
+
+from nexrad_utils.download import download_file, download_many
+from nexrad_utils.namingconventions import get_url_many
+from nexrad_utils.nexrad import TimeRange
+
+# the decompressed content of a file, large enough to span several blocks
+DATA = bytes(range(256)) * 8192
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Answer each path with the next of its responses, and count the requests.
+
+    `responses` maps a path to a list of `(status, body, length)`, where `length`
+    is the Content-Length to announce (None for the length of the body). The last
+    response of a path is repeated once the others are used up.
+    """
+
+    responses = {}
+    requests = {}
+
+    def do_GET(self) -> None:
+        n = self.requests.get(self.path, 0)
+        self.requests[self.path] = n + 1
+        answers = self.responses.get(self.path, [(404, b"", None)])
+        status, body, length = answers[min(n, len(answers) - 1)]
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body) if length is None else length))
+        self.end_headers()
+        self.wfile.write(body)
+        if length is not None and length != len(body):
+            # the body is cut off, so the connection cannot be reused
+            self.close_connection = True
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server():
+    """Serve the responses of a test, and return the root URL and the handler."""
+    handler = type("Handler", (ArchiveHandler,), {"responses": {}, "requests": {}})
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}", handler
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retry_after_server_error(server, tmp_path):
+    """A 503 is retried, and the file is saved decompressed."""
+    base_url, handler = server
+    handler.responses["/a.grib2.gz"] = [
+        (503, b"busy", None),
+        (200, gzip.compress(DATA), None),
+    ]
+    outfile = tmp_path / "a.grib2"
+    download_file(f"{base_url}/a.grib2.gz", str(outfile), retries=2, backoff=0)
+    assert outfile.read_bytes() == DATA
+    assert handler.requests["/a.grib2.gz"] == 2
+
+
+@pytest.mark.parametrize("announced", ["honest", "longer"])
+def test_truncated_body(server, tmp_path, announced):
+    """A body that is cut off leaves neither the file nor a partial file behind."""
+    base_url, handler = server
+    body = gzip.compress(DATA)[:-100]
+    length = None if announced == "honest" else len(body) + 100
+    handler.responses["/a.grib2.gz"] = [(200, body, length)]
+    with pytest.raises((OSError, http.client.HTTPException, zlib.error)):
+        download_file(
+            f"{base_url}/a.grib2.gz", str(tmp_path / "a.grib2"), retries=1, backoff=0
+        )
+    assert os.listdir(tmp_path) == []
+    assert handler.requests["/a.grib2.gz"] == 2
+
+
+def test_existing_files_are_skipped(server, tmp_path):
+    """Files that already exist are neither requested nor replaced."""
+    base_url, handler = server
+    handler.responses["/a.grib2.gz"] = [(200, gzip.compress(DATA), None)]
+    handler.responses["/b.grib2.gz"] = [(200, gzip.compress(DATA), None)]
+    (tmp_path / "a.grib2").write_bytes(b"old")
+    failed = download_many(
+        [f"{base_url}/a.grib2.gz", f"{base_url}/b.grib2.gz"],
+        [str(tmp_path / "a.grib2"), str(tmp_path / "b.grib2")],
+        max_workers=2,
+        progress=False,
+    )
+    assert failed == []
+    assert (tmp_path / "a.grib2").read_bytes() == b"old"
+    assert (tmp_path / "b.grib2").read_bytes() == DATA
+    assert "/a.grib2.gz" not in handler.requests
+
+
+def test_download_many_reports_failures(server, tmp_path):
+    """The files that still fail after the retries are returned, the others saved."""
+    base_url, handler = server
+    handler.responses["/a.grib2.gz"] = [(200, gzip.compress(DATA), None)]
+    handler.responses["/b.grib2.gz"] = [(500, b"", None)]
+    outfiles = [str(tmp_path / name) for name in ["a.grib2", "b.grib2", "c.grib2"]]
+    failed = download_many(
+        [f"{base_url}/{name}.grib2.gz" for name in "abc"],
+        outfiles,
+        max_workers=2,
+        progress=False,
+        retries=1,
+        backoff=0,
+    )
+    assert failed == outfiles[1:]
+    assert sorted(os.listdir(tmp_path)) == ["a.grib2"]
+    # the 404 is not retried, the 500 is
+    assert handler.requests["/c.grib2.gz"] == 1
+    assert handler.requests["/b.grib2.gz"] == 2
+
+
+def test_cli_skips_missing_hours(server, tmp_path):
+    """The hours in `--missing-file` are neither requested nor counted as failed."""
+    base_url, handler = server
+    trange = TimeRange(datetime(2020, 10, 14, 0), datetime(2020, 10, 14, 3))
+    paths = [urlsplit(url).path for url in get_url_many(trange, base_url=base_url)]
+    for path in paths[:2] + paths[3:]:
+        handler.responses[path] = [(200, gzip.compress(DATA), None)]
+    missing_file = tmp_path / "missing.txt"
+    missing_file.write_text("2020-10-14T02\n")
+    dirname = tmp_path / "NEXRAD"
+    subprocess.run(
+        [sys.executable, "-m", "nexrad_utils.download"]
+        + ["--stime", "2020-10-14T00", "--etime", "2020-10-14T03"]
+        + ["--dirname", str(dirname), "--base-url", base_url]
+        + ["--missing-file", str(missing_file), "--retries", "0"],
+        check=True,
+    )
+    assert paths[2] not in handler.requests
+    assert sum(len(files) for _, _, files in os.walk(dirname)) == 3
@@ -0,0 +1,374 @@
+"""
+Record how long each phase of a download or conversion job takes.
+
+A job is wrapped in `job(...)`, and its phases in `span(...)`. When a span ends, one
+JSON line is appended to the metrics file, `logs/metrics.jsonl` by default, with its
+wall time, bytes read and written, and the peak resident memory of the process so
+far. When the job ends, a line with its total wall and CPU time is added. Only the
+standard library is used, so any environment can import this module.
+
+Environment variables:
+    CLIMATEDATA_METRICS: Path of the metrics file. Set it to "off" to record
+        nothing.
+    CLIMATEDATA_RUN: A label for the current workflow run, added to every line.
+        The Snakefile sets it once per `snakemake` call.
+    CLIMATEDATA_PROFILE: "cprofile" or "pyinstrument" to profile each job. The
+        profiles are saved in a `profiles` directory next to the metrics file.
+
+Example:
+    from util.instrument import job, span
+
+    with job("grib2_to_netcdf4", n_files=24):
+        with span("decode", bytes_in=os.path.getsize(input_file)):
+            ds = open_grib2(input_file).load()
+
+    # the slowest phases of the last run
+    python -m util.instrument --metrics logs/metrics.jsonl
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+METRICS_ENV = "CLIMATEDATA_METRICS"
+RUN_ENV = "CLIMATEDATA_RUN"
+PROFILE_ENV = "CLIMATEDATA_PROFILE"
+
+# the metrics file when CLIMATEDATA_METRICS is not set
+DEFAULT_METRICS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "logs",
+    "metrics.jsonl",
+)
+
+# the job that the spans of this process belong to
+_JOB: Dict = {}
+
+# warn only once if the metrics file cannot be written
+_WARNED = []
+
+
+def metrics_path() -> Optional[str]:
+    """The metrics file, or None if recording is switched off."""
+    path = os.environ.get(METRICS_ENV, DEFAULT_METRICS)
+    return None if path.lower() in ("", "off") else path
+
+
+def peak_rss_mb() -> Optional[float]:
+    """The peak resident memory of this process so far, in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def file_size(path: str) -> int:
+    """The size of a file in bytes, or 0 if it does not exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _write(record: Dict) -> None:
+    """Append a record to the metrics file, without ever failing the job."""
+    path = metrics_path()
+    if path is None:
+        return
+    record = {
+        "time": datetime.now().isoformat(timespec="milliseconds"),
+        "run": os.environ.get(RUN_ENV),
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        **record,
+    }
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+    except OSError as e:
+        if not _WARNED:
+            print(f"Cannot write metrics to {path}: {e}", file=sys.stderr)
+            _WARNED.append(path)
+
+
+class Span:
+    """A timed phase of a job.
+
+    Attributes:
+        name (str): The phase, e.g. "decode".
+        bytes_in (int): Bytes read during the phase.
+        bytes_out (int): Bytes written during the phase.
+        attrs (Dict): Other values to record, e.g. the file name.
+    """
+
+    def __init__(self, name: str, bytes_in: int = 0, bytes_out: int = 0, **attrs):
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.attrs = attrs
+
+
+@contextmanager
+def span(name: str, bytes_in: int = 0, bytes_out: int = 0, **attrs) -> Iterator[Span]:
+    """Time a phase of the current job and record it when it ends.
+
+    The byte counts can also be set on the yielded `Span`, once they are known.
+
+    Args:
+        name (str): The phase, e.g. "decode" or "cds_queue".
+        bytes_in (int, optional): Bytes read during the phase.
+        bytes_out (int, optional): Bytes written during the phase.
+        **attrs: Other values to record, e.g. `file="input.grib2"`.
+
+    Yields:
+        Span: The phase.
+
+    Example:
+        with span("write", file=output_file) as s:
+            write_netcdf(da, output_file)
+            s.bytes_out = file_size(output_file)
+    """
+    current = Span(name, bytes_in, bytes_out, **attrs)
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _write(
+            {
+                "type": "span",
+                "job": _JOB.get("name"),
+                "job_id": _JOB.get("id"),
+                "span": current.name,
+                "wall_s": time.perf_counter() - start,
+                "bytes_in": current.bytes_in,
+                "bytes_out": current.bytes_out,
+                "peak_rss_mb": peak_rss_mb(),
+                "status": status,
+                **current.attrs,
+            }
+        )
+
+
+def _start_profiler(kind: str):
+    """Start a cProfile or pyinstrument profiler, or return None."""
+    if kind == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        except ImportError:
+            print("pyinstrument is not installed, using cProfile", file=sys.stderr)
+            kind = "cprofile"
+    if kind == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    return None
+
+
+def _save_profile(profiler, job_id: str) -> Optional[str]:
+    """Stop a profiler and save it next to the metrics file."""
+    path = metrics_path() or DEFAULT_METRICS
+    profile_dir = os.path.join(os.path.dirname(os.path.abspath(path)), "profiles")
+    os.makedirs(profile_dir, exist_ok=True)
+    if hasattr(profiler, "output_html"):
+        profiler.stop()
+        fname = os.path.join(profile_dir, f"{job_id}.html")
+        with open(fname, "w") as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        fname = os.path.join(profile_dir, f"{job_id}.prof")
+        profiler.dump_stats(fname)
+    return fname
+
+
+@contextmanager
+def job(name: str, **attrs) -> Iterator[Span]:
+    """Time a whole job, such as one run of a script, and record it when it ends.
+
+    Spans inside the job, also in worker processes forked from it, are recorded with
+    its name and ID. With `CLIMATEDATA_PROFILE` set, the job is also profiled.
+
+    Args:
+        name (str): The job, usually the name of the script.
+        **attrs: Other values to record, e.g. `year=2020`.
+
+    Yields:
+        Span: The job, whose byte counts can be set like those of a span.
+
+    Example:
+        with job("download_era5_single_level", variable="2m_temperature"):
+            download_era5_single_level(...)
+    """
+    job_id = f"{name}-{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+    _JOB.update(name=name, id=job_id)
+    profiler = _start_profiler(os.environ.get(PROFILE_ENV, "").lower())
+    current = Span(name, **attrs)
+    status = "ok"
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield current
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        profile = _save_profile(profiler, job_id) if profiler is not None else None
+        children = None
+        if resource is not None:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _write(
+            {
+                "type": "job",
+                "job": name,
+                "job_id": job_id,
+                "wall_s": time.perf_counter() - start,
+                "cpu_s": time.process_time()
+                - cpu_start
+                + (children.ru_utime + children.ru_stime if children else 0),
+                "bytes_in": current.bytes_in,
+                "bytes_out": current.bytes_out,
+                "peak_rss_mb": peak_rss_mb(),
+                "status": status,
+                "profile": profile,
+                **current.attrs,
+            }
+        )
+        _JOB.clear()
+
+
+def read_metrics(path: str, run: str = "last") -> List[Dict]:
+    """Read the records of a metrics file.
+
+    Args:
+        path (str): The metrics file.
+        run (str, optional): Only keep this run; "last" for the run of the last
+            record, "all" for every record.
+
+    Returns:
+        List[Dict]: The records.
+    """
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if run == "last" and records:
+        run = records[-1].get("run")
+    elif run == "all":
+        return records
+    return [record for record in records if record.get("run") == run]
+
+
+def summarize(records: List[Dict], top: int = 20) -> List[Dict]:
+    """Add up the time spent in each phase of each job, slowest first.
+
+    Args:
+        records (List[Dict]): Records from `read_metrics`.
+        top (int, optional): Number of phases to keep.
+
+    Returns:
+        List[Dict]: For each job and phase, the number of calls, total, mean and
+            maximum wall time, share of the wall time of the job (phases run in
+            parallel can add up to more than 100%), bytes in and out, throughput
+            and peak memory.
+    """
+    groups = defaultdict(list)
+    job_totals = defaultdict(float)
+    for record in records:
+        if record["type"] == "job":
+            job_totals[record["job"]] += record["wall_s"]
+            groups[(record["job"], "(job)")].append(record)
+        else:
+            groups[(record["job"], record["span"])].append(record)
+
+    rows = []
+    for (job_name, span_name), group in groups.items():
+        wall = [record["wall_s"] for record in group]
+        nbytes = sum(
+            (record.get("bytes_in") or 0) + (record.get("bytes_out") or 0)
+            for record in group
+        )
+        rss = [record["peak_rss_mb"] for record in group if record.get("peak_rss_mb")]
+        rows.append(
+            {
+                "job": job_name,
+                "span": span_name,
+                "calls": len(group),
+                "total_s": sum(wall),
+                "mean_s": sum(wall) / len(wall),
+                "max_s": max(wall),
+                "share": (
+                    sum(wall) / job_totals[job_name] if job_totals[job_name] else None
+                ),
+                "mb_in": sum(record.get("bytes_in") or 0 for record in group) / 1e6,
+                "mb_out": sum(record.get("bytes_out") or 0 for record in group) / 1e6,
+                "mb_per_s": nbytes / 1e6 / sum(wall) if sum(wall) else None,
+                "peak_rss_mb": max(rss) if rss else None,
+                "errors": sum(record.get("status") == "error" for record in group),
+            }
+        )
+    rows.sort(key=lambda row: -row["total_s"])
+    # the slowest phases, then the whole jobs they belong to
+    phases = [row for row in rows if row["span"] != "(job)"][:top]
+    return phases + [row for row in rows if row["span"] == "(job)"]
+
+
+def _format(value, fmt: str) -> str:
+    """Format a number for the summary table, with "-" for None."""
+    return "-" if value is None else format(value, fmt)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Show where the time of a workflow run was spent."
+    )
+    parser.add_argument(
+        "--metrics",
+        default=metrics_path() or DEFAULT_METRICS,
+        help="The metrics file.",
+    )
+    parser.add_argument(
+        "--run",
+        default="last",
+        help='The run to summarize, "last" (default) or "all".',
+    )
+    parser.add_argument("--top", type=int, default=20, help="Number of phases to show.")
+    args = parser.parse_args()
+
+    records = read_metrics(args.metrics, args.run)
+    runs = sorted({str(record.get("run")) for record in records})
+    print(f"{len(records)} records of run {', '.join(runs) or '-'}")
+    print(
+        f"{'job':<28}{'phase':<16}{'calls':>7}{'total s':>10}{'mean s':>9}"
+        f"{'max s':>9}{'share':>7}{'MB in':>9}{'MB out':>9}{'MB/s':>8}{'RSS MB':>8}"
+    )
+    for row in summarize(records, args.top):
+        print(
+            f"{row['job'] or '-':<28.28}{row['span']:<16.16}{row['calls']:>7}"
+            f"{row['total_s']:>10.2f}{row['mean_s']:>9.3f}{row['max_s']:>9.2f}"
+            f"{_format(row['share'], '.0%'):>7}{row['mb_in']:>9.1f}"
+            f"{row['mb_out']:>9.1f}{_format(row['mb_per_s'], '.1f'):>8}"
+            f"{_format(row['peak_rss_mb'], '.0f'):>8}"
+            + (f"  {row['errors']} failed" if row["errors"] else "")
+        )
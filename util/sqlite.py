@@ -0,0 +1,41 @@
+"""
+Open the small local SQLite databases that record the state of the workflow.
+
+The NEXRAD manifest (`nexrad_utils.manifest`), the cache of archive listings
+(`nexrad_utils.availability`), the GHCNd manifest (`ghcnd_utils.manifest`) and the
+integrity cache (`util.verify`) all open one short connection per transaction, with
+`connect`, instead of keeping one open.
+
+Example:
+    from util.sqlite import connect
+
+    with connect(".nexrad_manifest.sqlite") as conn:
+        conn.execute("SELECT COUNT(*) FROM hours").fetchone()
+"""
+
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def connect(path: str, timeout: float = 60.0) -> Iterator[sqlite3.Connection]:
+    """Open a connection for one transaction, and close it afterwards.
+
+    The transaction is committed if the block succeeds and rolled back otherwise.
+    The connection waits for other writers instead of failing, since several jobs
+    may write to the same database at the same time.
+
+    Args:
+        path (str): Path to the SQLite database. It should be on a local disk.
+        timeout (float, optional): Seconds to wait for a lock held by another writer.
+
+    Yields:
+        sqlite3.Connection: The open connection.
+    """
+    conn = sqlite3.connect(path, timeout=timeout)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
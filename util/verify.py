@@ -0,0 +1,504 @@
+"""
+Find corrupt GRIB and NetCDF files in the data directories without decoding them.
+
+A `curl | gunzip` that is cut off or a CDS download that is interrupted can leave a
+truncated file behind, which only fails later inside `xr.open_dataarray`. Opening
+every file to find them takes hours. This module only reads the few bytes that say
+how long a file should be:
+
+- GRIB: every message starts with `GRIB` and its total length, and ends with
+  `7777`. For GRIB2, the section lengths must also add up to the message length.
+- NetCDF4 / HDF5: the superblock starts with the HDF5 signature and gives the end
+  of file address, which the file size must reach.
+- NetCDF3 (classic, 64-bit offset and CDF-5): the header lists every variable with
+  its offset and size, and the number of records, so the size of the file is known.
+
+Files are checked over a pool of processes. The results are cached in a small
+SQLite database keyed by path, size and modification time, so a rescan only checks
+the files that are new or have changed. Directories ending in `.zarr` and hidden
+directories are not scanned.
+
+The corrupt files are printed and written to a list that can be passed back to
+Snakemake to produce them again.
+
+Example:
+    python -m util.verify --cache .integrity_cache.sqlite --workers 8 \
+        --output logs/corrupt_files.txt /data/NEXRAD /data/ERA5
+
+    # produce the corrupt files again
+    snakemake --use-conda --cores all --force $(cat logs/corrupt_files.txt)
+"""
+
+import argparse
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple
+
+from .instrument import job, span
+from .sqlite import connect
+
+OK = "ok"
+CORRUPT = "corrupt"
+
+GRIB_SUFFIXES = (".grib2", ".grib", ".grb2", ".grb")
+NETCDF_SUFFIXES = (".nc", ".nc4", ".h5", ".hdf5")
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+# sizes in bytes of the NetCDF3 types, by type number
+NC_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+# tags of the lists in a NetCDF3 header
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    checked TEXT NOT NULL
+)
+"""
+
+
+class CorruptFile(Exception):
+    """A file whose structure does not match its size."""
+
+
+def _read(f: BinaryIO, n: int, what: str) -> bytes:
+    """Read exactly `n` bytes, or raise `CorruptFile` saying that `what` is cut off."""
+    data = f.read(n)
+    if len(data) < n:
+        raise CorruptFile(f"{what} is cut off")
+    return data
+
+
+def check_grib(f: BinaryIO, size: int) -> None:
+    """Check that a file is a sequence of complete GRIB messages.
+
+    Args:
+        f (BinaryIO): The open file.
+        size (int): The size of the file in bytes.
+
+    Raises:
+        CorruptFile: If a message is cut off or malformed.
+    """
+    offset = 0
+    n_messages = 0
+    while offset < size:
+        f.seek(offset)
+        header = f.read(16)
+        if header[:4] != b"GRIB":
+            if n_messages and not header.strip(b"\x00"):
+                break  # padding after the last message
+            raise CorruptFile(f"no GRIB message at byte {offset}")
+        if len(header) < 8:
+            raise CorruptFile(f"message at byte {offset} is cut off")
+        edition = header[7]
+        if edition == 2:
+            if len(header) < 16:
+                raise CorruptFile(f"message at byte {offset} is cut off")
+            length = struct.unpack(">Q", header[8:16])[0]
+            first_section = offset + 16
+        elif edition == 1:
+            length = int.from_bytes(header[4:7], "big")
+            first_section = None
+        else:
+            raise CorruptFile(f"unknown GRIB edition {edition} at byte {offset}")
+        end = offset + length
+        if end > size:
+            raise CorruptFile(
+                f"message at byte {offset} needs {length} bytes, "
+                f"only {size - offset} left"
+            )
+
+        if first_section is not None:
+            # walk the sections up to the end marker
+            position = first_section
+            while position < end - 4:
+                f.seek(position)
+                section = f.read(5)
+                if len(section) < 5:
+                    raise CorruptFile(f"section at byte {position} is cut off")
+                section_length = struct.unpack(">I", section[:4])[0]
+                if section_length < 5:
+                    raise CorruptFile(f"bad section length at byte {position}")
+                position += section_length
+            if position != end - 4:
+                raise CorruptFile(
+                    f"sections of the message at byte {offset} overrun its end"
+                )
+        f.seek(end - 4)
+        if f.read(4) != b"7777":
+            raise CorruptFile(f"message at byte {offset} has no 7777 end marker")
+        offset = end
+        n_messages += 1
+    if not n_messages:
+        raise CorruptFile("empty file")
+
+
+def check_hdf5(f: BinaryIO, size: int) -> None:
+    """Check that an HDF5 (NetCDF4) file is as long as its superblock says.
+
+    Args:
+        f (BinaryIO): The open file.
+        size (int): The size of the file in bytes.
+
+    Raises:
+        CorruptFile: If there is no superblock or the file is cut off.
+    """
+    # the superblock is at byte 0, or after a user block of 512, 1024, ... bytes
+    base = 0
+    while True:
+        f.seek(base)
+        if f.read(8) == HDF5_SIGNATURE:
+            break
+        base = 512 if base == 0 else base * 2
+        if base + 8 > size:
+            raise CorruptFile("no HDF5 superblock")
+    version = _read(f, 1, "superblock")[0]
+    if version in (0, 1):
+        f.seek(base + 13)
+        size_of_offsets = _read(f, 1, "superblock")[0]
+        # base address, free-space address, end of file address
+        addresses = base + (24 if version == 0 else 28)
+        f.seek(addresses)
+        fields = f.read(3 * size_of_offsets)
+        base_address = int.from_bytes(fields[:size_of_offsets], "little")
+    elif version in (2, 3):
+        size_of_offsets = _read(f, 1, "superblock")[0]
+        # base address, superblock extension address, end of file address
+        f.seek(base + 12)
+        fields = f.read(3 * size_of_offsets)
+        base_address = int.from_bytes(fields[:size_of_offsets], "little")
+    else:
+        raise CorruptFile(f"unknown HDF5 superblock version {version}")
+    if len(fields) < 3 * size_of_offsets:
+        raise CorruptFile("superblock is cut off")
+    eof = int.from_bytes(fields[2 * size_of_offsets :], "little")
+    expected = base_address + eof
+    if size < expected:
+        raise CorruptFile(f"expected {expected} bytes, found {size}")
+
+
+class _HeaderReader:
+    """Read the fields of a NetCDF3 header in order."""
+
+    def __init__(self, f: BinaryIO, version: int) -> None:
+        self.f = f
+        # CDF-5 uses 64-bit counts, CDF-2 and CDF-5 use 64-bit offsets
+        self.count_size = 8 if version == 5 else 4
+        self.offset_size = 4 if version == 1 else 8
+
+    def read(self, n: int) -> bytes:
+        return _read(self.f, n, "header")
+
+    def int(self, n: int) -> int:
+        return int.from_bytes(self.read(n), "big")
+
+    def count(self) -> int:
+        return self.int(self.count_size)
+
+    def skip_padded(self, n: int) -> None:
+        self.read(n + (-n % 4))
+
+    def name(self) -> None:
+        self.skip_padded(self.count())
+
+    def attributes(self) -> None:
+        tag, n = self.int(4), self.count()
+        if tag not in (0, NC_ATTRIBUTE):
+            raise CorruptFile("bad attribute list in header")
+        for _ in range(n):
+            self.name()
+            nc_type = self.int(4)
+            if nc_type not in NC_TYPE_SIZES:
+                raise CorruptFile(f"unknown type {nc_type} in header")
+            self.skip_padded(self.count() * NC_TYPE_SIZES[nc_type])
+
+
+def check_netcdf3(f: BinaryIO, size: int) -> None:
+    """Check that a NetCDF3 file holds all the data its header lists.
+
+    Args:
+        f (BinaryIO): The open file.
+        size (int): The size of the file in bytes.
+
+    Raises:
+        CorruptFile: If the header is malformed or the data is cut off.
+    """
+    f.seek(0)
+    magic = _read(f, 4, "header")
+    version = magic[3]
+    if magic[:3] != b"CDF" or version not in (1, 2, 5):
+        raise CorruptFile("no NetCDF3 header")
+    header = _HeaderReader(f, version)
+    numrecs = header.count()
+    # a file that is still being written has all bits of its number of records set,
+    # which is 4 bytes long in CDF-1 and CDF-2 and 8 bytes long in CDF-5
+    streaming = numrecs == 2 ** (8 * header.count_size) - 1
+
+    tag, n_dims = header.int(4), header.count()
+    if tag not in (0, NC_DIMENSION):
+        raise CorruptFile("bad dimension list in header")
+    dims = []
+    for _ in range(n_dims):
+        header.name()
+        dims.append(header.count())
+    header.attributes()
+
+    tag, n_vars = header.int(4), header.count()
+    if tag not in (0, NC_VARIABLE):
+        raise CorruptFile("bad variable list in header")
+    variables = []
+    for _ in range(n_vars):
+        header.name()
+        dimids = [header.int(header.count_size) for _ in range(header.count())]
+        header.attributes()
+        nc_type = header.int(4)
+        header.count()  # vsize, which overflows for large variables
+        begin = header.int(header.offset_size)
+        if nc_type not in NC_TYPE_SIZES or any(i >= len(dims) for i in dimids):
+            raise CorruptFile("bad variable in header")
+        # the record dimension has length 0, and is the first one of a variable
+        is_record = bool(dimids) and dims[dimids[0]] == 0
+        nbytes = NC_TYPE_SIZES[nc_type]
+        for i in dimids[1:] if is_record else dimids:
+            nbytes *= dims[i]
+        variables.append((begin, nbytes, is_record))
+
+    records = [v for v in variables if v[2]]
+    # record variables are padded to 4 bytes, unless there is only one
+    recsize = sum(nbytes + (-nbytes % 4) for _, nbytes, _ in records)
+    if len(records) == 1:
+        recsize = records[0][1]
+    expected = header.f.tell()
+    for begin, nbytes, is_record in variables:
+        if not is_record:
+            expected = max(expected, begin + nbytes)
+        elif not streaming and numrecs > 0:
+            expected = max(expected, begin + (numrecs - 1) * recsize + nbytes)
+    if size < expected:
+        raise CorruptFile(f"expected {expected} bytes, found {size}")
+
+
+def check_file(path: str) -> Tuple[str, Optional[str]]:
+    """Check a GRIB or NetCDF file without decoding it.
+
+    Args:
+        path (str): The file, whose type is taken from its first bytes.
+
+    Returns:
+        Tuple[str, Optional[str]]: "ok" or "corrupt", and why it is corrupt.
+
+    Example:
+        check_file("/data/NEXRAD/2017/08/17/GaugeCorr_QPE_01H_00.00_20170817-120000.grib2")
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            magic = f.read(4)
+            if magic == b"GRIB":
+                check_grib(f, size)
+            elif magic[:3] == b"CDF":
+                check_netcdf3(f, size)
+            elif size == 0:
+                raise CorruptFile("empty file")
+            else:
+                check_hdf5(f, size)
+    except CorruptFile as e:
+        return CORRUPT, str(e)
+    except (IndexError, struct.error) as e:
+        # a field that the checks above do not bound-check yet
+        return CORRUPT, f"malformed: {e}"
+    except OSError as e:
+        return CORRUPT, f"cannot read: {e}"
+    return OK, None
+
+
+class IntegrityCache:
+    """The result of the last check of each file, stored in SQLite.
+
+    Attributes:
+        path (str): Path to the SQLite database.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open the cache, creating the database if it does not exist.
+
+        Args:
+            path (str): Path to the SQLite database. It should be on a local disk.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with connect(self.path) as conn:
+            conn.execute(SCHEMA)
+
+    def lookup(self, paths: Sequence[str]) -> Dict[str, Tuple[int, int, str, str]]:
+        """The cached `(size, mtime_ns, status, reason)` of some files.
+
+        Args:
+            paths (Sequence[str]): The files.
+
+        Returns:
+            Dict[str, Tuple[int, int, str, str]]: The cached results by path, for
+                the files that were checked before.
+        """
+        with connect(self.path) as conn:
+            conn.execute("CREATE TEMP TABLE wanted (path TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO wanted VALUES (?)", [(p,) for p in paths]
+            )
+            rows = conn.execute(
+                "SELECT files.path, size, mtime_ns, status, reason "
+                "FROM files JOIN wanted ON files.path = wanted.path"
+            ).fetchall()
+        return {path: tuple(rest) for path, *rest in rows}
+
+    def record(self, results: Sequence[Tuple[str, int, int, str, str]]) -> None:
+        """Store the results of some checks.
+
+        Args:
+            results (Sequence[Tuple[str, int, int, str, str]]): For each file, its
+                path, size, modification time in ns, status and reason.
+        """
+        checked = datetime.now().isoformat(timespec="seconds")
+        with connect(self.path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                [result + (checked,) for result in results],
+            )
+
+
+def find_files(roots: Sequence[str]) -> Dict[str, os.stat_result]:
+    """Find the GRIB and NetCDF files below some directories.
+
+    Args:
+        roots (Sequence[str]): Directories, or single files.
+
+    Returns:
+        Dict[str, os.stat_result]: The files with their status, by absolute path.
+    """
+    suffixes = GRIB_SUFFIXES + NETCDF_SUFFIXES
+    files = {}
+    for root in roots:
+        root = os.path.abspath(root)
+        if os.path.isfile(root):
+            files[root] = os.stat(root)
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Zarr stores hold many small chunks, and hidden directories caches
+            dirnames[:] = [
+                d for d in dirnames if not d.startswith(".") and not d.endswith(".zarr")
+            ]
+            for filename in filenames:
+                if filename.endswith(suffixes):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        files[path] = os.stat(path)
+                    except OSError:
+                        pass  # removed while scanning
+    return files
+
+
+def verify(
+    roots: Sequence[str],
+    cache_path: str = None,
+    max_workers: int = 1,
+    recheck: bool = False,
+) -> List[Tuple[str, str]]:
+    """Check the GRIB and NetCDF files below some directories.
+
+    Files whose size and modification time match the cache are not read again.
+
+    Args:
+        roots (Sequence[str]): Directories, or single files.
+        cache_path (str, optional): Path to the SQLite cache of results.
+        max_workers (int, optional): Number of worker processes.
+        recheck (bool, optional): Check every file, also those in the cache.
+
+    Returns:
+        List[Tuple[str, str]]: The corrupt files and why, sorted by path.
+
+    Example:
+        verify(["/data/NEXRAD", "/data/ERA5"], ".integrity_cache.sqlite", 8)
+    """
+    with span("scan") as scan:
+        files = find_files(roots)
+        scan.attrs["n_files"] = len(files)
+    cache = IntegrityCache(cache_path) if cache_path else None
+    cached = cache.lookup(list(files)) if cache and not recheck else {}
+
+    results = {}
+    todo = []
+    for path, stat in files.items():
+        hit = cached.get(path)
+        if hit and hit[:2] == (stat.st_size, stat.st_mtime_ns):
+            results[path] = hit[2:]
+        else:
+            todo.append(path)
+
+    with span("check", n_files=len(todo)):
+        if max_workers > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                checked = list(executor.map(check_file, todo, chunksize=64))
+        else:
+            checked = [check_file(path) for path in todo]
+    results.update(zip(todo, checked))
+    if cache:
+        cache.record(
+            [
+                (path, files[path].st_size, files[path].st_mtime_ns, status, reason)
+                for path, (status, reason) in zip(todo, checked)
+            ]
+        )
+
+    corrupt = sorted(
+        (path, reason)
+        for path, (status, reason) in results.items()
+        if status == CORRUPT
+    )
+    print(
+        f"{len(files)} files, {len(todo)} checked, {len(files) - len(todo)} unchanged, "
+        f"{len(corrupt)} corrupt"
+    )
+    return corrupt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find truncated or corrupt GRIB and NetCDF files without decoding them."
+    )
+    parser.add_argument(
+        "roots", nargs="+", help="Directories (or files) to check recursively."
+    )
+    parser.add_argument(
+        "--cache", help="SQLite cache of results, to skip unchanged files."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes."
+    )
+    parser.add_argument(
+        "--output", help="Write the paths of the corrupt files to this file."
+    )
+    parser.add_argument(
+        "--recheck", action="store_true", help="Also check unchanged files."
+    )
+    args = parser.parse_args()
+
+    with job("verify", roots=args.roots):
+        corrupt = verify(args.roots, args.cache, args.workers, args.recheck)
+    for path, reason in corrupt:
+        print(f"{path}: {reason}", file=sys.stderr)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            f.writelines(path + "\n" for path, _ in corrupt)
+    sys.exit(1 if corrupt else 0)